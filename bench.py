@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+#
+# Load generator and throughput benchmark: sends "send" commands with
+# synthetic device tokens or registration ids to the APNS or GCM
+# listener of a push2mob daemon, from several concurrent clients at a
+# given rate, then waits for the notifications to be delivered and
+# prints the results as a JSON object.
+#
+# With -S, it starts fakeserver.py and a push2mob node in the work
+# directory first (see clustertest.py); it must then be run from a
+# directory containing fake.crt and fake.key.  What the fake gateways
+# received and how long the node takes to exit are then added to the
+# results.
+#
+
+import base64
+import getopt
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import zmq
+
+from push2mob import Histogram
+
+def usage():
+    print """Usage: bench.py [options]
+Options:
+  -s    Service, "apns" or "gcm" (defaults to "apns")
+  -e    ZeroMQ endpoint of the listener (defaults to
+        tcp://127.0.0.1:12195 for APNS, tcp://127.0.0.1:12196 for GCM)
+  -a    Application (defaults to the default one)
+  -c    Number of concurrent clients (defaults to 4)
+  -r    Commands per second over all clients, 0 for as fast as
+        possible (defaults to 0)
+  -n    Number of commands (defaults to 1000)
+  -d    Duration in seconds, instead of a number of commands
+  -b    Device tokens or registration ids per command (defaults to 1)
+  -w    Max time to wait for deliveries in seconds (defaults to 60)
+  -o    File where to write the results instead of stdout
+  -S    Start fakeserver.py and a push2mob node in the work directory
+  -C    With -S, a "section.option=value" setting of the node
+        (may be given several times)
+  -F    With -S, options of fakeserver.py (e.g. "-a 8=0.01 -l 0.05")
+  -p    With -S, first TCP port to use (defaults to 13500)
+  -D    With -S, work directory (defaults to "./bench")
+  -h    Show this help message"""
+
+_STATRE = re.compile(r'^(\w+)(?:\{(.*)\})?=(\S+)$')
+_LABELRE = re.compile(r'(\w+)="([^"]*)"')
+
+def devtoken():
+    return base64.standard_b64encode(os.urandom(32))
+
+def regid():
+    return "APA91b%x" % random.getrandbits(512)
+
+def stats(sock):
+    """
+    Returns the result of the "stats" command as a list of (name,
+    labels dictionary, value) tuples.
+    """
+    sock.send("stats")
+    if not sock.poll(10000):
+        raise Exception("No reply to the stats command")
+    rep = sock.recv()
+    if not rep.startswith("OK"):
+        raise Exception("stats: %s" % rep)
+    samples = []
+    for item in rep.split()[1:]:
+        m = _STATRE.match(item)
+        if m is None:
+            continue
+        labels = dict(_LABELRE.findall(m.group(2) or ''))
+        samples.append((m.group(1), labels, float(m.group(3))))
+    return samples
+
+def completed(samples, service, outcome=None):
+    return sum(v for name, labels, v in samples
+        if name == 'push2mob_notifications_total' and
+            labels.get('service') == service and
+            (outcome is None or labels.get('outcome') == outcome))
+
+
+class Client(threading.Thread):
+    """
+    Sends commands until there are no more to send, each one waiting
+    for its turn when the rate is limited.
+    """
+
+    def __init__(self, bench, zmqctx):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.bench = bench
+        self.sock = zmqctx.socket(zmq.REQ)
+        self.sock.setsockopt(zmq.LINGER, 0)
+        self.sock.connect(bench.endpoint)
+        self.rtt = Histogram()
+        self.commands = 0
+        self.accepted = 0
+        self.errors = 0
+
+    def run(self):
+        b = self.bench
+        while True:
+            i = b.next()
+            if i is None:
+                break
+            if b.rate > 0:
+                delay = b.start + float(i) / b.rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            msg = b.command()
+            t0 = time.time()
+            self.sock.send(msg)
+            if not self.sock.poll(30000):
+                self.errors += 1
+                break
+            rep = self.sock.recv()
+            self.rtt.record(time.time() - t0)
+            self.commands += 1
+            if rep.startswith("OK"):
+                self.accepted += len(rep.split()) - 1
+            else:
+                self.errors += 1
+        self.sock.close()
+
+
+class Bench:
+    def __init__(self, service, endpoint, app, rate, count, duration,
+      batch):
+        self.service = service
+        self.endpoint = endpoint
+        self.prefix = "app=%s " % app if app is not None else ""
+        self.rate = rate
+        self.count = count
+        self.duration = duration
+        self.batch = batch
+        self.counter = itertools.count()
+        self.mutex = threading.Lock()
+        self.start = None
+
+    def next(self):
+        """
+        Returns the index of the next command to send or None when done.
+        """
+        with self.mutex:
+            i = self.counter.next()
+        if self.duration is not None:
+            if time.time() - self.start >= self.duration or \
+              (self.rate > 0 and i >= self.duration * self.rate):
+                return None
+        elif i >= self.count:
+            return None
+        return i
+
+    def command(self):
+        if self.service == 'apns':
+            toks = [devtoken() for i in range(self.batch)]
+            return "%ssend +3600 %d %s {\"aps\":{\"alert\":\"bench\"}}" % \
+                (self.prefix, len(toks), ' '.join(toks))
+        ids = [regid() for i in range(self.batch)]
+        return "%ssend bench +3600 nodelayidle %d %s {\"msg\":\"bench\"}" % \
+            (self.prefix, len(ids), ' '.join(ids))
+
+    def run(self, concurrency, drainwait):
+        zmqctx = zmq.Context()
+        ctl = zmqctx.socket(zmq.REQ)
+        ctl.setsockopt(zmq.LINGER, 0)
+        ctl.connect(self.endpoint)
+        before = stats(ctl)
+
+        clients = [Client(self, zmqctx) for i in range(concurrency)]
+        self.start = time.time()
+        for c in clients:
+            c.start()
+        for c in clients:
+            c.join()
+        sendtime = time.time() - self.start
+        rtt = Histogram()
+        for c in clients:
+            rtt.merge(c.rtt.snapshot())
+        commands = sum(c.commands for c in clients)
+        accepted = sum(c.accepted for c in clients)
+        errors = sum(c.errors for c in clients)
+
+        done0 = completed(before, self.service)
+        sent0 = completed(before, self.service, 'sent')
+        deadline = time.time() + drainwait
+        while True:
+            after = stats(ctl)
+            done = completed(after, self.service) - done0
+            if done >= accepted or time.time() >= deadline:
+                break
+            time.sleep(0.1)
+        drainedtime = time.time() - self.start
+        delivered = completed(after, self.service, 'sent') - sent0
+        ctl.close()
+
+        lag = {}
+        for name, labels, v in after:
+            if name == 'push2mob_lag_seconds' and \
+              labels.get('service') == self.service:
+                lag["p%g" % (float(labels['quantile']) * 100)] = v
+        return {
+            'service': self.service,
+            'endpoint': self.endpoint,
+            'concurrency': concurrency,
+            'rate': self.rate,
+            'batch': self.batch,
+            'commands': commands,
+            'errors': errors,
+            'accepted': accepted,
+            'completed': int(done),
+            'delivered': int(delivered),
+            'send_seconds': sendtime,
+            'drain_seconds': drainedtime,
+            'commands_per_second': commands / sendtime,
+            'accepted_per_second': accepted / sendtime,
+            'delivered_per_second': delivered / drainedtime,
+            'rtt_seconds': dict(("p%g" % (q * 100), rtt.quantile(q))
+                for q in (0.5, 0.9, 0.99, 0.999)),
+            # Quantiles over the whole life of the daemon.
+            'lag_seconds': lag,
+        }
+
+if __name__ == "__main__":
+    service = 'apns'
+    endpoint = None
+    app = None
+    concurrency = 4
+    rate = 0.0
+    count = 1000
+    duration = None
+    batch = 1
+    drainwait = 60.0
+    output = None
+    spawn = False
+    overrides = {}
+    fsoptions = []
+    port = 13500
+    workdir = "bench"
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "s:e:a:c:r:n:d:b:w:o:SC:F:p:D:h")
+    except getopt.GetoptError as e:
+        print >>sys.stderr, e
+        sys.exit(1)
+    try:
+        for o, a in opts:
+            if o == "-s":
+                if a not in ('apns', 'gcm'):
+                    raise ValueError("Unknown service: %s" % a)
+                service = a
+            elif o == "-e":
+                endpoint = a
+            elif o == "-a":
+                app = a
+            elif o == "-c":
+                concurrency = int(a)
+            elif o == "-r":
+                rate = float(a)
+            elif o == "-n":
+                count = int(a)
+            elif o == "-d":
+                duration = float(a)
+            elif o == "-b":
+                batch = int(a)
+            elif o == "-w":
+                drainwait = float(a)
+            elif o == "-o":
+                output = a
+            elif o == "-S":
+                spawn = True
+            elif o == "-C":
+                option, value = a.split('=', 1)
+                section, option = option.rsplit('.', 1)
+                overrides.setdefault(section, {})[option] = value
+            elif o == "-F":
+                fsoptions = a.split()
+            elif o == "-p":
+                port = int(a)
+            elif o == "-D":
+                workdir = a
+            elif o == "-h":
+                usage()
+                sys.exit(0)
+    except ValueError as e:
+        print >>sys.stderr, e
+        sys.exit(1)
+
+    cluster = None
+    if spawn:
+        from clustertest import Cluster
+        workdir = os.path.abspath(workdir)
+        if not os.path.isdir(workdir):
+            os.makedirs(workdir)
+        for f in os.listdir(workdir):
+            os.unlink(os.path.join(workdir, f))
+        cluster = Cluster(workdir, port)
+        fscounts = os.path.join(workdir, "fakeserver.json")
+        cluster.startfakeserver(fsoptions + ["-q", "-o", fscounts])
+        time.sleep(1)
+        # Logging each notification would be what is measured.
+        settings = {'apns': {'log_level': 'info'},
+            'gcm': {'log_level': 'info'}}
+        for section, options in overrides.iteritems():
+            settings.setdefault(section, {}).update(options)
+        cluster.startnode(0, settings)
+        time.sleep(2)
+        apns, gcm = cluster.nodeendpoints(0)
+        if endpoint is None:
+            endpoint = apns if service == 'apns' else gcm
+    elif endpoint is None:
+        endpoint = "tcp://127.0.0.1:%d" % \
+            (12195 if service == 'apns' else 12196)
+
+    try:
+        bench = Bench(service, endpoint, app, rate, count, duration, batch)
+        results = bench.run(concurrency, drainwait)
+        if cluster is not None:
+            # From the exit request to the end of the node process,
+            # including the checkpoint of what is left in the queues.
+            t0 = time.time()
+            cluster.stop("node0")
+            results['shutdown_seconds'] = time.time() - t0
+    finally:
+        if cluster is not None:
+            cluster.stopall()
+    if cluster is not None:
+        results['gateway'] = json.load(open(fscounts))
+
+    out = json.dumps(results, sort_keys=True, indent=2)
+    if output is not None:
+        open(output, "w").write(out + '\n')
+    else:
+        print out
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+#
+# Runs a local push2mob cluster: fakeserver.py, several push2mob nodes
+# and p2mrouter.py, all as separate processes, then checks how device
+# tokens are spread over the nodes, including when a node joins and
+# leaves the ring.
+#
+# It must be run from a directory containing fake.crt and fake.key (see
+# fakeserver.py).  Files of the run are left in the work directory.
+#
+
+import ConfigParser
+import base64
+import getopt
+import os
+import random
+import re
+import signal
+import subprocess
+import sys
+import time
+import zmq
+
+TOPDIR = os.path.dirname(os.path.abspath(__file__))
+
+# Settings of the nodes, so that the duplicate filter and the device
+# throttle are checked together: one notification per minute for each
+# device token, dropped beyond.
+NODECONF = {'apns': {'dedup_window': '600', 'device_max_rate': '1'}}
+
+def usage():
+    print """Usage: clustertest.py [options]
+Options:
+  -n    Number of nodes (defaults to 3)
+  -t    Number of device tokens (defaults to 1000)
+  -p    First TCP port to use (defaults to 13000)
+  -d    Work directory (defaults to "./clustertest")
+  -h    Show this help message"""
+
+class Cluster:
+    def __init__(self, workdir, port):
+        self.workdir = workdir
+        self.port = port
+        self.procs = {}
+        self.order = []
+        self.zmqctx = zmq.Context()
+
+    def spawn(self, name, args):
+        log = open(os.path.join(self.workdir, "%s.out" % name), "w")
+        self.procs[name] = subprocess.Popen([sys.executable] + args,
+            stdout=log, stderr=subprocess.STDOUT)
+        self.order.append(name)
+
+    def stop(self, name):
+        p = self.procs.pop(name)
+        self.order.remove(name)
+        p.send_signal(signal.SIGINT)
+        p.wait()
+
+    def kill(self, name):
+        p = self.procs.pop(name)
+        self.order.remove(name)
+        p.kill()
+        p.wait()
+
+    def stopall(self):
+        # Nodes cannot exit while they are connecting to the fake server.
+        for name in reversed(self.order[:]):
+            self.stop(name)
+
+    def nodeendpoints(self, i):
+        port = self.port + 100 + 2 * i
+        return ("tcp://127.0.0.1:%d" % port, "tcp://127.0.0.1:%d" % (port + 1))
+
+    def startfakeserver(self, options=[]):
+        self.spawn("fakeserver", [os.path.join(TOPDIR, "fakeserver.py")] +
+            options + ["apns:127.0.0.1:%d" % self.port,
+            "feedback:127.0.0.1:%d" % (self.port + 1),
+            "gcm:127.0.0.1:%d" % (self.port + 2)])
+
+    def startnode(self, i, overrides={}):
+        """
+        Starts a push2mob node, `overrides' maps sections to options
+        to set in its configuration file.
+        """
+        cp = ConfigParser.SafeConfigParser()
+        cp.read([os.path.join(TOPDIR, "push2mob.conf")])
+        f = lambda name: os.path.join(self.workdir, "node%d.%s" % (i, name))
+        apns, gcm = self.nodeendpoints(i)
+        settings = {
+            'main': {'daemon': '0', 'log_stdout': '0', 'log_file': f("log"),
+                'log_level': 'info'},
+            'apns': {'zmq_bind': apns[6:], 'sqlite_db': f("db"),
+                'log_level': 'debug', 'cacerts_file': '', 'cert_file': '',
+                'key_file': '',
+                'push_gateway': '127.0.0.1:%d' % self.port,
+                'feedback_gateway': '127.0.0.1:%d' % (self.port + 1)},
+            'gcm': {'zmq_bind': gcm[6:], 'sqlite_db': f("db"),
+                'log_level': 'debug', 'cacerts_file': '',
+                'server_url': 'https://localhost:%d/gcm/send' %
+                    (self.port + 2)}
+        }
+        for section, options in settings.items() + overrides.items():
+            if not cp.has_section(section):
+                cp.add_section(section)
+            for option, value in options.iteritems():
+                cp.set(section, option, value)
+        cp.write(open(f("conf"), "w"))
+        self.spawn("node%d" % i, [os.path.join(TOPDIR, "push2mob.py"),
+            "-c", f("conf")])
+
+    def startrouter(self, nnodes):
+        cp = ConfigParser.SafeConfigParser()
+        cp.read([os.path.join(TOPDIR, "p2mrouter.conf")])
+        endpoints = [self.nodeendpoints(i) for i in range(nnodes)]
+        cp.set('router', 'log_stdout', '0')
+        cp.set('router', 'node_timeout', '1')
+        cp.set('router', 'log_file', os.path.join(self.workdir, "router.log"))
+        cp.set('router', 'apns_zmq_bind', "127.0.0.1:%d" % (self.port + 10))
+        cp.set('router', 'gcm_zmq_bind', "127.0.0.1:%d" % (self.port + 11))
+        cp.set('router', 'apns_nodes', ','.join(e[0] for e in endpoints))
+        cp.set('router', 'gcm_nodes', ','.join(e[1] for e in endpoints))
+        conffile = os.path.join(self.workdir, "router.conf")
+        cp.write(open(conffile, "w"))
+        self.spawn("router", [os.path.join(TOPDIR, "p2mrouter.py"),
+            "-c", conffile])
+        self.apns = self.zmqctx.socket(zmq.REQ)
+        self.apns.connect("tcp://127.0.0.1:%d" % (self.port + 10))
+        self.gcm = self.zmqctx.socket(zmq.REQ)
+        self.gcm.connect("tcp://127.0.0.1:%d" % (self.port + 11))
+
+    def request(self, sock, msg):
+        sock.send(msg)
+        if not sock.poll(30000):
+            raise Exception("No reply to: %s" % msg[:80])
+        return sock.recv()
+
+    def route(self, devtoks):
+        return [self.request(self.apns, "route %s" % t)[3:] for t in devtoks]
+
+
+def check(what, ok):
+    print "%s: %s" % ("PASS" if ok else "FAIL", what)
+    return ok
+
+def distribution(owners):
+    counts = {}
+    for o in owners:
+        counts[o] = counts.get(o, 0) + 1
+    return ', '.join("%s=%d" % (o, counts[o]) for o in sorted(counts))
+
+def scenario(c, nnodes, ntokens):
+    ok = True
+    devtoks = [base64.standard_b64encode(os.urandom(32))
+        for i in range(ntokens)]
+    regids = ["APA91b%x" % random.getrandbits(128) for i in range(ntokens)]
+
+    before = c.route(devtoks)
+    print "Device tokens over %d nodes: %s" % (nnodes, distribution(before))
+
+    # A new node takes about 1/(N+1) of the tokens and only from others.
+    c.startnode(nnodes, NODECONF)
+    newapns, newgcm = c.nodeendpoints(nnodes)
+    c.request(c.apns, "join %s" % newapns)
+    c.request(c.gcm, "join %s" % newgcm)
+    after = c.route(devtoks)
+    moved = [i for i in range(ntokens) if before[i] != after[i]]
+    print "Device tokens over %d nodes: %s" % (nnodes + 1,
+        distribution(after))
+    ok &= check("%d/%d device tokens moved (expected ~%d), all to the new " \
+        "node" % (len(moved), ntokens, ntokens / (nnodes + 1)),
+        all(after[i] == newapns for i in moved) and
+        len(moved) < 2 * ntokens / (nnodes + 1))
+
+    # Send notifications by batches of 10 devices.
+    t0 = time.time()
+    napnsids = ngcmids = 0
+    for i in range(0, ntokens, 10):
+        rep = c.request(c.apns, "send +3600 %d %s {\"aps\":{\"alert\":\"" \
+            "cluster\"}}" % (len(devtoks[i:i+10]), ' '.join(devtoks[i:i+10])))
+        napnsids += len(rep.split()) - 1
+        rep = c.request(c.gcm, "send cluster +3600 nodelayidle %d %s " \
+            "{\"msg\":\"cluster\"}" % (len(regids[i:i+10]),
+            ' '.join(regids[i:i+10])))
+        ngcmids += len(rep.split()) - 1
+    elapsed = time.time() - t0
+    print "Sent %d APNS and %d GCM device tokens in %.3fs" % \
+        (ntokens, ntokens, elapsed)
+    ok &= check("one APNS id per device token", napnsids == ntokens)
+    ok &= check("GCM notifications accepted", ngcmids > 0)
+
+    # Back to the initial ring, the feedback of the leaving node is
+    # retrieved.
+    c.request(c.apns, "leave %s" % newapns)
+    c.request(c.gcm, "leave %s" % newgcm)
+    ok &= check("device tokens back to their initial node after leave",
+        c.route(devtoks) == before)
+    ok &= check("feedback", c.request(c.apns, "feedback").startswith("OK") and
+        c.request(c.gcm, "feedback").startswith("OK"))
+
+    # A notification dropped by the throttle is not remembered by the
+    # duplicate filter: sent again, it is throttled again instead of
+    # being taken for the notification which got the next id, here to
+    # another device of the same node.
+    fresh = [base64.standard_b64encode(os.urandom(32)) for i in range(20)]
+    owners = c.route(fresh)
+    a = fresh[0]
+    b = [t for t, node in zip(fresh, owners) if node == owners[0]][1]
+    send = lambda devtok, alert: c.request(c.apns, "send +3600 1 %s " \
+        "{\"aps\":{\"alert\":\"%s\"}}" % (devtok, alert)).split()[1:]
+    again = [send(a, "p1"), send(a, "p2"), send(b, "p3"), send(a, "p2")]
+    ok &= check("a throttled notification sent again is not a duplicate",
+        again[1] == ["-"] and again[3] == ["-"] and
+        again[2][0].isdigit())
+
+    # The device tokens of a node which does not answer go to the next
+    # node on the ring.
+    c.kill("node0")
+    failover = [base64.standard_b64encode(os.urandom(32)) for i in range(20)]
+    rep = c.request(c.apns, "send +3600 %d %s {\"aps\":{\"alert\":\"" \
+        "failover\"}}" % (len(failover), ' '.join(failover)))
+    ok &= check("failover when a node is down", len(rep.split()) == 21)
+
+    # Check in the logs of the nodes that each got its shard.
+    time.sleep(2)
+    c.stopall()
+    got = {}
+    gotre = re.compile(r"Got notification #\d+ for device token (\S+) ")
+    for i in range(nnodes + 1):
+        for line in open(os.path.join(c.workdir, "node%d.log" % i)):
+            m = gotre.search(line)
+            if m is not None:
+                got[m.group(1)] = c.nodeendpoints(i)[0]
+    ok &= check("each node got the device tokens of its shard",
+        all(got.get(devtoks[i]) == after[i] for i in range(ntokens)))
+    return ok
+
+if __name__ == "__main__":
+    nnodes = 3
+    ntokens = 1000
+    port = 13000
+    workdir = "clustertest"
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "n:t:p:d:h")
+    except getopt.GetoptError as e:
+        print >>sys.stderr, e
+        sys.exit(1)
+    for o, a in opts:
+        if o == "-n":
+            nnodes = int(a)
+        elif o == "-t":
+            ntokens = int(a)
+        elif o == "-p":
+            port = int(a)
+        elif o == "-d":
+            workdir = a
+        elif o == "-h":
+            usage()
+            sys.exit(0)
+
+    workdir = os.path.abspath(workdir)
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    for f in os.listdir(workdir):
+        os.unlink(os.path.join(workdir, f))
+
+    c = Cluster(workdir, port)
+    try:
+        c.startfakeserver()
+        time.sleep(1)
+        for i in range(nnodes):
+            c.startnode(i, NODECONF)
+        time.sleep(2)
+        c.startrouter(nnodes)
+        ok = scenario(c, nnodes, ntokens)
+    finally:
+        c.stopall()
+    sys.exit(0 if ok else 1)
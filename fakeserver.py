@@ -6,18 +6,18 @@
 #   % [req]
 #   % prompt = yes
 #   % distinguished_name = dn
-#   % 
+#   %
 #   % [dn]
 #   % countryName="Country Name"
 #   % countryName_default="FR"
 #   % countryName_min=2
 #   % countryName_max=2
-#   % 
+#   %
 #   % organizationName="Organization"
 #   % organizationName_default="Self-Signed"
 #   % organizationName_min=2
 #   % organizationName_max=32
-#   % 
+#   %
 #   % commonName="Common Name"
 #   % commonName_default="Test"
 #   % commonName_min=2
@@ -29,84 +29,430 @@
 #   $ openssl rsa -in fake.key.crypted -out fake.key
 #   $ openssl x509 -req -days 365 -in fake.csr -signkey fake.key -out fake.crt
 #   $ rm fake.key.crypted fake.key.crypted
+#
+# The fake APNS push gateway parses notifications and may answer them
+# with an error response before closing the connection, as APNS does.
+# Device tokens rejected as invalid are rejected again afterwards and
+# are returned by the fake feedback service.  The fake GCM server
+# answers each registration id with a success or an error, or the
+# whole request with a 503.  See the options for how often.
+#
+# Counts of what has been received are printed on exit (SIGINT) as a
+# JSON object, and served by the fake GCM server on GET /stats.
+#
 
 import BaseHTTPServer
 import SocketServer
+import getopt
 import json
-import os
-import select
+import random
+import signal
 import socket
 import ssl
+import struct
 import sys
 import threading
+import time
+
+def usage():
+    print """Usage: fakeserver.py [options] <type:ip:port> [...]
+Type: apns, feedback, gcm
+Options:
+  -a    APNS error responses, as "status=fraction,..." (e.g. "8=0.01")
+  -g    GCM errors, as "error=fraction,..." where error is a GCM error
+        such as NotRegistered or Unavailable, or "canonical" for results
+        with a registration_id (e.g. "NotRegistered=0.01,canonical=0.01")
+  -u    Fraction of GCM requests answered with a 503 status
+  -r    Retry-After of 503 responses in seconds (defaults to 1)
+  -l    Latency in seconds, before each GCM response and APNS error
+        response
+  -b    Bandwidth in bytes per second of each connection, 0 for no
+        limit (defaults to 0)
+  -P    Max APNS payload size (defaults to 256)
+  -s    Random seed
+  -o    File where to write the counts on exit
+  -i    Print the counts every given seconds
+  -q    Don't log each connection and request
+  -h    Show this help message"""
+
+class Settings:
+    apnserrors = []
+    gcmerrors = []
+    unavailable = 0.0
+    retryafter = 1
+    latency = 0.0
+    bandwidth = 0
+    maxpayload = 256
+    quiet = False
+
+def parsefractions(spec, conv=str):
+    l = []
+    for item in spec.split(','):
+        k, v = item.split('=')
+        l.append((conv(k), float(v)))
+    return l
+
+def pick(fractions):
+    """
+    Returns the key picked at random from a list of (key, fraction),
+    or None for the remaining fraction.
+    """
+    r = random.random()
+    for k, fraction in fractions:
+        if r < fraction:
+            return k
+        r -= fraction
+    return None
+
+def log(msg):
+    if not Settings.quiet:
+        print msg
+        sys.stdout.flush()
+
+
+class Counts:
+    """
+    Thread-safe counters, keyed by name.
+    """
+
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.counts = {}
+
+    def incr(self, name, n=1):
+        with self.mutex:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def dump(self):
+        with self.mutex:
+            return json.dumps(self.counts, sort_keys=True)
+
+counts = Counts()
+# Device tokens (binary) rejected as invalid, those not returned by the
+# feedback service yet, and registration ids answered with
+# NotRegistered.  Sets are thread-safe enough.
+invalidtokens = set()
+feedbacktokens = set()
+unregistered = set()
+
+
+class Throttle:
+    """
+    Sleeps as needed so that a connection does not go faster than the
+    configured bandwidth.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.size = 0
+
+    def __call__(self, size):
+        if Settings.bandwidth <= 0:
+            return
+        self.size += size
+        delay = self.start + float(self.size) / Settings.bandwidth - \
+            time.time()
+        if delay > 0:
+            time.sleep(delay)
+
 
 class SSLServer(SocketServer.TCPServer):
+    allow_reuse_address = True
+
     def __init__(self, srvaddr, RequestHandlerClass, sslcert, sslkey):
         SocketServer.TCPServer.__init__(self, srvaddr, RequestHandlerClass)
         self.socket = ssl.wrap_socket(self.socket, server_side=True,
             certfile=sslcert, keyfile=sslkey, ssl_version=ssl.PROTOCOL_TLSv1)
 
 class APNSRequestHandler(SocketServer.BaseRequestHandler):
+    """
+    Parses simple (0), enhanced (1) and frame-based (2) notifications.
+    """
+
+    _ITEMIDENTIFIER = 3
+
+    def _read(self, n):
+        while len(self.buf) < n:
+            data = self.request.recv(4096)
+            if len(data) == 0:
+                raise EOFError
+            self.size += len(data)
+            self.throttle(len(data))
+            self.buf += data
+        data, self.buf = self.buf[:n], self.buf[n:]
+        return data
+
+    def _unpack(self, fmt):
+        return struct.unpack(fmt, self._read(struct.calcsize(fmt)))
+
+    def _notification(self):
+        """
+        Returns (identifier, device token, payload) of the next
+        notification, or a status if it cannot be parsed.
+        """
+        cmd, = self._unpack('>B')
+        ident = 0
+        if cmd == 0:
+            toklen, = self._unpack('>H')
+        elif cmd == 1:
+            ident, expiry, toklen = self._unpack('>IIH')
+        elif cmd == 2:
+            framelen, = self._unpack('>I')
+            frame = self._read(framelen)
+            items = {}
+            while len(frame) >= 3:
+                itemid, itemlen = struct.unpack('>BH', frame[:3])
+                items[itemid] = frame[3:3 + itemlen]
+                frame = frame[3 + itemlen:]
+            if len(items.get(self._ITEMIDENTIFIER, '')) == 4:
+                ident, = struct.unpack('>I', items[self._ITEMIDENTIFIER])
+            return (ident, items.get(1, ''), items.get(2, ''))
+        else:
+            return 1
+        devtok = self._read(toklen)
+        paylen, = self._unpack('>H')
+        payload = self._read(paylen)
+        return (ident, devtok, payload)
+
+    def _status(self, devtok, payload):
+        if len(devtok) == 0:
+            return 2
+        if len(devtok) != 32:
+            return 5
+        if len(payload) == 0:
+            return 4
+        if len(payload) > Settings.maxpayload:
+            return 7
+        if devtok in invalidtokens:
+            return 8
+        return pick(Settings.apnserrors)
+
     def handle(self):
-        size = 0
-        while True:
-            data = self.request.recv(1024)
-            size += len(data)
-            if len(data) != 0:
-                continue
-            print ("Client wrote %u bytes" % size)
-            break
+        self.buf = ""
+        self.size = 0
+        self.throttle = Throttle()
+        counts.incr('apns_connections')
+        frames = 0
+        try:
+            while True:
+                n = self._notification()
+                if type(n) is tuple:
+                    ident, devtok, payload = n
+                    frames += 1
+                    counts.incr('apns_notifications')
+                    st = self._status(devtok, payload)
+                else:
+                    ident, st = 0, n
+                if st is None:
+                    counts.incr('apns_accepted')
+                    continue
+                counts.incr('apns_errors_%d' % st)
+                if st == 8:
+                    invalidtokens.add(devtok)
+                    feedbacktokens.add(devtok)
+                if Settings.latency > 0:
+                    time.sleep(Settings.latency)
+                # APNS discards what follows and closes the connection.
+                self.request.sendall(struct.pack('>BBI', 8, st, ident))
+                log("Notification #%d: status %d, closing" % (ident, st))
+                break
+        except EOFError:
+            pass
+        except socket.error as e:
+            log("Connection error: %s" % e)
+        counts.incr('apns_bytes', self.size)
+        log("Client wrote %u bytes in %u notifications" % (self.size, frames))
+
+class FeedbackRequestHandler(SocketServer.BaseRequestHandler):
+    """
+    Returns the device tokens rejected as invalid so far, once.
+    """
+
+    def handle(self):
+        counts.incr('feedback_connections')
+        now = int(time.time())
+        buf = ""
+        while len(feedbacktokens) != 0:
+            try:
+                devtok = feedbacktokens.pop()
+            except KeyError:
+                break
+            buf += struct.pack('>IH32s', now, len(devtok), devtok)
+            counts.incr('feedback_tokens')
+        if len(buf) != 0:
+            if Settings.latency > 0:
+                time.sleep(Settings.latency)
+            Throttle()(len(buf))
+            self.request.sendall(buf)
+        log("Sent %u device tokens as feedback" % (len(buf) / 38))
 
 class GCMRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def _respond(self, status, body, headers={}):
+        if Settings.latency > 0:
+            time.sleep(Settings.latency)
+        self.throttle(len(body))
+        self.send_response(status)
+        for k, v in headers.iteritems():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _result(self, regid):
+        if regid in unregistered:
+            error = 'NotRegistered'
+        else:
+            error = pick(Settings.gcmerrors)
+        counts.incr('gcm_results_%s' % (error or 'success'))
+        if error is None:
+            return {'message_id': '0:%d' % random.getrandbits(48)}
+        if error == 'canonical':
+            return {'message_id': '0:%d' % random.getrandbits(48),
+                'registration_id': 'APA91bcanonical%x' %
+                random.getrandbits(64)}
+        if error == 'NotRegistered':
+            unregistered.add(regid)
+        return {'error': error}
+
+    def do_GET(self):
+        if self.path != '/stats':
+            self.send_error(404)
+            return
+        self.throttle = Throttle()
+        self._respond(200, counts.dump() + "\n",
+            {'Content-Type': 'application/json'})
+
     def do_POST(self):
+        self.throttle = Throttle()
         bodylen = int(self.headers.getheader('Content-length'))
+        self.throttle(bodylen)
+        counts.incr('gcm_requests')
         try:
             body = json.loads(self.rfile.read(bodylen))
+            regids = body['registration_ids']
         except:
-            self.send_error(415, "Wrong JSON formatting")
+            counts.incr('gcm_status_400')
+            self._respond(400, "Wrong JSON formatting\n")
             return
-	try:
-	    status = body['data']['status']
-	except KeyError:
-	    status = 200
-	print "Client sent %u notifications, returning %u" % \
-	  (len(body['registration_ids']), status)
+        if self.headers.getheader('Authorization') is None:
+            counts.incr('gcm_status_401')
+            self._respond(401, "Unauthorized\n")
+            return
+        if len(regids) > 1000:
+            counts.incr('gcm_status_400')
+            self._respond(400, "Too many registration ids\n")
+            return
+        try:
+            status = body['data']['status']
+        except (KeyError, TypeError):
+            status = 200
+        if status == 200 and Settings.unavailable > 0 and \
+          random.random() < Settings.unavailable:
+            status = 503
+        counts.incr('gcm_status_%d' % status)
+        log("Client sent %u notifications, returning %u" %
+            (len(regids), status))
+        if status != 200:
+            self._respond(status, "", {'Retry-After':
+                str(Settings.retryafter)})
+            return
+
+        counts.incr('gcm_registration_ids', len(regids))
+        results = [self._result(regid) for regid in regids]
         resp = json.dumps({
-            'multicast_id': 'stubby answer',
-            'success': len(body['registration_ids']),
-            'failure': 0,
-            'canonical_ids': 0
+            'multicast_id': random.getrandbits(63),
+            'success': sum(1 for r in results if 'error' not in r),
+            'failure': sum(1 for r in results if 'error' in r),
+            'canonical_ids': sum(1 for r in results if
+                'registration_id' in r),
+            'results': results
         }) + "\n"
-        self.send_response(status)
-        self.send_header("Content-Length", str(len(resp)))
-        self.end_headers()
-        self.wfile.write(resp)
+        self._respond(200, resp, {'Content-Type': 'application/json'})
+
+    def log_message(self, format, *args):
+        if not Settings.quiet:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self,
+                format, *args)
 
 SocketServer.ThreadingMixIn.daemon_threads = True
 class ThreadedSSLServer(SocketServer.ThreadingMixIn, SSLServer):
     pass
 
+def report(output):
+    c = counts.dump()
+    print c
+    sys.stdout.flush()
+    if output is not None:
+        open(output, "w").write(c + "\n")
+
+def interrupted(signum, frame):
+    raise KeyboardInterrupt
+
+handlers = {
+    'apns': APNSRequestHandler,
+    'feedback': FeedbackRequestHandler,
+    'gcm': GCMRequestHandler
+}
+
 tlist = []
 if __name__ == "__main__":
-    for arg in sys.argv[1:]:
+    output = None
+    interval = 0
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "a:g:u:r:l:b:P:s:o:i:qh")
+        for o, a in opts:
+            if o == "-a":
+                Settings.apnserrors = parsefractions(a, int)
+            elif o == "-g":
+                Settings.gcmerrors = parsefractions(a)
+            elif o == "-u":
+                Settings.unavailable = float(a)
+            elif o == "-r":
+                Settings.retryafter = int(a)
+            elif o == "-l":
+                Settings.latency = float(a)
+            elif o == "-b":
+                Settings.bandwidth = int(a)
+            elif o == "-P":
+                Settings.maxpayload = int(a)
+            elif o == "-s":
+                random.seed(int(a))
+            elif o == "-o":
+                output = a
+            elif o == "-i":
+                interval = float(a)
+            elif o == "-q":
+                Settings.quiet = True
+            elif o == "-h":
+                usage()
+                sys.exit(0)
+    except (getopt.GetoptError, ValueError) as e:
+        print >>sys.stderr, e
+        sys.exit(1)
+
+    for arg in args:
         a = arg.split(":")
-        if a[0] == "apns":
-	    print "Starting %s..." % arg
-            server = ThreadedSSLServer((a[1], int(a[2])),
-              APNSRequestHandler, "fake.crt", "fake.key")
-        elif a[0] == "gcm":
-	    print "Starting %s..." % arg
-            server = ThreadedSSLServer((a[1], int(a[2])),
-              GCMRequestHandler, "fake.crt", "fake.key")
-        else:
-            print "Usage: %s <type:ip:port> [...]"
-            print "Type: apns, gcm"
+        if len(a) != 3 or a[0] not in handlers:
+            usage()
             sys.exit(1)
+        print "Starting %s..." % arg
+        server = ThreadedSSLServer((a[1], int(a[2])), handlers[a[0]],
+            "fake.crt", "fake.key")
         t = threading.Thread(target=server.serve_forever)
-	t.daemon = True
+        t.daemon = True
         tlist.append(t)
         t.start()
+    sys.stdout.flush()
 
-for t in tlist:
-    while t.isAlive():
-	t.join(1)
+    signal.signal(signal.SIGTERM, interrupted)
+    last = time.time()
+    try:
+        for t in tlist:
+            while t.isAlive():
+                t.join(1)
+                if interval > 0 and time.time() - last >= interval:
+                    last = time.time()
+                    report(None)
+    except KeyboardInterrupt:
+        pass
+    report(output)
@@ -0,0 +1,410 @@
+#!/usr/bin/env python
+#
+# Microbenchmarks of the hot paths of push2mob: command parsing, APNS
+# and GCM message building, GCM response handling and persistent
+# queues.  Each benchmark runs in isolation over input sizes like those
+# of production and its time per item is compared to a baseline stored
+# in microbench.json.  Exits with status 1 if any benchmark is slower
+# than its baseline by more than the threshold, or than its noise if
+# greater.
+#
+# Baselines depend on the machine: record your own with -u before
+# changing the code.
+#
+
+import base64
+import getopt
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import push2mob
+from push2mob import APNSAgent, APNSListener, AttributeHolder, \
+    CheckpointableQueue, CheckpointableTimelySQueue, GCMAgent, \
+    GCMExponentialBackoffDatabase, GCMFeedbackDatabase, GCMListener, \
+    GCMNotification, HTTPResponseReceiver, Listener
+
+TOPDIR = os.path.dirname(os.path.abspath(__file__))
+
+def usage():
+    print """Usage: microbench.py [options]
+Options:
+  -b    Baseline file (defaults to microbench.json next to this script)
+  -u    Record the results as the new baseline
+  -t    Min ratio to the baseline before failing (defaults to 1.5)
+  -k    Only run benchmarks whose name matches this regular expression
+  -r    Number of rounds, each running every benchmark once, the best
+        time being kept (defaults to 7)
+  -o    File where to write the results as JSON
+  -h    Show this help message"""
+
+# List of (name, setup), setup returning (func, number of items func
+# handles at each call).
+BENCHMARKS = []
+
+def benchmark(name):
+    def register(setup):
+        BENCHMARKS.append((name, setup))
+        return setup
+    return register
+
+def measure(func, nitems):
+    """
+    Returns the time per item in microseconds of a run of at least 0.1
+    second.
+    """
+    loops = 0
+    t0 = time.time()
+    while True:
+        func()
+        loops += 1
+        elapsed = time.time() - t0
+        if elapsed >= 0.1:
+            break
+    return elapsed / (loops * nitems) * 1000000
+
+def summarize(times):
+    """
+    Returns the best of `times' and their noise, how much slower the
+    first quartile is relatively to the best.
+    """
+    times = sorted(times)
+    best = times[0]
+    return best, (times[len(times) / 4] - best) / best
+
+# The speed of the machine drifts over seconds (frequency scaling, other
+# tenants), so rounds interleave the benchmarks rather than running
+# each of them several times in a row, and a benchmark only fails
+# beyond its noise.  With enough benchmarks, their ratios to the
+# baseline are relative to the median one, which is that of the speed
+# of the machine unless most of them regressed.
+NOISE_FACTOR = 2
+MIN_BENCHMARKS_FOR_SPEED = 5
+
+
+#
+# Fixtures.
+#
+
+WORKDIR = tempfile.mkdtemp(prefix="microbench.")
+logger = logging.getLogger('microbench')
+logger.addHandler(logging.NullHandler())
+logger.setLevel(logging.WARNING)
+logger.propagate = False
+apps = {push2mob.DEFAULT_APP: AttributeHolder(name=push2mob.DEFAULT_APP,
+    feedback_dbinfo=AttributeHolder(db=os.path.join(WORKDIR, "gcm.db"),
+        table='gcm_feedback', lock=threading.Lock()))}
+sendopts = AttributeHolder(app=apps[push2mob.DEFAULT_APP], at=None)
+apnspayload = json.dumps({'aps': {'alert': 'x' * 150, 'badge': 1,
+    'sound': 'default'}})
+gcmpayload = json.dumps({'msg': 'x' * 1000})
+
+def devtokens(n):
+    return [base64.standard_b64encode(os.urandom(32)) for i in range(n)]
+
+def regids(n):
+    return ["APA91b%x" % random.getrandbits(640) for i in range(n)]
+
+def dbinfo(name, **kwargs):
+    return AttributeHolder(db=os.path.join(WORKDIR, "%s.db" % name),
+        table=name, **kwargs)
+
+def apnsnotifications(n):
+    curtime = push2mob.now()
+    return [(i, curtime, int(curtime) + 3600, devtok, apnspayload,
+        push2mob.LANE_NORMAL, push2mob.DEFAULT_TENANT)
+        for i, devtok in enumerate(devtokens(n))]
+
+def gcmnotifications(n, nids):
+    curtime = push2mob.now()
+    payload = json.loads(gcmpayload)
+    return [GCMNotification(i, curtime, 'bench', curtime + 3600, False,
+        regids(nids), payload, push2mob.DEFAULT_APP, push2mob.LANE_NORMAL,
+        push2mob.DEFAULT_TENANT, len(json.dumps(payload)))
+        for i in range(n)]
+
+def gcmresponse(ids, errors):
+    results = []
+    for i in ids:
+        r = random.random()
+        if r < errors:
+            results.append({'error': 'NotRegistered'})
+        elif r < 2 * errors:
+            results.append({'error': 'Unavailable'})
+        elif r < 3 * errors:
+            results.append({'message_id': '0:%d' % random.getrandbits(48),
+                'registration_id': regids(1)[0]})
+        else:
+            results.append({'message_id': '0:%d' % random.getrandbits(48)})
+    return json.dumps({'multicast_id': random.getrandbits(63),
+        'success': 0, 'failure': 1, 'canonical_ids': 0,
+        'results': results})
+
+class NullSocket:
+    def send(self, msg):
+        pass
+
+
+#
+# Benchmarks, per item.
+#
+
+@benchmark("listener.parse_send_args.apns.100")
+def _():
+    msg = "send +3600 100 %s %s" % (' '.join(devtokens(100)), apnspayload)
+    l = APNSListener(0, logger, NullSocket(), apps)
+    return (lambda: Listener._parse_send_args(l, 1, msg), 100)
+
+@benchmark("listener.parse_send.apns.1")
+def _():
+    msg = "send +3600 1 %s %s" % (devtokens(1)[0], apnspayload)
+    l = APNSListener(0, logger, NullSocket(), apps)
+    return (lambda: l._parse_send(sendopts, msg), 1)
+
+@benchmark("listener.parse_send.apns.100")
+def _():
+    msg = "send +3600 100 %s %s" % (' '.join(devtokens(100)), apnspayload)
+    l = APNSListener(0, logger, NullSocket(), apps)
+    return (lambda: l._parse_send(sendopts, msg), 100)
+
+@benchmark("listener.parse_devtoks.base64.100")
+def _():
+    toks = devtokens(100)
+    l = APNSListener(0, logger, NullSocket(), apps)
+    return (lambda: l._parse_devtoks(toks), 100)
+
+@benchmark("listener.parse_devtoks.hex.100")
+def _():
+    toks = [os.urandom(32).encode('hex') for i in range(100)]
+    l = APNSListener(0, logger, NullSocket(), apps)
+    return (lambda: l._parse_devtoks(toks), 100)
+
+@benchmark("listener.parse_send.gcm.1000")
+def _():
+    msg = "send bench +3600 nodelayidle 1000 %s %s" % \
+        (' '.join(regids(1000)), gcmpayload)
+    l = GCMListener(0, logger, NullSocket(), None, apps)
+    l.idschanges = {push2mob.DEFAULT_APP:
+        GCMFeedbackDatabase(apps[push2mob.DEFAULT_APP].feedback_dbinfo)}
+    return (lambda: l._parse_send(sendopts, msg), 1000)
+
+@benchmark("apns.frame.100")
+def _():
+    notifications = [(uid, expiry, base64.standard_b64decode(devtok),
+        payload) for uid, creation, expiry, devtok, payload, lane, tenant
+        in apnsnotifications(100)]
+    def run():
+        for uid, expiry, bintok, payload in notifications:
+            APNSAgent._frame(uid, expiry, bintok, payload)
+    return (run, 100)
+
+def gcmagent():
+    return GCMAgent(0, logger, None, "https://localhost/gcm/send", "", 0, 0,
+        False, GCMExponentialBackoffDatabase(5), None, apps, None)
+
+@benchmark("gcm.request.1000")
+def _():
+    agent = gcmagent()
+    n = gcmnotifications(1, 1000)[0]
+    def run():
+        req = agent._request(n.devtoks, n.collapsekey, n.payload,
+            n.delayidle, 3600)
+        json.dumps(req, separators=(',',':'))
+    return (run, 1000)
+
+@benchmark("gcm.response.1000")
+def _():
+    agent = gcmagent()
+    feedbackdb = GCMFeedbackDatabase(
+        apps[push2mob.DEFAULT_APP].feedback_dbinfo)
+    ids = regids(1000)
+    jsonresp = gcmresponse(ids, 0.01)
+    labels = (('app', push2mob.DEFAULT_APP),)
+    def run():
+        resp = json.loads(jsonresp)
+        agent._handleresults(0, ids, resp['results'], jsonresp, feedbackdb,
+            labels)
+    return (run, 1000)
+
+@benchmark("http.receiver.1000")
+def _():
+    body = gcmresponse(regids(1000), 0.01)
+    lines = ["HTTP/1.1 200 OK\r\n",
+        "Content-Type: application/json; charset=UTF-8\r\n",
+        "Date: Mon, 19 Oct 2026 10:00:00 GMT\r\n",
+        "Expires: Mon, 19 Oct 2026 10:00:00 GMT\r\n",
+        "Cache-Control: private, max-age=0\r\n",
+        "X-Content-Type-Options: nosniff\r\n",
+        "X-Frame-Options: SAMEORIGIN\r\n",
+        "X-XSS-Protection: 1; mode=block\r\n",
+        "Server: GSE\r\n",
+        "Content-Length: %d\r\n" % len(body),
+        "\r\n",
+        body]
+    def run():
+        r = HTTPResponseReceiver()
+        for line in lines:
+            r.write(line)
+    return (run, 1000)
+
+@benchmark("timelyq.putget.1000")
+def _():
+    q = CheckpointableTimelySQueue(dbinfo("timelyq"))
+    q.start()
+    items = gcmnotifications(1000, 1)
+    def run():
+        curtime = push2mob.now()
+        for item in items:
+            q.put(curtime, item)
+        for item in items:
+            q.get()
+    return (run, 1000)
+
+@benchmark("checkpoint.apns.10000")
+def _():
+    q = CheckpointableQueue(dbinfo("apnsq"))
+    for n in apnsnotifications(10000):
+        q.put(n)
+    return (q.checkpoint, 10000)
+
+@benchmark("restore.apns.10000")
+def _():
+    info = dbinfo("apnsq")
+    q = CheckpointableQueue(info)
+    q.restore()
+    if q.qsize() == 0:
+        for n in apnsnotifications(10000):
+            q.put(n)
+        q.checkpoint()
+    return (lambda: CheckpointableQueue(info).restore(), 10000)
+
+@benchmark("checkpoint.gcm.100x100")
+def _():
+    q = CheckpointableTimelySQueue(dbinfo("gcmq",
+        upgrade=GCMNotification.upgrade))
+    curtime = push2mob.now()
+    for n in gcmnotifications(100, 100):
+        q.put(curtime + 3600, n)
+    return (q.checkpoint, 100)
+
+@benchmark("restore.gcm.100x100")
+def _():
+    info = dbinfo("gcmq", upgrade=GCMNotification.upgrade)
+    q = CheckpointableTimelySQueue(info)
+    q.restore()
+    if q.qsize() == 0:
+        curtime = push2mob.now()
+        for n in gcmnotifications(100, 100):
+            q.put(curtime + 3600, n)
+        q.checkpoint()
+    return (lambda: CheckpointableTimelySQueue(info).restore(), 100)
+
+
+if __name__ == "__main__":
+    baselinefile = os.path.join(TOPDIR, "microbench.json")
+    update = False
+    threshold = 1.5
+    pattern = None
+    runs = 7
+    output = None
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "b:ut:k:r:o:h")
+        for o, a in opts:
+            if o == "-b":
+                baselinefile = a
+            elif o == "-u":
+                update = True
+            elif o == "-t":
+                threshold = float(a)
+            elif o == "-k":
+                pattern = re.compile(a)
+            elif o == "-r":
+                runs = int(a)
+            elif o == "-o":
+                output = a
+            elif o == "-h":
+                usage()
+                sys.exit(0)
+    except (getopt.GetoptError, ValueError, re.error) as e:
+        print >>sys.stderr, e
+        sys.exit(1)
+
+    baseline = {}
+    if os.path.exists(baselinefile):
+        baseline = json.load(open(baselinefile))
+    for name, base in baseline.items():
+        # Baselines of older versions have no noise.
+        if not isinstance(base, dict):
+            baseline[name] = {'us': base, 'noise': 0}
+
+    # Agents and queues use the main logger.
+    push2mob.main_logger = logger
+    random.seed(0)
+    results = {}
+    regressions = []
+    try:
+        benchmarks = []
+        for name, setup in BENCHMARKS:
+            if pattern is None or pattern.search(name) is not None:
+                func, nitems = setup()
+                benchmarks.append((name, func, nitems))
+        times = dict((name, []) for name, func, nitems in benchmarks)
+        for r in range(runs):
+            for name, func, nitems in benchmarks:
+                times[name].append(measure(func, nitems))
+
+        stats = {}
+        for name, func, nitems in benchmarks:
+            best, noise = summarize(times[name])
+            results[name] = {'us': round(best, 3), 'noise': round(noise, 3)}
+            if name in baseline:
+                stats[name] = (best / baseline[name]['us'],
+                    max(noise, baseline[name]['noise']))
+        speed = 1
+        if len(stats) >= MIN_BENCHMARKS_FOR_SPEED:
+            ratios = sorted(ratio for ratio, noise in stats.itervalues())
+            speed = ratios[len(ratios) / 2]
+
+        print "%-36s %12s %12s %7s %7s" % ("benchmark", "us/item",
+            "baseline", "ratio", "limit")
+        for name, func, nitems in benchmarks:
+            if name not in stats:
+                print "%-36s %12.3f %12s %7s %7s" % (name,
+                    results[name]['us'], "-", "-", "-")
+                continue
+            ratio, noise = stats[name]
+            ratio /= speed
+            limit = max(threshold, 1 + NOISE_FACTOR * noise)
+            failed = ratio > limit
+            if failed:
+                regressions.append(name)
+            print "%-36s %12.3f %12.3f %7.2f %7.2f%s" % (name,
+                results[name]['us'], baseline[name]['us'], ratio, limit,
+                " REGRESSION" if failed else "")
+        if speed != 1:
+            print "Ratios are relative to the median one, %.2f" % speed
+    finally:
+        # Stop the queue threads.
+        push2mob.ExitHelper().signalexit()
+        push2mob.ExitHelper().waitexit()
+        shutil.rmtree(WORKDIR)
+
+    if output is not None:
+        open(output, "w").write(json.dumps({'threshold': threshold,
+            'speed': speed, 'baseline': baseline, 'results': results,
+            'regressions': regressions}, sort_keys=True, indent=2) + '\n')
+    if update:
+        baseline.update(results)
+        open(baselinefile, "w").write(json.dumps(baseline, sort_keys=True,
+            indent=2) + '\n')
+        print "Baseline written to %s" % baselinefile
+    elif len(regressions) > 0:
+        print "%d regression(s) beyond their limit" % len(regressions)
+        sys.exit(1)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+#
+# Reads the delivery journal of push2mob (see journal_dir in
+# push2mob.conf) and tells what happened to a notification id or to a
+# device token or registration id.  Only the blocks whose sparse index
+# entry may contain them are read, plus the records of the segment
+# being written which are not indexed yet.
+#
+
+import base64
+import getopt
+import mmap
+import os
+import sys
+import time
+
+from push2mob import Journal, OUTCOME_NAMES
+
+def usage():
+    print """Usage: p2mjournal.py [options] -d <journal_dir> <-u uid | -t token>
+Options:
+  -d    Journal directory (journal_dir in push2mob.conf)
+  -u    Notification id, as returned by the send command
+  -t    Device token (base64 or hex) or GCM registration id
+  -s    Only show records of this service, "apns" or "gcm"
+  -h    Show this help message"""
+
+def fmttime(t):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t)) + \
+        (".%03d" % (t * 1000 % 1000))
+
+def candidates(idxpath, uid, tokhash):
+    """
+    Returns the (first record, count) of the blocks of a segment which
+    may contain the uid or the token hash, and the number of records
+    indexed.
+    """
+    blocks = []
+    indexed = 0
+    entrysize = Journal._INDEX.size + Journal._BLOOMBYTES
+    if not os.path.exists(idxpath):
+        return blocks, indexed
+    data = open(idxpath, "rb").read()
+    bits = Journal.bloombits(tokhash) if tokhash is not None else None
+    for off in range(0, len(data) - entrysize + 1, entrysize):
+        first, count, minuid, maxuid, mintime, maxtime = \
+            Journal._INDEX.unpack_from(data, off)
+        indexed = max(indexed, first + count)
+        if uid is not None and not minuid <= uid <= maxuid:
+            continue
+        if bits is not None:
+            bloom = data[off + Journal._INDEX.size:off + entrysize]
+            if not all(ord(bloom[byte]) & mask for byte, mask in bits):
+                continue
+        blocks.append((first, count))
+    return blocks, indexed
+
+def search(directory, uid, tokhash, service):
+    """
+    Yields the (segment, record) matching, oldest first.
+    """
+    rsize = Journal._RECORD.size
+    for segment in Journal.segments(directory):
+        path = Journal.path(directory, segment)
+        size = os.path.getsize(path)
+        if size < rsize:
+            continue
+        blocks, indexed = candidates(path + ".idx", uid, tokhash)
+        f = open(path, "rb")
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        nrecords = size / rsize
+        # The tail is not indexed yet, or was not when the daemon died.
+        if indexed < nrecords:
+            blocks.append((indexed, nrecords - indexed))
+        for first, count in blocks:
+            for i in xrange(first, min(first + count, nrecords)):
+                r = Journal._RECORD.unpack_from(mm, i * rsize)
+                if r[5] == 0:
+                    # Preallocated space.
+                    break
+                if (uid is None or r[0] == uid) and \
+                  (tokhash is None or r[1] == tokhash) and \
+                  (service is None or r[5] == service):
+                    yield segment, r
+        mm.close()
+        f.close()
+
+if __name__ == "__main__":
+    directory = None
+    uid = None
+    token = None
+    service = None
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "d:u:t:s:h")
+    except getopt.GetoptError as e:
+        print >>sys.stderr, e
+        sys.exit(1)
+    try:
+        for o, a in opts:
+            if o == "-d":
+                directory = a
+            elif o == "-u":
+                uid = int(a)
+            elif o == "-t":
+                token = a
+            elif o == "-s":
+                if a not in Journal.SERVICES:
+                    raise ValueError("Unknown service: %s" % a)
+                service = Journal.SERVICES[a]
+            elif o == "-h":
+                usage()
+                sys.exit(0)
+    except ValueError as e:
+        print >>sys.stderr, e
+        sys.exit(1)
+    if directory is None or (uid is None and token is None):
+        usage()
+        sys.exit(1)
+
+    tokhash = None
+    if token is not None:
+        # APNS device tokens are journaled in base64.
+        if len(token) == 64:
+            try:
+                token = base64.standard_b64encode(token.decode('hex'))
+            except TypeError:
+                pass
+        tokhash = Journal.tokenhash(token)
+    services = dict((v, k) for k, v in Journal.SERVICES.iteritems())
+
+    found = 0
+    for segment, r in search(directory, uid, tokhash, service):
+        ruid, rhash, creation, completion, outcome, rservice = r
+        print "%s #%d token=%016x enqueued=%s sent=%s lag=%.3fs %s " \
+            "segment=%d" % (services.get(rservice, rservice), ruid, rhash,
+            fmttime(creation), fmttime(completion), completion - creation,
+            OUTCOME_NAMES.get(outcome, outcome), segment)
+        found += 1
+    sys.exit(0 if found > 0 else 2)
@@ -0,0 +1,522 @@
+#!/usr/bin/env python
+# vim: ts=4:sw=4:et
+#
+# Copyright (C) 2012 Jeremie Le Hen <jeremie@le-hen.org>
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+#
+# Router spreading the notifications of push2mob clients over several
+# push2mob nodes: the device tokens of each "send" command are split by
+# consistent hashing, so that each node owns a shard of the devices
+# along with their queue and feedback state.  It speaks the same
+# protocol as push2mob with a few additional commands to manage nodes.
+#
+
+import ConfigParser
+import bisect
+import getopt
+import hashlib
+import json
+import logging
+import os
+import signal
+import sys
+import zmq
+
+from push2mob import APNSListener, AttributeHolder, DEFAULT_APP, \
+    ExitHelper, GCMListener, Listener, Tenant, confget, createLogger, now, \
+    parse_loglevel
+
+CONFIGFILE = 'p2mrouter.conf'
+
+def usage():
+    print """Usage: p2mrouter.py [options]
+Options:
+  -c    Change configuration file (defaults to "./%s")
+  -h    Show this help message""" % CONFIGFILE
+
+
+class HashRing:
+    """
+    Consistent hash ring mapping keys (device tokens) to nodes.  Each
+    node is placed at several points of the ring so that keys are
+    evenly spread and only about 1/N of them move when a node joins or
+    leaves.
+    """
+
+    def __init__(self, replicas):
+        self.replicas = replicas
+        self.points = []
+        self.nodes = set()
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+    def add(self, node):
+        for i in range(self.replicas):
+            bisect.insort(self.points,
+                (HashRing._hash("%s#%d" % (node, i)), node))
+        self.nodes.add(node)
+
+    def remove(self, node):
+        self.points = [p for p in self.points if p[1] != node]
+        self.nodes.discard(node)
+
+    def lookup(self, key, skip=()):
+        """
+        Returns the node in charge of `key', ignoring those in `skip'
+        (the next one on the ring takes over).  Returns None if there
+        is no node left.
+        """
+        i = bisect.bisect(self.points, (HashRing._hash(key),))
+        for j in range(len(self.points)):
+            h, node = self.points[(i + j) % len(self.points)]
+            if node not in skip:
+                return node
+        return None
+
+
+class NodeClient:
+    """
+    ZMQ REQ socket to a push2mob node.  A REQ socket cannot be used
+    anymore if the reply never comes, so it is recreated in this case.
+    """
+
+    def __init__(self, zmqctx, endpoint):
+        self.zmqctx = zmqctx
+        self.endpoint = endpoint
+        self._connect()
+
+    def _connect(self):
+        self.sock = self.zmqctx.socket(zmq.REQ)
+        self.sock.setsockopt(zmq.LINGER, 0)
+        self.sock.connect(self.endpoint)
+
+    def send(self, msg):
+        self.sock.send(msg)
+
+    def recv(self, deadline):
+        """
+        Returns the reply, or None if it did not come before `deadline'.
+        """
+        timeout = max(deadline - now(), 0)
+        if self.sock.poll(int(timeout * 1000)):
+            return self.sock.recv()
+        self.close()
+        self._connect()
+        return None
+
+    def close(self):
+        self.sock.close()
+
+
+class Router:
+    """
+    Mixin turning a Listener into a router: commands are parsed and
+    checked as usual, but they are carried out by the push2mob nodes.
+    Device tokens of "send" commands are split between nodes with a
+    HashRing; when a node does not answer, its tokens go to the next
+    node on the ring.  "feedback" commands are sent to all nodes.
+    Besides, nodes can be managed with the following commands:
+    - "nodes" lists the nodes of the ring;
+    - "join <endpoint>" adds a node to the ring;
+    - "leave <endpoint>" removes a node from the ring.  The feedback it
+      has is retrieved at once and it is still asked for feedback until
+      it stops answering, as it delivers the notifications it has
+      already been given;
+    - "route <devtok>" returns the node in charge of a device token.
+    Tenants are declared and their limits enforced by the nodes, as well
+    as admission control: "BUSY" is replied if all the nodes of an APNS
+    send command are, otherwise device tokens refused by a busy node get
+    "~<retryafter>" as their id.  GCM ids are per notification, so
+    "BUSY" is replied if any node of a GCM send command is.
+    """
+
+    # Whether nodes return one id per device token (APNS) or per
+    # notification (GCM).
+    _IDS_PER_TOKEN = True
+
+    def _init_router(self, nodes, timeout, replicas):
+        self.zmqctx = zmq.Context()
+        self.timeout = timeout
+        self.ring = HashRing(replicas)
+        self.clients = {}
+        # Nodes which left the ring but may still have feedback.
+        self.leaving = set()
+        # Feedback retrieved from nodes when they left, by application.
+        self.handedover = {}
+        for node in nodes:
+            self.ring.add(node)
+
+    def _client(self, node):
+        client = self.clients.get(node)
+        if client is None:
+            client = NodeClient(self.zmqctx, node)
+            self.clients[node] = client
+        return client
+
+    def _forget(self, node):
+        self.leaving.discard(node)
+        client = self.clients.pop(node, None)
+        if client is not None:
+            client.close()
+
+    def _request(self, requests):
+        """
+        Sends commands to several nodes at once and waits for their
+        replies.  `requests' maps nodes to their command.  Returns a
+        dict mapping nodes to their reply, None if it did not come in
+        time.
+        """
+        deadline = now() + self.timeout
+        for node, msg in requests.iteritems():
+            self._client(node).send(msg)
+        replies = {}
+        for node in requests:
+            replies[node] = self._client(node).recv(deadline)
+        return replies
+
+    def _format_options(self, opts):
+        options = []
+        for name in sorted(self._OPTIONS):
+            value = getattr(opts, name)
+            if name in ('app', 'tenant'):
+                value = value.name
+            elif name == 'at' and value is not None:
+                value = "%d" % value
+            if value != self._OPTIONS[name]:
+                options.append("%s=%s " % (name, value))
+        return ''.join(options)
+
+    def _format_send(self, arglist, devtoks, payload):
+        """
+        Builds the send command for a node.  You must overload this
+        method.
+        """
+        pass
+
+    def _tenant(self, name):
+        return Tenant(name)
+
+    def _admit(self, opts, ndevices):
+        return None
+
+    def _busy(self, opts):
+        return None
+
+    def _canonical_devtok(self, devtok):
+        """
+        Returns the device token as used in the ring, or None if an
+        error message has already been issued.
+        """
+        return devtok
+
+    def _perform_send(self, opts, arglist, devtoks, payload):
+        options = self._format_options(opts)
+        ids = [None] * len(devtoks)
+        errors = []
+        # Retry-after of the nodes which are busy.
+        busy = []
+        failed = set()
+        pending = range(len(devtoks))
+        while len(pending) > 0:
+            # Indexes of the device tokens each node is in charge of.
+            shards = {}
+            for i in pending:
+                node = self.ring.lookup(devtoks[i], failed)
+                if node is None:
+                    self._send_error("No node available for %d device " \
+                        "tokens" % len(pending))
+                    return None
+                shards.setdefault(node, []).append(i)
+
+            requests = {}
+            for node, shard in shards.iteritems():
+                requests[node] = options + self._format_send(arglist,
+                    [devtoks[i] for i in shard], payload)
+            replies = self._request(requests)
+
+            pending = []
+            for node, reply in replies.iteritems():
+                if reply is None:
+                    self.l.warning("Node %s did not answer, giving its " \
+                        "%d device tokens to the next one" %
+                        (node, len(shards[node])))
+                    failed.add(node)
+                    pending.extend(shards[node])
+                    continue
+                if reply.startswith("BUSY"):
+                    retry = int(reply.split()[1])
+                    busy.append((node, retry))
+                    # Refused device tokens get "~<retryafter>" as their
+                    # id if others are accepted.
+                    if self._IDS_PER_TOKEN:
+                        for i in shards[node]:
+                            ids[i] = "~%d" % retry
+                    continue
+                if not reply.startswith("OK"):
+                    errors.append("%s: %s" % (node, reply[6:]))
+                    continue
+                nodeids = reply.split()[1:]
+                if self._IDS_PER_TOKEN:
+                    for i, uid in zip(shards[node], nodeids):
+                        ids[i] = uid
+                else:
+                    ids[shards[node][0]] = ' '.join(nodeids)
+
+        ids = [uid for uid in ids if uid is not None]
+        # Notifications are either all accepted or all refused by a
+        # node, but other nodes may have accepted theirs.
+        if len(errors) > 0 and (self._IDS_PER_TOKEN or len(ids) == 0):
+            self._send_error("Node %s" % errors[0])
+            return None
+        # Only busy nodes, or ids which cannot tell the refused device
+        # tokens: the whole command is to be sent again.
+        if len(busy) > 0 and (not self._IDS_PER_TOKEN or
+          all(uid.startswith("~") for uid in ids)):
+            if len(ids) > 0:
+                self.l.warning("Node %s is busy, refusing the send " \
+                    "command although other nodes accepted it" % busy[0][0])
+            self._send_busy(max(retry for node, retry in busy))
+            return None
+        for error in errors:
+            self.l.warning("Node %s" % error)
+        for node, retry in busy:
+            self.l.warning("Node %s is busy, its device tokens were " \
+                "refused" % node)
+        return ' '.join(ids)
+
+    def _perform_feedback(self, opts):
+        options = self._format_options(opts)
+        nodes = self.ring.nodes | self.leaving
+        replies = self._request(dict((node, options + "feedback")
+            for node in nodes))
+
+        feedbacks = self.handedover.pop(opts.app.name, [])
+        for node, reply in replies.iteritems():
+            if reply is None and node in self.leaving:
+                self.l.info("Node %s which left does not answer anymore, " \
+                    "forgetting it" % node)
+                self._forget(node)
+            elif reply is None:
+                self.l.warning("Node %s did not answer, its feedback " \
+                    "will be retrieved later" % node)
+            elif not reply.startswith("OK"):
+                self.l.warning("Node %s: %s" % (node, reply[6:]))
+            else:
+                feedbacks.extend(reply.split()[1:])
+        return ' '.join(feedbacks)
+
+    def _perform_other(self, opts, msg):
+        args = msg.split()
+        cmd = args[0].lower()
+        if cmd == "nodes" and len(args) == 1:
+            return ' '.join(sorted(self.ring.nodes))
+        if len(args) != 2:
+            return False
+
+        if cmd == "join":
+            node = args[1]
+            if node in self.ring.nodes:
+                self._send_error("Node %s is already in the ring" % node)
+                return None
+            self.leaving.discard(node)
+            self.ring.add(node)
+            self.l.info("Node %s joined, %d nodes in the ring" %
+                (node, len(self.ring.nodes)))
+            return ''
+
+        if cmd == "leave":
+            node = args[1]
+            if node not in self.ring.nodes:
+                self._send_error("Node %s is not in the ring" % node)
+                return None
+            if len(self.ring.nodes) == 1:
+                self._send_error("Node %s is the last one" % node)
+                return None
+            self.ring.remove(node)
+            self.leaving.add(node)
+            self.l.info("Node %s left, %d nodes in the ring" %
+                (node, len(self.ring.nodes)))
+            for name in self.apps:
+                options = ''
+                if name != DEFAULT_APP:
+                    options = "app=%s " % name
+                reply = self._request({node: options + "feedback"})[node]
+                if reply is None or not reply.startswith("OK"):
+                    self.l.warning("Cannot retrieve feedback of " \
+                        "application %s from node %s" % (name, node))
+                    continue
+                self.handedover.setdefault(name, []).extend(
+                    reply.split()[1:])
+            return ''
+
+        if cmd == "route":
+            devtok = self._canonical_devtok(args[1])
+            if devtok is None:
+                return None
+            return self.ring.lookup(devtok)
+
+        return False
+
+
+class APNSRouterListener(Router, APNSListener):
+    """
+    Router for the APNS service.
+    """
+
+    def __init__(self, idx, logger, zmqsock, apps, nodes, timeout,
+      replicas):
+        APNSListener.__init__(self, idx, logger, zmqsock, apps)
+        self._init_router(nodes, timeout, replicas)
+
+    def _format_send(self, arglist, devtoks, payload):
+        return "send %d %d %s %s" % (arglist[0], len(devtoks),
+            ' '.join(devtoks), payload)
+
+    def _canonical_devtok(self, devtok):
+        devtoks = self._parse_devtoks([devtok])
+        if devtoks is None:
+            return None
+        return devtoks[0]
+
+
+class GCMRouterListener(Router, GCMListener):
+    """
+    Router for the GCM service.  Registration IDs are filtered by the
+    nodes, which own the feedback.
+    """
+
+    _IDS_PER_TOKEN = False
+
+    def __init__(self, idx, logger, zmqsock, apps, nodes, timeout,
+      replicas):
+        GCMListener.__init__(self, idx, logger, zmqsock, None, apps)
+        self._init_router(nodes, timeout, replicas)
+
+    def _filter_ids(self, opts, ids):
+        return ids
+
+    def _format_send(self, arglist, devtoks, payload):
+        collapsekey, expiry, delayidle = arglist
+        return "send %s %d %s %d %s %s" % (collapsekey, expiry,
+            "delayidle" if delayidle else "nodelayidle", len(devtoks),
+            ' '.join(devtoks), json.dumps(payload))
+
+    def run(self):
+        Listener.run(self)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG,
+        format='%(asctime)s MAIN/%(threadName)s: %(message)s',
+        datefmt='%Y/%m/%d %H:%M:%S')
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "c:h")
+    except getopt.GetoptError as e:
+        logging.error("%s" % e)
+        sys.exit(1)
+
+    for o, a in opts:
+        if o == "-c":
+            CONFIGFILE = a
+        elif o == "-h":
+            usage()
+            sys.exit(0)
+
+    cp = ConfigParser.SafeConfigParser()
+    l = cp.read([CONFIGFILE])
+    if len(l) == 0:
+        logging.error("Cannot open '%s'" % CONFIGFILE)
+        sys.exit(1)
+
+    try:
+        logstdout = cp.getboolean('router', 'log_stdout')
+        logfile = cp.get('router', 'log_file')
+        try:
+            loglevel = parse_loglevel(cp.get('router', 'log_level'))
+        except Exception as e:
+            raise Exception("router.log_level: %s" % e)
+        services = {}
+        for service in ('apns', 'gcm'):
+            services[service] = AttributeHolder(
+                zmq_bind=cp.get('router', '%s_zmq_bind' % service),
+                nodes=[n.strip() for n in
+                    cp.get('router', '%s_nodes' % service).split(',')
+                    if len(n.strip()) > 0])
+        apps = {DEFAULT_APP: AttributeHolder(name=DEFAULT_APP)}
+        for name in confget(cp, 'get', 'router', 'apps', '').split():
+            apps[name] = AttributeHolder(name=name)
+        node_timeout = cp.getfloat('router', 'node_timeout')
+        ring_replicas = cp.getint('router', 'ring_replicas')
+    except BaseException as e:
+        logging.error("%s: %s" % (CONFIGFILE, e))
+        sys.exit(1)
+
+    formatter = logging.Formatter('%(asctime)s %(name)s/%(threadName)s: ' \
+        '%(message)s', '%Y/%m/%d %H:%M:%S')
+    logger = createLogger('p2mrouter', logfile, loglevel, False, formatter, 0)
+    logger.propagate = False
+    if logstdout:
+        handler = logging.StreamHandler()
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+
+    try:
+        logger.warning("Starting with pid %u..." % os.getpid())
+        zmqctx = zmq.Context()
+        threadlist = []
+        for service, cls in (('apns', APNSRouterListener),
+          ('gcm', GCMRouterListener)):
+            conf = services[service]
+            logger.info("ZMQ REP socket for %s service bound on tcp://%s, " \
+                "nodes: %s" % (service.upper(), conf.zmq_bind,
+                ' '.join(conf.nodes)))
+            try:
+                sock = zmqctx.socket(zmq.REP)
+                sock.bind("tcp://%s" % conf.zmq_bind)
+            except zmq.ZMQError as e:
+                logger.error("Cannot create ZMQ REP socket for %s on " \
+                    "tcp://%s: %s" % (service.upper(), conf.zmq_bind, e))
+                sys.exit(3)
+            t = cls(0, logging.getLogger('p2mrouter.%s' % service.upper()),
+                sock, apps, conf.nodes, node_timeout, ring_replicas)
+            threadlist.append(t)
+            t.start()
+
+        exithelper = ExitHelper()
+        def exit_handler(signum, frame):
+            logger.info("Exit requested, waiting %d threads " \
+              "acknowledgement...", exithelper.pending())
+            exithelper.signalexit()
+        signal.signal(signal.SIGTERM, exit_handler)
+        signal.signal(signal.SIGINT, exit_handler)
+        signal.signal(signal.SIGQUIT, exit_handler)
+
+        exithelper.waitexit()
+        sys.exit(0)
+
+    except SystemExit:
+        pass
+    except BaseException as e:
+        logger.exception("Uncaugth exception: %s" % e)
+        sys.exit(99)
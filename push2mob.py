@@ -21,16 +21,23 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import BaseHTTPServer
 import ConfigParser
 import Queue
+import array
 import base64
 import collections
 import datetime
+import email.utils
+import errno
 import getopt
+import hashlib
 import heapq
+import itertools
 import json
 import logging
 import math
+import mmap
 import os
 import pycurl
 import random
@@ -45,11 +52,17 @@ import sys
 import threading
 import time
 import types
+import weakref
 import zmq
 
 CHECKPOINT_TIME = 10
 DUMP_QUERIES = False
+# Level of the line logged for each notification sent, lowered to debug
+# when summaries are logged instead (see LogSummary).
+NOTIFICATION_LOGLEVEL = logging.INFO
 CONFIGFILE = 'push2mob.conf'
+# Name of the application configured in the [apns] and [gcm] sections.
+DEFAULT_APP = 'default'
 
 def usage():
     print """Usage: push2mob.py [options]
@@ -87,6 +100,21 @@ def jsonload(payload):
         return None
     return obj
 
+def parse_retryafter(value):
+    """
+    Returns the number of seconds to wait given by an HTTP Retry-After
+    header, which is either a number of seconds or an HTTP date.
+    Raises ValueError if it is neither.
+    """
+    try:
+        return max(int(value), 0)
+    except ValueError:
+        pass
+    t = email.utils.parsedate_tz(value)
+    if t is None:
+        raise ValueError("Invalid Retry-After value: %s" % value)
+    return max(email.utils.mktime_tz(t) - now(), 0)
+
 
 class Locker:
     def __init__(self, lock):
@@ -113,6 +141,16 @@ def singleton(cls):
     return getinstance
 
 
+def appthreadname(app, name):
+    """
+    Prefixes a thread name with the application name, unless this is
+    the default application.
+    """
+    if app.name == DEFAULT_APP:
+        return name
+    return "%s:%s" % (app.name, name)
+
+
 class Exiting(Exception):
     pass
 
@@ -121,12 +159,19 @@ class ExitHelper:
     """
     This object is used to notify all threads that we are planning to exit.
     Threads used it to notify they are ready.
+    Threads waiting for work do so without timeout: they are woken up on
+    exit through the conditions registered with onexit() or the pipe
+    returned by fileno().
     """
 
     def __init__(self):
         self.val = 0
         self.exiting = False
         self.cond = threading.Condition()
+        self.conds = weakref.WeakSet()
+        self.pid = None
+        self.pipe = None
+        self.retired = set()
 
     def register(self):
         if self.exiting:
@@ -138,19 +183,103 @@ class ExitHelper:
         return True
 
     def checkexit(self):
-        if not self.exiting:
+        if not self.stopping():
             return
         with Locker(self.cond):
             self.val -= 1
+            self.retired.discard(threading.current_thread())
             if self.val == 0:
                 self.cond.notifyAll()
         raise Exiting()
 
+    def stopping(self):
+        """
+        Returns whether the current thread must exit, either because
+        the daemon exits or because it has been retired.
+        """
+        return self.exiting or (len(self.retired) > 0 and
+            threading.current_thread() in self.retired)
+
+    def retire(self, thread):
+        """
+        Asks a single registered thread to exit, checkexit() raising
+        Exiting in it from now on.  It is woken up if it waits on a
+        condition registered with onexit().
+        """
+        with Locker(self.cond):
+            self.retired.add(thread)
+        self._notifyall()
+
     def pending(self):
         return self.val
 
     def signalexit(self):
         self.exiting = True
+        # This may be called from a signal handler, while the thread
+        # it interrupted holds one of the conditions.
+        t = threading.Thread(target=self._wakeup, name="ExitWakeup")
+        t.daemon = True
+        t.start()
+
+    def _wakeup(self):
+        os.write(self.fileno(True), "x")
+        self._notifyall()
+
+    def _notifyall(self):
+        with Locker(self.cond):
+            conds = list(self.conds)
+        for c in conds:
+            with Locker(c):
+                c.notifyAll()
+
+    def onexit(self, cond):
+        """
+        Registers a Condition notified on exit.  Threads waiting on it
+        must check stopping() with the condition held before waiting.
+        """
+        with Locker(self.cond):
+            self.conds.add(cond)
+
+    def fileno(self, writer=False):
+        """
+        Returns a file descriptor which becomes readable on exit, for
+        threads waiting in select() or a zmq.Poller.
+        """
+        with Locker(self.cond):
+            # Worker processes need their own pipe.
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.pipe = os.pipe()
+                if self.exiting:
+                    os.write(self.pipe[1], "x")
+            return self.pipe[1 if writer else 0]
+
+    def select(self, rlist, timeout=None):
+        """
+        Same as select.select() for reading, but also returns when exit
+        is signaled.  Returns the list of readable objects.
+        """
+        fd = self.fileno()
+        try:
+            r = select.select(rlist + [fd], [], [], timeout)[0]
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return []
+        return [o for o in r if o != fd]
+
+    def sleep(self, duration):
+        """
+        Sleeps for `duration' seconds unless exit is signaled meanwhile,
+        then calls checkexit().
+        """
+        deadline = now() + duration
+        while not self.stopping():
+            remaining = deadline - now()
+            if remaining <= 0:
+                break
+            self.select([], remaining)
+        self.checkexit()
 
     def waitexit(self):
         with Locker(self.cond):
@@ -158,27 +287,1128 @@ class ExitHelper:
                 self.cond.wait(1)
 
 
+# Outcome of notifications, as reported by the agents.
+OUTCOME_SENT = 0
+OUTCOME_FAILED = 1
+OUTCOME_DISCARDED = 2
+OUTCOME_NAMES = {
+    OUTCOME_SENT: 'sent',
+    OUTCOME_FAILED: 'failed',
+    OUTCOME_DISCARDED: 'discarded'
+}
+
+# Priority lanes of the push queues, highest first.  Notifications go
+# to the "normal" one unless the "priority" option of the send command
+# says otherwise.
+LANES = ('high', 'normal', 'bulk')
+LANE_HIGH = 'high'
+LANE_NORMAL = 'normal'
+
+# Tenant of the notifications sent without the "tenant" option.
+DEFAULT_TENANT = 'default'
+
+class Completions:
+    """
+    Each agent reports the outcome of every notification it has
+    handled to this object, which calls in turn the registered hooks
+    as hook(service, appname, uid, creation, outcome, devtoks, tenant),
+    devtoks being the device tokens or registration ids of the
+    notification and tenant the name of the tenant which sent it.
+    Hooks are called from the agent threads, so they must be cheap
+    and thread-safe.
+    """
+
+    def __init__(self):
+        self.hooks = []
+
+    def register(self, hook):
+        self.hooks.append(hook)
+
+    def __call__(self, service, appname, uid, creation, outcome, devtoks,
+      tenant):
+        for hook in self.hooks:
+            hook(service, appname, uid, creation, outcome, devtoks, tenant)
+
+
+class Histogram:
+    """
+    Histogram of durations with a bounded relative error, in the spirit
+    of HdrHistogram: each power of two (of microseconds) is split in
+    _SUBBUCKETS linear buckets, so recording a value only costs an
+    frexp() and a dictionary update whatever its magnitude.
+    This class is not thread-safe, Metrics takes care of locking.
+    """
+
+    _SUBBUCKETS = 16
+    _UNIT = 0.000001
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.sum = 0.0
+
+    @staticmethod
+    def _index(value):
+        m, e = math.frexp(max(value / Histogram._UNIT, 1))
+        return e * Histogram._SUBBUCKETS + \
+            int((m - 0.5) * 2 * Histogram._SUBBUCKETS)
+
+    @staticmethod
+    def _value(idx):
+        # Middle of the bucket.
+        e, sub = divmod(idx, Histogram._SUBBUCKETS)
+        m = 0.5 + (sub + 0.5) / (2 * Histogram._SUBBUCKETS)
+        return math.ldexp(m, e) * Histogram._UNIT
+
+    def record(self, value):
+        idx = Histogram._index(value)
+        self.counts[idx] = self.counts.get(idx, 0) + 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        return (dict(self.counts), self.count, self.sum)
+
+    def merge(self, snapshot):
+        counts, count, sum = snapshot
+        for idx, n in counts.iteritems():
+            self.counts[idx] = self.counts.get(idx, 0) + n
+        self.count += count
+        self.sum += sum
+
+    def quantile(self, q):
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for idx in sorted(self.counts):
+            seen += self.counts[idx]
+            if seen >= rank:
+                return Histogram._value(idx)
+        return Histogram._value(idx)
+
+
+@singleton
+class Metrics:
+    """
+    In-process metrics, identified by a name and a tuple of (label,
+    value) pairs: counters, histograms and gauges (functions called
+    when metrics are read).  Recording is cheap enough to be done for
+    each notification.
+    Worker processes send the snapshot of their own metrics to the
+    main process, which merges them when metrics are read.
+    """
+
+    _QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.remote = {}
+
+    def incr(self, name, labels=(), n=1):
+        key = (name, labels)
+        with Locker(self.mutex):
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def record(self, name, labels, value):
+        key = (name, labels)
+        with Locker(self.mutex):
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = Histogram()
+            h.record(value)
+
+    def gauge(self, name, labels, func):
+        self.gauges[(name, labels)] = func
+
+    def completed(self, service, appname, uid, creation, outcome, devtoks,
+      tenant):
+        """
+        Completions hook.
+        """
+        self.incr('push2mob_notifications_total', (('service', service),
+            ('app', appname), ('tenant', tenant),
+            ('outcome', OUTCOME_NAMES[outcome])))
+        if outcome == OUTCOME_SENT:
+            lag = now() - creation
+            self.record('push2mob_lag_seconds', (('service', service),), lag)
+            self.record('push2mob_tenant_lag_seconds', (('service', service),
+                ('tenant', tenant)), lag)
+
+    def snapshot(self):
+        """
+        Returns counters and histograms as plain Python objects.
+        """
+        with Locker(self.mutex):
+            return (dict(self.counters), dict((k, h.snapshot())
+                for k, h in self.histograms.iteritems()))
+
+    def merge(self, source, snapshot):
+        """
+        Records the latest snapshot of another process.
+        """
+        with Locker(self.mutex):
+            self.remote[source] = snapshot
+
+    def _families(self):
+        """
+        Returns a sorted list of (name, type, samples) tuples, samples
+        being a list of (name, labels, value) tuples.
+        """
+        with Locker(self.mutex):
+            counters = dict(self.counters)
+            histograms = {}
+            for k, h in self.histograms.iteritems():
+                histograms[k] = Histogram()
+                histograms[k].merge(h.snapshot())
+            remote = self.remote.values()
+        for rcounters, rhistograms in remote:
+            for k, v in rcounters.iteritems():
+                counters[k] = counters.get(k, 0) + v
+            for k, snapshot in rhistograms.iteritems():
+                histograms.setdefault(k, Histogram()).merge(snapshot)
+
+        families = {}
+        for (name, labels), v in counters.iteritems():
+            families.setdefault((name, 'counter'), []).append(
+                (name, labels, v))
+        for (name, labels), func in self.gauges.items():
+            families.setdefault((name, 'gauge'), []).append(
+                (name, labels, func()))
+        for (name, labels), h in histograms.iteritems():
+            samples = families.setdefault((name, 'summary'), [])
+            for q in self._QUANTILES:
+                samples.append((name, labels + (('quantile', str(q)),),
+                    h.quantile(q)))
+            samples.append((name + '_sum', labels, h.sum))
+            samples.append((name + '_count', labels, h.count))
+        return [(name, mtype, sorted(samples))
+            for (name, mtype), samples in sorted(families.iteritems())]
+
+    @staticmethod
+    def _format(name, labels, value):
+        if len(labels) > 0:
+            name = "%s{%s}" % (name,
+                ','.join('%s="%s"' % l for l in labels))
+        if type(value) is types.FloatType:
+            return (name, "%.6g" % value)
+        return (name, "%d" % value)
+
+    def stats(self):
+        """
+        Returns metrics as "name{labels}=value" items separated by
+        spaces.
+        """
+        items = []
+        for family, mtype, samples in self._families():
+            for sample in samples:
+                items.append("%s=%s" % self._format(*sample))
+        return ' '.join(items)
+
+    def prometheus(self):
+        """
+        Returns metrics in Prometheus text exposition format.
+        """
+        lines = []
+        for family, mtype, samples in self._families():
+            lines.append("# TYPE %s %s" % (family, mtype))
+            for sample in samples:
+                lines.append("%s %s" % self._format(*sample))
+        return '\n'.join(lines) + '\n'
+
+
+@singleton
+class Tracer:
+    """
+    Records when sampled notifications go through each stage of their
+    life (see README), as (service, uid, stage, timestamp) events in a
+    ring buffer which is dumped with the "trace" command.
+    Sampling only depends on the notification id, so all threads and
+    processes agree on it without sharing anything; when it is
+    disabled, checking it is all it costs.
+    """
+
+    def __init__(self):
+        self.threshold = 0
+        self.events = collections.deque(maxlen=1)
+
+    def configure(self, rate, size):
+        self.threshold = int(rate * 2**32)
+        self.events = collections.deque(maxlen=size)
+
+    def sampled(self, uid):
+        # Knuth's multiplicative hash spreads consecutive ids.
+        return self.threshold != 0 and \
+            (uid * 2654435761) & 0xFFFFFFFF < self.threshold
+
+    def mark(self, service, uid, stage, when=None):
+        if when is None:
+            when = now()
+        # deque.append() is atomic, no need to lock.
+        self.events.append((service, uid, stage, when))
+
+    def completed(self, service, appname, uid, creation, outcome, devtoks,
+      tenant):
+        """
+        Completions hook.
+        """
+        if self.sampled(uid):
+            self.mark(service, uid, OUTCOME_NAMES[outcome])
+
+    def drain(self):
+        """
+        Removes and returns all events, worker processes send them to
+        the main process.
+        """
+        events = []
+        while True:
+            try:
+                events.append(self.events.popleft())
+            except IndexError:
+                return events
+
+    def extend(self, events):
+        self.events.extend(events)
+
+    def dump(self, service):
+        """
+        Returns the traces of `service' as "uid@start:stage+offset,..."
+        items separated by spaces, oldest first.
+        """
+        while True:
+            try:
+                events = list(self.events)
+                break
+            except RuntimeError:
+                # Mutated while being copied.
+                continue
+        traces = {}
+        for svc, uid, stage, when in events:
+            if svc == service:
+                traces.setdefault(uid, []).append((when, stage))
+        items = []
+        for uid, stages in traces.iteritems():
+            stages.sort()
+            start = stages[0][0]
+            items.append((start, "%d@%.6f:%s" % (uid, start,
+                ','.join("%s+%.6f" % (stage, when - start)
+                for when, stage in stages))))
+        return ' '.join(item for start, item in sorted(items))
+
+
+class MetricsHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves metrics to Prometheus on /metrics.
+    """
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = Metrics().prometheus()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+class AsyncLogHandler(logging.Handler):
+    """
+    Queues records for a writer thread which formats them and writes
+    them by batches to the stream of `target', a StreamHandler or
+    FileHandler.  Logging then only costs an append to a deque in the
+    thread which logs.  When `maxqueue' records are waiting, further
+    ones are dropped and their number is logged afterwards.  Records
+    of a batch which cannot be written are counted as dropped too.
+    """
+
+    _INTERVAL = 0.2
+    _BATCH = 1000
+
+    def __init__(self, target, maxqueue):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.maxqueue = maxqueue
+        self.records = collections.deque()
+        self.dropped = 0
+        self.wakeup = threading.Event()
+        self.writelock = threading.Lock()
+        self.pid = None
+
+    def _start(self):
+        # The writer thread does not survive fork() (daemonization or
+        # worker processes): start another one, with fresh locks as the
+        # former one may have held them.  Queued records are the
+        # parent's.
+        self.pid = os.getpid()
+        self.records.clear()
+        self.writelock = threading.Lock()
+        self.target.createLock()
+        t = threading.Thread(target=self._run, name="LogWriter")
+        t.daemon = True
+        t.start()
+
+    def emit(self, record):
+        # Called with self.lock held.
+        if self.pid != os.getpid():
+            self._start()
+        if len(self.records) >= self.maxqueue:
+            self.dropped += 1
+            return
+        self.records.append(record)
+        if len(self.records) == self._BATCH:
+            self.wakeup.set()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self._INTERVAL)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        with Locker(self.writelock):
+            lines = []
+            record = None
+            while True:
+                try:
+                    record = self.records.popleft()
+                except IndexError:
+                    break
+                try:
+                    lines.append(self.target.format(record))
+                except Exception:
+                    self.handleError(record)
+            nrecords = len(lines)
+            if self.dropped != 0:
+                with Locker(self.lock):
+                    dropped, self.dropped = self.dropped, 0
+                Metrics().incr('push2mob_log_dropped_total', (), dropped)
+                lines.append(self.target.format(logging.makeLogRecord({
+                    'name': 'push2mob', 'levelno': logging.WARNING,
+                    'levelname': 'WARNING', 'threadName': 'LogWriter',
+                    'msg': "%d log records dropped" % dropped})))
+            if len(lines) == 0:
+                return
+            buf = '\n'.join(l.encode('utf-8') if type(l) is types.UnicodeType
+                else l for l in lines) + '\n'
+            with Locker(self.target.lock):
+                try:
+                    self.target.stream.write(buf)
+                    self.target.stream.flush()
+                except Exception:
+                    # The batch is lost, whatever part of it was written.
+                    Metrics().incr('push2mob_log_dropped_total', (),
+                        nrecords)
+                    if record is not None:
+                        self.handleError(record)
+
+    def close(self):
+        self.flush()
+        self.target.close()
+        logging.Handler.close(self)
+
+
+class LogSummary(threading.Thread):
+    """
+    Completions hook counting notifications, whose outcome is logged
+    for each application every `interval' seconds instead of a line
+    per notification.
+    """
+
+    def __init__(self, loggers, interval):
+        threading.Thread.__init__(self)
+        self.name = "LogSummary"
+        self.daemon = True
+        self.loggers = loggers
+        self.interval = interval
+        self.mutex = threading.Lock()
+        # (service, appname) -> [sent, failed, discarded, lag sum, max]
+        self.counts = {}
+
+    def completed(self, service, appname, uid, creation, outcome, devtoks,
+      tenant):
+        """
+        Completions hook.
+        """
+        lag = now() - creation
+        with Locker(self.mutex):
+            c = self.counts.get((service, appname))
+            if c is None:
+                c = self.counts[(service, appname)] = [0, 0, 0, 0., 0.]
+            c[outcome] += 1
+            if outcome == OUTCOME_SENT:
+                c[3] += lag
+                c[4] = max(c[4], lag)
+
+    def _log(self):
+        with Locker(self.mutex):
+            counts, self.counts = self.counts, {}
+        for (service, appname), c in sorted(counts.iteritems()):
+            sent = c[OUTCOME_SENT]
+            self.loggers[service].info("Application %s: %d notifications " \
+                "sent, %d failed, %d discarded, delayed by %.3fs on " \
+                "average and %.3fs at most", appname, sent,
+                c[OUTCOME_FAILED], c[OUTCOME_DISCARDED],
+                c[3] / sent if sent != 0 else 0, c[4])
+
+    def run(self):
+        exithelper = ExitHelper()
+        exithelper.register()
+        while True:
+            try:
+                exithelper.sleep(self.interval)
+            except Exiting:
+                self._log()
+                break
+            self._log()
+
+
+class Journal:
+    """
+    Append-only binary journal of the outcome of notifications, one
+    fixed-size record per device token or registration id (see
+    _RECORD).  Records go to segment files named journal.<number>,
+    preallocated to `segsize' bytes and mapped in memory; a new segment
+    is started when one is full and only the last `maxsegments' are
+    kept (0 to keep them all).  Segments are truncated to their records
+    when closed; after a crash, the first record whose service is 0
+    marks the end.
+    For each block of _BLOCK records, a sparse index entry is appended
+    to journal.<number>.idx (see _INDEX) with the range of uids and
+    times of the block and a Bloom filter of its token hashes, so that
+    looking for a uid or a token only reads a few blocks.  p2mjournal.py
+    reads the journal.
+    This is a completions hook.
+    """
+
+    # uid, token hash, creation time, completion time, outcome, service.
+    _RECORD = struct.Struct('>QQddBB6x')
+    # First record, number of records, min and max uid, min and max
+    # completion time, followed by the Bloom filter.
+    _INDEX = struct.Struct('>IIQQdd')
+    _BLOCK = 1024
+    _BLOOMBYTES = 1024
+    SERVICES = {'apns': 1, 'gcm': 2}
+
+    @staticmethod
+    def tokenhash(devtok):
+        """
+        Hash of a device token (in base64) or of a registration id.
+        """
+        return struct.unpack('>Q', hashlib.md5(devtok).digest()[:8])[0]
+
+    @staticmethod
+    def bloombits(h):
+        """
+        Returns the bits of the Bloom filter set for the token hash `h',
+        as (byte index, mask) tuples.
+        """
+        nbits = Journal._BLOOMBYTES * 8
+        bits = []
+        for i in range(3):
+            bit = (h >> (21 * i)) % nbits
+            bits.append((bit >> 3, 1 << (bit & 7)))
+        return bits
+
+    @staticmethod
+    def segments(directory):
+        """
+        Returns the sorted list of segment numbers in `directory'.
+        """
+        l = []
+        for name in os.listdir(directory):
+            m = re.match(r"^journal\.(\d+)$", name)
+            if m is not None:
+                l.append(int(m.group(1)))
+        return sorted(l)
+
+    @staticmethod
+    def path(directory, segment):
+        return os.path.join(directory, "journal.%08d" % segment)
+
+    def __init__(self, directory, segsize, maxsegments):
+        self.directory = directory
+        self.maxrecords = max(segsize / Journal._RECORD.size, 1)
+        self.maxsegments = maxsegments
+        self.mutex = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        segments = Journal.segments(directory)
+        # Never append to a segment which may not have been closed.
+        self.segment = segments[-1] if len(segments) > 0 else 0
+        self.mm = None
+        self._open()
+
+    def _open(self):
+        self.segment += 1
+        path = Journal.path(self.directory, self.segment)
+        size = self.maxrecords * Journal._RECORD.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0644)
+        try:
+            os.ftruncate(fd, size)
+            self.mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.index = open(path + ".idx", "wb")
+        self.nrecords = 0
+        self._newblock()
+        if self.maxsegments > 0:
+            for segment in Journal.segments(self.directory):
+                if segment > self.segment - self.maxsegments:
+                    break
+                path = Journal.path(self.directory, segment)
+                os.unlink(path)
+                if os.path.exists(path + ".idx"):
+                    os.unlink(path + ".idx")
+
+    def _newblock(self):
+        self.blockstart = self.nrecords
+        self.minuid = self.mintime = None
+        self.maxuid = self.maxtime = 0
+        self.bloom = bytearray(Journal._BLOOMBYTES)
+
+    def _endblock(self):
+        if self.nrecords == self.blockstart:
+            return
+        self.index.write(Journal._INDEX.pack(self.blockstart,
+            self.nrecords - self.blockstart, self.minuid, self.maxuid,
+            self.mintime, self.maxtime) + str(self.bloom))
+        self.index.flush()
+        self._newblock()
+
+    def _close(self):
+        self._endblock()
+        self.index.close()
+        self.mm.flush()
+        self.mm.close()
+        with open(Journal.path(self.directory, self.segment), "r+b") as f:
+            f.truncate(self.nrecords * Journal._RECORD.size)
+
+    def completed(self, service, appname, uid, creation, outcome, devtoks,
+      tenant):
+        """
+        Completions hook.
+        """
+        curtime = now()
+        code = Journal.SERVICES[service]
+        hashes = [Journal.tokenhash(t) for t in devtoks]
+        with Locker(self.mutex):
+            if self.mm is None:
+                return
+            for h in hashes:
+                # The bounds of a block are those of its own records.
+                if self.minuid is None:
+                    self.minuid, self.mintime = uid, curtime
+                self.minuid = min(self.minuid, uid)
+                self.maxuid = max(self.maxuid, uid)
+                self.maxtime = curtime
+                Journal._RECORD.pack_into(self.mm,
+                    self.nrecords * Journal._RECORD.size,
+                    uid, h, creation, curtime, outcome, code)
+                self.nrecords += 1
+                for byte, mask in Journal.bloombits(h):
+                    self.bloom[byte] |= mask
+                if self.nrecords - self.blockstart == Journal._BLOCK or \
+                  self.nrecords == self.maxrecords:
+                    self._endblock()
+                    if self.nrecords == self.maxrecords:
+                        self._close()
+                        self._open()
+
+    def close(self):
+        with Locker(self.mutex):
+            self._close()
+            self.mm = None
+
+
+class ExitAwareQueue(Queue.Queue):
+    """
+    Queue whose get() also returns, raising Queue.Empty, when exit is
+    signaled or the calling thread is retired (see ExitHelper), so that
+    consumers can wait without timeout.
+    """
+
+    def __init__(self, maxsize=0):
+        Queue.Queue.__init__(self, maxsize)
+        ExitHelper().onexit(self.not_empty)
+
+    def get(self, block=True, timeout=None):
+        exithelper = ExitHelper()
+        with Locker(self.not_empty):
+            if timeout is not None:
+                deadline = now() + timeout
+            while not self._qsize():
+                if not block or exithelper.stopping():
+                    raise Queue.Empty
+                if timeout is None:
+                    self.not_empty.wait()
+                else:
+                    remaining = deadline - now()
+                    if remaining <= 0:
+                        raise Queue.Empty
+                    self.not_empty.wait(remaining)
+            item = self._get()
+            self.not_full.notify()
+            return item
+
+
+class TenantDeque:
+    """
+    Deque-like container of the items of several tenants, each having
+    its own FIFO, which hands them out by deficit round-robin: the
+    tenants which have items take turns, each being credited its quantum
+    on its turn and handing out items as long as their cost is covered
+    by its credit.  `fairness' is an object whose tenant(item),
+    cost(item) and quantum(tenant) attributes are functions returning
+    the tenant of an item, its cost (e.g. its number of devices) and the
+    credit of a tenant for each turn.  Without it, all items belong to
+    the same tenant and it is a plain FIFO.
+    This is not thread-safe.
+    """
+
+    def __init__(self, fairness=None):
+        self.fairness = fairness
+        if self.fairness is None:
+            self.fairness = AttributeHolder(tenant=lambda item: None,
+                cost=lambda item: 1, quantum=lambda tenant: 1)
+        # Tenants which have items, the first one having its turn.
+        self.active = collections.deque()
+        # FIFO, credit, cost of the items and number of restored items
+        # at the head of the FIFO of each active tenant.
+        self.queues = {}
+        self.deficits = {}
+        self.costs = {}
+        self.restored = {}
+        self.size = 0
+
+    # Operations on the FIFO of a tenant.
+    def _new(self):
+        return collections.deque()
+
+    def _push(self, q, item):
+        q.append(item)
+
+    def _pop(self, q):
+        return q.popleft()
+
+    def _head(self, q):
+        return q[0]
+
+    def _activate(self, tenant):
+        q = self.queues.get(tenant)
+        if q is None:
+            q = self.queues[tenant] = self._new()
+            self.costs[tenant] = 0
+            self.restored[tenant] = 0
+            self.deficits[tenant] = 0
+            if len(self.active) == 0:
+                self.deficits[tenant] = self.fairness.quantum(tenant)
+            self.active.append(tenant)
+        return q
+
+    def _deactivate(self, tenant):
+        head = self.active[0] == tenant
+        self.active.remove(tenant)
+        del self.queues[tenant], self.costs[tenant], self.restored[tenant], \
+            self.deficits[tenant]
+        if head and len(self.active) > 0:
+            self.deficits[self.active[0]] += \
+                self.fairness.quantum(self.active[0])
+
+    def append(self, item):
+        tenant = self.fairness.tenant(item)
+        self._push(self._activate(tenant), item)
+        self.costs[tenant] += self.fairness.cost(item)
+        self.size += 1
+
+    def extendrestored(self, items):
+        """
+        Appends `items', restored from the database, after the restored
+        items already at the head of the FIFO of their tenant but before
+        the others.
+        """
+        bytenant = collections.OrderedDict()
+        for item in items:
+            bytenant.setdefault(self.fairness.tenant(item), []).append(item)
+        for tenant, titems in bytenant.iteritems():
+            q = self._activate(tenant)
+            n = self.restored[tenant]
+            q.rotate(-n)
+            q.extend(titems)
+            q.rotate(n + len(titems))
+            self.restored[tenant] += len(titems)
+            self.costs[tenant] += sum(self.fairness.cost(item)
+                for item in titems)
+            self.size += len(titems)
+
+    def _credit(self):
+        """
+        Credits all tenants at once with the rounds needed for one of
+        them to hand out its next item, after a whole round where none
+        of them could.
+        """
+        cost = self.fairness.cost
+        quantum = self.fairness.quantum
+        rounds = min(int(math.ceil(float(cost(self._head(self.queues[t])) -
+            self.deficits[t]) / quantum(t))) for t in self.active) - 1
+        if rounds > 0:
+            for t in self.active:
+                self.deficits[t] += rounds * quantum(t)
+
+    def popleft(self):
+        if self.size == 0:
+            raise IndexError("pop from an empty TenantDeque")
+        cost = self.fairness.cost
+        skipped = 0
+        while True:
+            tenant = self.active[0]
+            q = self.queues[tenant]
+            c = cost(self._head(q))
+            if len(self.active) == 1:
+                break
+            if self.deficits[tenant] >= c:
+                self.deficits[tenant] -= c
+                break
+            skipped += 1
+            if skipped == len(self.active):
+                self._credit()
+                skipped = 0
+            # Its turn is over.
+            self.active.rotate(-1)
+            self.deficits[self.active[0]] += \
+                self.fairness.quantum(self.active[0])
+        item = self._pop(q)
+        self.size -= 1
+        self.costs[tenant] -= c
+        if self.restored[tenant] > 0:
+            self.restored[tenant] -= 1
+        if len(q) == 0:
+            self._deactivate(tenant)
+        return item
+
+    def take(self, match):
+        """
+        Removes and returns the items for which `match(item)' is true,
+        in order for each tenant, without charging their tenant.
+        """
+        taken = []
+        for tenant in list(self.active):
+            q = self.queues[tenant]
+            restored = self.restored[tenant]
+            for i in range(len(q)):
+                item = self._pop(q)
+                if not match(item):
+                    self._push(q, item)
+                    continue
+                taken.append(item)
+                self.size -= 1
+                self.costs[tenant] -= self.fairness.cost(item)
+                if i < restored:
+                    self.restored[tenant] -= 1
+            if len(q) == 0:
+                self._deactivate(tenant)
+        return taken
+
+    def queued(self, tenant):
+        """
+        Returns the cost of the items of `tenant'.
+        """
+        return self.costs.get(tenant, 0)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for tenant in self.active:
+            for item in self.queues[tenant]:
+                yield item
+
+
+class TenantHeaps(TenantDeque):
+    """
+    Same as TenantDeque but the items of each tenant are a heap: the
+    smallest one is handed out first on its turn.  extendrestored() is
+    not supported.
+    """
+
+    def _new(self):
+        return []
+
+    def _push(self, q, item):
+        heapq.heappush(q, item)
+
+    def _pop(self, q):
+        return heapq.heappop(q)
+
+    def take(self, match):
+        """
+        Same as TenantDeque.take(), the items of each tenant being
+        returned smallest first.
+        """
+        taken = []
+        for tenant in list(self.active):
+            q = self.queues[tenant]
+            matched = sorted(item for item in q if match(item))
+            if len(matched) == 0:
+                continue
+            q[:] = [item for item in q if not match(item)]
+            heapq.heapify(q)
+            taken.extend(matched)
+            self.size -= len(matched)
+            self.costs[tenant] -= sum(self.fairness.cost(item)
+                for item in matched)
+            if len(q) == 0:
+                self._deactivate(tenant)
+        return taken
+
+
+class MemoryBudget:
+    """
+    Accounts the memory used by the items of a set of queues, in bytes
+    as estimated by each of them, against a limit shared by all of them
+    (0 for no limit).  Queues spill their items to disk (see Spill) once
+    it is exceeded, and page them back in when the memory used falls
+    below three quarters of the limit, so as not to do it after each
+    item handed out.
+    """
+
+    def __init__(self, limit=0):
+        self.limit = limit
+        self.used = 0
+        self.mutex = threading.Lock()
+
+    def charge(self, size):
+        with Locker(self.mutex):
+            self.used += size
+
+    def release(self, size):
+        with Locker(self.mutex):
+            self.used -= size
+
+    def exceeded(self):
+        return self.limit > 0 and self.used >= self.limit
+
+    def hasroom(self):
+        return self.limit <= 0 or self.used < self.limit * 3 / 4
+
+
+class Spill:
+    """
+    FIFO of the items of a queue over its memory budget, kept in the
+    SQLite table `dbinfo.table' with the tenant and cost of each item
+    (see TenantDeque) so that quotas still account for them.  Items are
+    written by batches and survive a crash: those left over are paged
+    in as any other.
+    Items pushed as restored from the database go before the others,
+    in order, with negative rowids: after the restored items left over
+    by an earlier run, if any, which keep their place.
+    This is not thread-safe, it is used with the mutex of its queue
+    held.
+    """
+
+    # Items written or read at a time.
+    BATCHSIZE = 100
+
+    def __init__(self, dbinfo, fairness=None):
+        self.dbinfo = dbinfo
+        self.fairness = fairness
+        if self.fairness is None:
+            self.fairness = AttributeHolder(tenant=lambda item: None,
+                cost=lambda item: 1)
+        self.conn = sqlite3.connect(dbinfo.db, check_same_thread=False)
+        # What is in the table is in memory as well, until exit.
+        self.conn.execute("PRAGMA synchronous = OFF")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS %s (
+            rowid INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+            tenant TEXT,
+            cost INTEGER,
+            data BLOB);""" % dbinfo.table)
+        self.conn.commit()
+        # Items not written yet.
+        self.buffer = []
+        self.count = 0
+        self.costs = {}
+        for tenant, count, cost in self.conn.execute("SELECT tenant, " \
+          "COUNT(*), SUM(cost) FROM %s GROUP BY tenant" % dbinfo.table):
+            self.count += count
+            self.costs[tenant] = cost
+        # Number of restored items, which are the first ones, and rowid
+        # of the next one.
+        maxrowid, self.restored = self.conn.execute("SELECT MAX(rowid), " \
+            "COUNT(*) FROM %s WHERE rowid < 0" % dbinfo.table).fetchone()
+        self.restoredrowid = -2**48 if maxrowid is None else maxrowid + 1
+
+    def flush(self):
+        """
+        Writes the items not written yet.
+        """
+        if len(self.buffer) == 0:
+            return
+        with self.conn:
+            self.conn.executemany("INSERT INTO %s (rowid, tenant, cost, " \
+                "data) VALUES (?, ?, ?, ?)" % self.dbinfo.table, self.buffer)
+        del self.buffer[:]
+
+    def push(self, item, key=None, restored=False):
+        """
+        Appends `item', stored as the (key, item) tuple if `key' is not
+        None.  If `restored' is True, it goes after the restored items
+        but before the others.
+        """
+        tenant = self.fairness.tenant(item)
+        cost = self.fairness.cost(item)
+        rowid = None
+        if restored:
+            rowid = self.restoredrowid
+            self.restoredrowid += 1
+            self.restored += 1
+        self.buffer.append((rowid, tenant, cost,
+            str(item if key is None else (key, item))))
+        self.count += 1
+        self.costs[tenant] = self.costs.get(tenant, 0) + cost
+        if len(self.buffer) >= self.BATCHSIZE:
+            self.flush()
+
+    def pop(self, n):
+        """
+        Removes and returns up to `n' items, oldest first, as they were
+        pushed.
+        """
+        self.flush()
+        rows = self.conn.execute("SELECT rowid, tenant, cost, data FROM %s " \
+            "ORDER BY rowid LIMIT %d" % (self.dbinfo.table, n)).fetchall()
+        if len(rows) == 0:
+            return []
+        with self.conn:
+            self.conn.execute("DELETE FROM %s WHERE rowid <= ?" %
+                self.dbinfo.table, (rows[-1][0], ))
+        items = []
+        for rowid, tenant, cost, data in rows:
+            items.append(eval(data))
+            if rowid < 0:
+                self.restored -= 1
+            self.count -= 1
+            self.costs[tenant] -= cost
+            if self.costs[tenant] == 0:
+                del self.costs[tenant]
+        return items
+
+    def drain(self, conn, table):
+        """
+        Moves all the items to `table', with the `conn' connection
+        which is in a transaction, flush() having been called before it
+        began.  Returns how many there were.
+        """
+        n = conn.execute("INSERT INTO %s (data) SELECT data FROM %s " \
+            "ORDER BY rowid" % (table, self.dbinfo.table)).rowcount
+        conn.execute("DELETE FROM %s" % self.dbinfo.table)
+        self.count = 0
+        self.costs = {}
+        self.restored = 0
+        return n
+
+    def queued(self, tenant):
+        return self.costs.get(tenant, 0)
+
+    def __len__(self):
+        return self.count
+
+
 class Checkpointable:
     """
     Implements the checkpoint() method that writes to an SQLite database
-    the current content of a Queue-like object.
+    the current content of a Queue-like object, and the restore() method
+    that puts it back, chunk by chunk so that the queue can be used
+    meanwhile.
+    Items spilled to disk by the queue, if any, are moved to the table as
+    well, after the others.
     This class it not meant to be used as is, but should be inherited.
     """
 
+    # Spill of the items over the memory budget of the queue, if any.
+    spill = None
+
     def __init__(self, dbinfo):
         self.dbinfo = dbinfo
+        # Items written by an older version may need to be converted.
+        self.upgrade = getattr(dbinfo, 'upgrade', None)
+        if self.upgrade is None:
+            self.upgrade = lambda item: item
         # Just test that queue exits.
         if len(self.queue) == 0:
             pass
+        # Serializes restore() and checkpoint(), it is taken before
+        # self.mutex.
+        self.restoremutex = threading.Lock()
+        self.lastrowid = 0
         conn = sqlite3.connect(self.dbinfo.db)
-        conn.isolation_level = None
         try:
-            c = conn.execute(
-              "SELECT data FROM %s ORDER BY rowid" % self.dbinfo.table)
+            c = conn.execute("SELECT COUNT(*) FROM %s" % self.dbinfo.table)
+            self.torestore = c.fetchone()[0]
         except:
-            return
-        for e in c:
-            self.queue.append(eval(e[0]))
+            self.torestore = 0
+        conn.close()
+
+    def _restore(self, item):
+        """
+        Puts back an item read from the database.  Override this if
+        the queue is not a plain list-like object.
+        This is called with self.mutex held.
+        """
+        self.queue.append(self.upgrade(item))
+
+    def _restore_items(self, items):
+        """
+        Puts back a chunk of items read from the database and wakes up
+        consumers.  This is called with self.mutex held.
+        """
+        for item in items:
+            self._restore(item)
+
+    def _restore_chunk(self, chunksize):
+        if self.torestore == 0:
+            return 0
+        conn = sqlite3.connect(self.dbinfo.db)
+        q = "SELECT rowid, data FROM %s WHERE rowid > ? ORDER BY rowid" % \
+            self.dbinfo.table
+        if chunksize > 0:
+            q += " LIMIT %d" % chunksize
+        rows = conn.execute(q, (self.lastrowid, )).fetchall()
+        conn.close()
+        if len(rows) == 0:
+            self.torestore = 0
+            return 0
+        items = [eval(data) for rowid, data in rows]
+        with Locker(self.mutex):
+            self._restore_items(items)
+        self.lastrowid = rows[-1][0]
+        self.torestore = max(self.torestore - len(rows), 0)
+        if chunksize <= 0 or len(rows) < chunksize:
+            self.torestore = 0
+        return len(rows)
+
+    def restore(self, chunksize=0):
+        """
+        Puts back the next `chunksize' items of the database (all of
+        them if 0) and returns how many there were, 0 once all of them
+        are restored.
+        """
+        with Locker(self.restoremutex):
+            return self._restore_chunk(chunksize)
+
+    def _checkpoint_items(self):
+        """
+        Returns an iterable over the items to write in the database.
+        This is called with self.mutex held.
+        """
+        return self.queue
 
     def __rename_table(self, conn):
         c = conn.execute(
@@ -193,8 +1423,17 @@ class Checkpointable:
               (self.dbinfo.table, self.dbinfo.table))
 
     def checkpoint(self):
+        with Locker(self.restoremutex):
+            # Items not restored yet would be lost with the table.
+            self._restore_chunk(0)
+            self.torestore = 0
+            return self._checkpoint()
+
+    def _checkpoint(self):
         i = 0
         with Locker(self.mutex):
+            if self.spill is not None:
+                self.spill.flush()
             conn = sqlite3.connect(self.dbinfo.db)
             conn.isolation_level = None
             self.__rename_table(conn)
@@ -204,111 +1443,844 @@ class Checkpointable:
                 rowid INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
                 data BLOB);""" % self.dbinfo.table)
             c.execute("BEGIN")
-            for e in self.queue:
+            for e in self._checkpoint_items():
                 i += 1
                 c.execute("INSERT INTO %s (data) VALUES(?)""" % \
                   self.dbinfo.table, (str(e), ))
+            if self.spill is not None:
+                i += self.spill.drain(c, self.dbinfo.table)
             c.execute("END")
             conn.close()
         return i
 
 
-class CheckpointableQueue(Queue.Queue, Checkpointable):
+class CheckpointableQueue(ExitAwareQueue, Checkpointable):
     """
     Guess what!
+    Items restored while new ones are enqueued go before them if
+    `restoredfirst' is True, otherwise after them.
+    Items are shared among tenants as described by `fairness' (see
+    TenantDeque).
+    If `memory' is given, its "budget" attribute is a MemoryBudget and
+    its "sizeof" one a function estimating the memory used by an item.
+    Items put while the budget is exceeded are spilled to the
+    "<table>_spill" table, as well as the following ones to keep them
+    in order, until they are paged back in.
     """
 
-    def __init__(self, dbinfo):
-        Queue.Queue.__init__(self)
+    # Items paged in at a time.
+    _PAGESIZE = 1000
+
+    def __init__(self, dbinfo, restoredfirst=True, fairness=None,
+      memory=None):
+        self.fairness = fairness
+        self.memory = memory
+        ExitAwareQueue.__init__(self)
+        if memory is not None:
+            self.spill = Spill(AttributeHolder(db=dbinfo.db,
+                table='%s_spill' % dbinfo.table), fairness)
         Checkpointable.__init__(self, dbinfo)
+        self.restoredfirst = restoredfirst
+
+    def _init(self, maxsize):
+        self.queue = TenantDeque(self.fairness)
+
+    def _append(self, item):
+        self.queue.append(item)
+
+    def _popleft(self):
+        return self.queue.popleft()
+
+    def _restore(self, item):
+        # Items are upgraded by _restore_items().
+        self._append(item)
+
+    def _qsize(self, len=len):
+        n = len(self.queue)
+        if self.spill is not None:
+            n += len(self.spill)
+        return n
+
+    def _spills(self):
+        return self.spill is not None and \
+            (len(self.spill) > 0 or self.memory.budget.exceeded())
+
+    def _put(self, item):
+        if self._spills():
+            self.spill.push(item)
+            return
+        if self.memory is not None:
+            self.memory.budget.charge(self.memory.sizeof(item))
+        self._append(item)
+
+    def _pagein(self):
+        """
+        Pages spilled items back in if there is room for them, or if
+        there is nothing else left in memory.
+        """
+        if len(self.spill) == 0 or (len(self.queue) > 0 and
+          not self.memory.budget.hasroom()):
+            return
+        budget = self.memory.budget
+        n = 0
+        while len(self.spill) > 0 and n < self._PAGESIZE and \
+          (n == 0 or not budget.exceeded()):
+            # Restored items come first.
+            restored = self.spill.restored
+            items = [self.upgrade(item)
+                for item in self.spill.pop(Spill.BATCHSIZE)]
+            budget.charge(sum(self.memory.sizeof(item) for item in items))
+            if restored > 0:
+                self.queue.extendrestored(items[:restored])
+            for item in items[restored:]:
+                self._append(item)
+            n += len(items)
+
+    def _get(self):
+        if self.spill is not None:
+            self._pagein()
+        item = self._popleft()
+        if self.memory is not None:
+            self.memory.budget.release(self.memory.sizeof(item))
+        return item
+
+    def _restore_items(self, items):
+        items = [self.upgrade(item) for item in items]
+        n = len(items)
+        if self.spill is not None:
+            # With restoredfirst, restored items spilled still go before
+            # the new ones.
+            kept = []
+            for item in items:
+                if self._spills():
+                    self.spill.push(item, restored=self.restoredfirst)
+                else:
+                    self.memory.budget.charge(self.memory.sizeof(item))
+                    kept.append(item)
+            items = kept
+        if self.restoredfirst:
+            self.queue.extendrestored(items)
+        else:
+            Checkpointable._restore_items(self, items)
+        self.unfinished_tasks += n
+        self.not_empty.notify(n)
+
+    def queued(self, tenant):
+        """
+        Returns the cost of the items of `tenant' in the queue.
+        """
+        with Locker(self.mutex):
+            n = self.queue.queued(tenant)
+            if self.spill is not None:
+                n += self.spill.queued(tenant)
+            return n
+
+    def spilled(self):
+        """
+        Returns the number of items spilled to disk.
+        """
+        with Locker(self.mutex):
+            return len(self.spill) if self.spill is not None else 0
+
+
+class CheckpointableDeadlineQueue(CheckpointableQueue):
+    """
+    Same as CheckpointableQueue but delivers items by earliest deadline
+    first instead of FIFO order.  Items whose deadline has passed are
+    discarded when dequeued and when checkpointed, and passed to
+    `discard' if given, as discard(item, when) with `when' being
+    "dequeue" or "checkpoint", without any lock held.
+    `deadline' is a function returning the deadline of an item, or None
+    if the item must never be considered stale; such items are ordered
+    by the time they have been enqueued.
+    With several tenants, each of them has its turn as with
+    CheckpointableQueue, and hands out its own items by earliest
+    deadline first.
+    Items over the memory budget are spilled as with CheckpointableQueue,
+    and only ordered by deadline once paged back in.
+    """
+
+    def __init__(self, dbinfo, deadline, fairness=None, discard=None,
+      memory=None):
+        self.deadline = deadline
+        self.discard = discard
+        if self.discard is None:
+            self.discard = lambda item, when: None
+        self.seq = itertools.count()
+        self.dropped_at_dequeue = 0
+        self.dropped_at_checkpoint = 0
+        CheckpointableQueue.__init__(self, dbinfo, False, fairness, memory)
+
+    # Queue.Queue internals, the heaps contain (deadline, seq, item).
+    def _init(self, maxsize):
+        fairness = None
+        if self.fairness is not None:
+            f = self.fairness
+            fairness = AttributeHolder(tenant=lambda e: f.tenant(e[2]),
+                cost=lambda e: f.cost(e[2]), quantum=f.quantum)
+        self.queue = TenantHeaps(fairness)
+
+    def _append(self, item):
+        dl = self.deadline(item)
+        self.queue.append(
+            (dl if dl is not None else now(), self.seq.next(), item))
+
+    def _popleft(self):
+        return self.queue.popleft()[2]
+
+    def _isstale(self, item, curtime):
+        dl = self.deadline(item)
+        return dl is not None and dl < curtime
+
+    def _checkpoint(self):
+        # Stale items leave the queue, so that they are discarded once.
+        curtime = now()
+        with Locker(self.mutex):
+            stale = self.queue.take(lambda e: self._isstale(e[2], curtime))
+            if self.memory is not None:
+                self.memory.budget.release(sum(self.memory.sizeof(e[2])
+                    for e in stale))
+        self.dropped_at_checkpoint += len(stale)
+        for dl, seq, item in stale:
+            self.discard(item, "checkpoint")
+        return CheckpointableQueue._checkpoint(self)
+
+    def _checkpoint_items(self):
+        return [item for dl, seq, item in sorted(self.queue)]
+
+    def get(self, block=True, timeout=None):
+        if timeout is not None:
+            deadline = now() + timeout
+        while True:
+            item = CheckpointableQueue.get(self, block, timeout)
+            curtime = now()
+            if not self._isstale(item, curtime):
+                return item
+            # Only the agent threads dequeue, the counter doesn't need
+            # to be exact.
+            self.dropped_at_dequeue += 1
+            self.discard(item, "dequeue")
+            if timeout is not None:
+                timeout = max(deadline - curtime, 0)
 
 
 class CheckpointableTimelySQueue(Checkpointable, threading.Thread):
     """
     Implements a similar but stripped down interface of Queue which
     delivers items on time only.
+    Items already due are shared among tenants as described by
+    `fairness' (see TenantDeque).
+    Items over the memory budget are spilled as with
+    CheckpointableQueue, and paged back in by the thread.
     """
 
     _RESOLUTION = 0.01
+    _PAGESIZE = 1000
 
-    def __init__(self, dbinfo):
+    def __init__(self, dbinfo, getcond=None, fairness=None, memory=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.name = "CheckpointableTimelySQueue"
+        self.queue = []
+        self.fairness = fairness
+        self.memory = memory
+        if memory is not None:
+            self.spill = Spill(AttributeHolder(db=dbinfo.db,
+                table='%s_spill' % dbinfo.table), fairness)
+        tfairness = None
+        if fairness is not None:
+            tfairness = AttributeHolder(tenant=lambda e: fairness.tenant(e[1]),
+                cost=lambda e: fairness.cost(e[1]), quantum=fairness.quantum)
+        # Items due, as (when, item), modified with self.getcond held.
+        self.triggered = TenantDeque(tfairness)
+        # Cost of the items not due yet by tenant.
+        self.scheduled = {}
+        self.mutex = threading.Lock()
+        self.putcond = threading.Condition(self.mutex)
+        # May be shared with other queues (see LanedTimelyQueue).
+        self.getcond = getcond
+        if self.getcond is None:
+            self.getcond = threading.Condition()
+        self.putwaketime = 0
+        exithelper = ExitHelper()
+        exithelper.onexit(self.putcond)
+        exithelper.onexit(self.getcond)
+        Checkpointable.__init__(self, dbinfo)
+
+    def _schedule(self, when, item):
+        """
+        This is called with self.mutex held.
+        """
+        if self.memory is not None:
+            self.memory.budget.charge(self.memory.sizeof(item))
+        heapq.heappush(self.queue, (when, item))
+        if self.fairness is not None:
+            tenant = self.fairness.tenant(item)
+            self.scheduled[tenant] = self.scheduled.get(tenant, 0) + \
+                self.fairness.cost(item)
+
+    def _spills(self):
+        return self.spill is not None and \
+            (len(self.spill) > 0 or self.memory.budget.exceeded())
+
+    def _restore(self, e):
+        when, item = e
+        item = self.upgrade(item)
+        if self._spills():
+            self.spill.push(item, when)
+        else:
+            self._schedule(when, item)
+
+    def _pagein(self):
+        """
+        Pages spilled items back in if there is room for them, or if
+        there is nothing else left in memory.
+        This is called with self.mutex held.
+        """
+        if len(self.spill) == 0 or ((len(self.queue) > 0 or
+          len(self.triggered) > 0) and not self.memory.budget.hasroom()):
+            return
+        n = 0
+        while len(self.spill) > 0 and n < self._PAGESIZE and \
+          (n == 0 or not self.memory.budget.exceeded()):
+            items = self.spill.pop(Spill.BATCHSIZE)
+            for when, item in items:
+                self._schedule(when, self.upgrade(item))
+            n += len(items)
+
+    def _restore_items(self, items):
+        Checkpointable._restore_items(self, items)
+        self.putcond.notify()
+
+    def _checkpoint_items(self):
+        # Items triggered but not handed to an agent yet count too.
+        with Locker(self.getcond):
+            return list(self.triggered) + self.queue
+
+    def put(self, when, item):
+        with Locker(self.mutex):
+            if self._spills():
+                self.spill.push(item, when)
+                if self.putwaketime == 0:
+                    # Nothing left in memory maybe, let the thread page
+                    # it in.
+                    self.putcond.notify()
+                return
+            self._schedule(when, item)
+            if when < self.putwaketime or self.putwaketime == 0:
+                self.putcond.notify()
+
+    def queued(self, tenant):
+        """
+        Returns the cost of the items of `tenant' in the queue, due or
+        not.
+        """
+        with Locker(self.mutex):
+            # Reading the cost of the triggered items doesn't need to be
+            # exact.
+            n = self.scheduled.get(tenant, 0) + self.triggered.queued(tenant)
+            if self.spill is not None:
+                n += self.spill.queued(tenant)
+            return n
+
+    def spilled(self):
+        """
+        Returns the number of items spilled to disk.
+        """
+        with Locker(self.mutex):
+            return len(self.spill) if self.spill is not None else 0
+
+    def _released(self, item):
+        """
+        Called on the items handed out by get() and take(), without any
+        lock held.  Returns the item to hand out, or None to skip it.
+        """
+        if self.memory is not None:
+            self.memory.budget.release(self.memory.sizeof(item))
+            if len(self.spill) > 0:
+                # Let the thread page them in if it is time to.
+                with Locker(self.mutex):
+                    self.putcond.notify()
+        return item
+
+    def get(self, timeout=None):
+        """
+        Returns the next item due, or None if none is within `timeout'
+        seconds (None to wait as long as needed), on exit or if the
+        calling thread is retired.
+        """
+        while True:
+            item = self._get(timeout)
+            if item is None:
+                return None
+            item = self._released(item)
+            if item is not None:
+                return item
+
+    def _get(self, timeout):
+        exithelper = ExitHelper()
+        with Locker(self.getcond):
+            if timeout is not None:
+                deadline = now() + timeout
+            while len(self.triggered) == 0:
+                if exithelper.stopping():
+                    return None
+                if timeout is None:
+                    self.getcond.wait()
+                    continue
+                remaining = deadline - now()
+                if remaining <= 0:
+                    return None
+                self.getcond.wait(remaining)
+            when, item = self.triggered.popleft()
+            return item
+
+    def take(self, match):
+        """
+        Removes and returns the items already due for which `match(item)'
+        is true, in order.
+        """
+        with Locker(self.getcond):
+            taken = [e[1] for e in self.triggered.take(
+                lambda e: match(e[1]))]
+        taken = [self._released(item) for item in taken]
+        return [item for item in taken if item is not None]
+
+    def qsize(self):
+        with Locker(self.mutex):
+            # Reading the number of triggered items doesn't need to be
+            # exact.
+            n = len(self.queue) + len(self.triggered)
+            if self.spill is not None:
+                n += len(self.spill)
+            return n
+
+    def run(self):
+        exithelper = ExitHelper()
+        exithelper.register()
+        with Locker(self.mutex):
+            while True:
+                try:
+                    while True:
+                        exithelper.checkexit()
+                        if self.spill is not None:
+                            self._pagein()
+                        try:
+                            when, item = self.queue[0]
+                        except IndexError:
+                            # Until put() wakes us up.
+                            self.putwaketime = 0
+                            self.putcond.wait()
+                            continue
+                        maxwait = when - now()
+                        if maxwait < self._RESOLUTION:
+                            break
+                        self.putwaketime = when
+                        self.putcond.wait(maxwait)
+                except Exiting:
+                    main_logger.debug("Exiting...")
+                    break
+
+                curtime = now()
+                with Locker(self.getcond):
+                    while True:
+                        # Don't dequeue now, we are not sure we will use
+                        # it.
+                        try:
+                            when, item = self.queue[0]
+                        except IndexError:
+                            break
+                        if when > curtime + self._RESOLUTION:
+                            break
+
+                        self.triggered.append(heapq.heappop(self.queue))
+                        if self.fairness is not None:
+                            tenant = self.fairness.tenant(item)
+                            self.scheduled[tenant] -= \
+                                self.fairness.cost(item)
+                            if self.scheduled[tenant] == 0:
+                                del self.scheduled[tenant]
+                    if len(self.triggered) > 0:
+                        self.getcond.notify(len(self.triggered))
+
+
+class LaneScheduler:
+    """
+    Chooses the priority lane to serve next.  Without weights, a lane is
+    only served when the lanes before it are empty (strict priority).
+    Otherwise the lanes which have items are served in turn, each as
+    many times in a row as its weight.
+    """
+
+    def __init__(self, weights=None):
+        self.weights = weights
+        self.credits = list(weights) if weights is not None else None
+
+    def pick(self, ready):
+        """
+        Returns the index of the lane to serve among those whose flag is
+        true in `ready', or None if there is none.
+        """
+        if not any(ready):
+            return None
+        if self.weights is None:
+            return ready.index(True)
+        while True:
+            for i in range(len(ready)):
+                if ready[i] and self.credits[i] > 0:
+                    self.credits[i] -= 1
+                    return i
+            self.credits = list(self.weights)
+
+
+class Lanes:
+    """
+    Base class of the push queues made of one queue per priority lane,
+    in the order of LANES, each persisted in its own table.  `lane' is a
+    function returning the lane of an item, as items go back to their
+    lane when they are put back (e.g. GCM retries).
+    This class it not meant to be used as is, but should be inherited.
+    """
+
+    def __init__(self, lanes, lane, scheduler):
+        self.lanes = lanes
+        self.lane = lane
+        self.scheduler = scheduler
+        self.index = dict((name, i) for i, name in enumerate(LANES))
+        # Number of items handed out, for Admission.  Only the agent
+        # threads or dispatchers dequeue, it doesn't need to be exact.
+        self.dequeued = 0
+        # Admission control of the listener, if any.
+        self.admission = None
+
+    def _lanequeue(self, item):
+        return self.lanes[self.index.get(self.lane(item),
+            self.index[LANE_NORMAL])]
+
+    def _restored(self):
+        """
+        Wakes up consumers after items have been restored.
+        """
+
+    @property
+    def torestore(self):
+        return sum(q.torestore for q in self.lanes)
+
+    def restore(self, chunksize=0):
+        """
+        Same as Checkpointable.restore(), higher lanes first.
+        """
+        n = 0
+        for q in self.lanes:
+            n += q.restore(chunksize)
+            if chunksize > 0 and n > 0:
+                break
+        if n > 0:
+            self._restored()
+        return n
+
+    def checkpoint(self):
+        return sum(q.checkpoint() for q in self.lanes)
+
+    def qsize(self):
+        return sum(q.qsize() for q in self.lanes)
+
+    def queued(self, tenant):
+        return sum(q.queued(tenant) for q in self.lanes)
+
+
+class LanedQueue(Lanes):
+    """
+    Push queue with priority lanes made of CheckpointableQueue objects,
+    with the same interface.
+    """
+
+    def __init__(self, lanes, lane, scheduler):
+        Lanes.__init__(self, lanes, lane, scheduler)
+        # Notified when items are put in any lane.
+        self.cond = threading.Condition()
+        ExitHelper().onexit(self.cond)
+
+    @property
+    def dropped_at_dequeue(self):
+        return sum(q.dropped_at_dequeue for q in self.lanes)
+
+    @property
+    def dropped_at_checkpoint(self):
+        return sum(q.dropped_at_checkpoint for q in self.lanes)
+
+    def _restored(self):
+        with Locker(self.cond):
+            self.cond.notify_all()
+
+    def put(self, item):
+        self._lanequeue(item).put(item)
+        with Locker(self.cond):
+            self.cond.notify()
+
+    def get(self, block=True, timeout=None):
+        """
+        Same as ExitAwareQueue.get(), the lane being chosen by the
+        scheduler.
+        """
+        exithelper = ExitHelper()
+        if timeout is not None:
+            deadline = now() + timeout
+        while True:
+            with Locker(self.cond):
+                while True:
+                    i = self.scheduler.pick([q.qsize() > 0
+                        for q in self.lanes])
+                    if i is not None:
+                        break
+                    if not block or exithelper.stopping():
+                        raise Queue.Empty
+                    if timeout is None:
+                        self.cond.wait()
+                    else:
+                        remaining = deadline - now()
+                        if remaining <= 0:
+                            raise Queue.Empty
+                        self.cond.wait(remaining)
+            try:
+                item = self.lanes[i].get(False)
+            except Queue.Empty:
+                # Taken by another thread meanwhile, or stale.
+                continue
+            self.dequeued += 1
+            return item
+
+
+class LanedTimelyQueue(Lanes):
+    """
+    GCM push queue with priority lanes made of CheckpointableTimelySQueue
+    objects sharing the same `getcond', with the same interface.
+    """
+
+    def __init__(self, lanes, lane, scheduler):
+        Lanes.__init__(self, lanes, lane, scheduler)
+        self.getcond = lanes[0].getcond
+
+    def start(self):
+        for q in self.lanes:
+            q.start()
+
+    def put(self, when, item):
+        self._lanequeue(item).put(when, item)
+
+    def get(self, timeout=None):
+        exithelper = ExitHelper()
+        if timeout is not None:
+            deadline = now() + timeout
+        while True:
+            with Locker(self.getcond):
+                while True:
+                    i = self.scheduler.pick([len(q.triggered) > 0
+                        for q in self.lanes])
+                    if i is not None:
+                        break
+                    if exithelper.stopping():
+                        return None
+                    if timeout is None:
+                        self.getcond.wait()
+                        continue
+                    remaining = deadline - now()
+                    if remaining <= 0:
+                        return None
+                    self.getcond.wait(remaining)
+                q = self.lanes[i]
+                when, item = q.triggered.popleft()
+            self.dequeued += 1
+            item = q._released(item)
+            if item is not None:
+                return item
+
+    def take(self, match):
+        taken = []
+        for q in self.lanes:
+            taken.extend(q.take(match))
+        self.dequeued += len(taken)
+        return taken
+
+
+class QueueRestorer(threading.Thread):
+    """
+    Restores persistent queues in the background, `chunksize' items of
+    each queue in turn, while the listeners and agents already use them.
+    `queues' is a list of (description, queue) tuples.
+    """
+
+    def __init__(self, queues, chunksize):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.name = "QueueRestorer"
+        self.queues = queues
+        self.chunksize = chunksize
+
+    def run(self):
+        exithelper = ExitHelper()
+        counts = dict((desc, 0) for desc, q in self.queues)
+        pending = list(self.queues)
+        t0 = now()
+        while len(pending) > 0 and not exithelper.exiting:
+            for desc, q in pending[:]:
+                n = q.restore(self.chunksize)
+                counts[desc] += n
+                if n == 0:
+                    pending.remove((desc, q))
+                    main_logger.info("%d %s retrieved from persistent " \
+                        "storage in %.3fs" % (counts[desc], desc, now() - t0))
+                # Let the listeners have the interpreter lock.
+                time.sleep(0)
+
+
+class Scheduler(threading.Thread):
+    """
+    Holds the notifications of a service sent with the "at" option until
+    they are due, then hands them to `route(appname, item)' which puts
+    them in their push queue.  Those due within `window' seconds are
+    kept in memory, the others in an SQLite table indexed on their due
+    time, from which they are paged in as time goes on: campaigns can be
+    scheduled long in advance without holding them in memory.  The
+    notifications in memory are written back to the table by
+    checkpoint().
+    """
+
+    # Rows paged in at a time.
+    _CHUNKSIZE = 10000
+
+    def __init__(self, service, dbinfo, window, route):
         threading.Thread.__init__(self)
         self.daemon = True
-        self.name = "CheckpointableTimelySQueue"
-        self.queue = []
-        self.triggered = collections.deque()
-        self.mutex = threading.Lock()
-        self.putcond = threading.Condition(self.mutex)
-        self.getcond = threading.Condition()
-        self.putwaketime = 0
-        Checkpointable.__init__(self, dbinfo)
+        self.name = "%sScheduler" % service.upper()
+        self.dbinfo = dbinfo
+        self.window = window
+        self.route = route
+        # Items written by an older version may need to be converted.
+        self.upgrade = getattr(dbinfo, 'upgrade', None)
+        if self.upgrade is None:
+            self.upgrade = lambda item: item
+        # (due, seq, (appname, item)) due within the window.
+        self.heap = []
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        ExitHelper().onexit(self.cond)
+        # SQLite connections cannot be shared between threads.
+        self.local = threading.local()
+        conn = self._conn()
+        conn.execute("""CREATE TABLE IF NOT EXISTS %s (
+            rowid INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+            due REAL NOT NULL,
+            data BLOB);""" % dbinfo.table)
+        conn.execute("CREATE INDEX IF NOT EXISTS %s_due ON %s (due)" %
+            (dbinfo.table, dbinfo.table))
+        conn.commit()
+        # Number of rows in the table.
+        self.stored = conn.execute("SELECT COUNT(*) FROM %s" %
+            dbinfo.table).fetchone()[0]
+
+    def _conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(self.dbinfo.db)
+        return conn
+
+    def _insert(self, entries):
+        """
+        Writes (due, appname, item) tuples to the table.
+        """
+        conn = self._conn()
+        with conn:
+            conn.executemany("INSERT INTO %s (due, data) VALUES (?, ?)" %
+                self.dbinfo.table, ((due, str((appname, item)))
+                for due, appname, item in entries))
+        with Locker(self.cond):
+            self.stored += len(entries)
 
-    def put(self, when, item):
-        with Locker(self.mutex):
-            heapq.heappush(self.queue, (when, item))
-            if when < self.putwaketime or self.putwaketime == 0:
-                self.putcond.notify()
+    def _push(self, due, appname, item):
+        """
+        This is called with self.cond held.
+        """
+        heapq.heappush(self.heap, (due, self.seq.next(), (appname, item)))
 
-    def get(self, timeout=None):
-        with Locker(self.getcond):
-            if len(self.triggered) > 0:
-                when, item = self.triggered.popleft()
-                return item
-            while True:
-                if timeout is not None and timeout <= 0:
-                    return None
-                maxwait = 1 if timeout > 1 else timeout
-                timeout -= 1
-                self.getcond.wait(timeout)
-                try:
-                    when, item = self.triggered.popleft()
-                except IndexError:
-                    continue
-                return item
+    def schedule(self, due, appname, items):
+        """
+        Schedules the notifications `items' of application `appname' at
+        `due'.
+        """
+        if due >= now() + self.window:
+            self._insert([(due, appname, item) for item in items])
+            return
+        with Locker(self.cond):
+            for item in items:
+                self._push(due, appname, item)
+            self.cond.notify()
+
+    def _pagein(self, horizon):
+        """
+        Moves the rows due before `horizon' from the table to memory.
+        """
+        conn = self._conn()
+        while True:
+            rows = conn.execute("SELECT rowid, due, data FROM %s " \
+                "WHERE due < ? ORDER BY due LIMIT %d" %
+                (self.dbinfo.table, self._CHUNKSIZE), (horizon, )).fetchall()
+            if len(rows) == 0:
+                return
+            entries = []
+            for rowid, due, data in rows:
+                appname, item = eval(data)
+                entries.append((due, appname, self.upgrade(item)))
+            with Locker(self.cond):
+                for due, appname, item in entries:
+                    self._push(due, appname, item)
+                self.stored -= len(rows)
+            with conn:
+                conn.executemany("DELETE FROM %s WHERE rowid = ?" %
+                    self.dbinfo.table, ((row[0], ) for row in rows))
+            if len(rows) < self._CHUNKSIZE:
+                return
 
     def qsize(self):
-        with Locker(self.mutex):
-            return len(self.queue)
+        return self.stored + len(self.heap)
+
+    def checkpoint(self):
+        """
+        Writes the notifications in memory back to the table.  Returns
+        the number of notifications scheduled.
+        """
+        with Locker(self.cond):
+            entries = [(due, appname, item)
+                for due, seq, (appname, item) in self.heap]
+            del self.heap[:]
+        self._insert(entries)
+        return self.stored
 
     def run(self):
         exithelper = ExitHelper()
         exithelper.register()
-        with Locker(self.mutex):
-            maxwait = None
-            while True:
-                try:
-                    while True:
-                        exithelper.checkexit()
-                        curtime = now()
-                        try:
-                            when, item = self.queue[0]
-                            maxwait = when - curtime
-                        except IndexError:
-                            maxwait = 1
-                        if maxwait < self._RESOLUTION:
-                            break
-                        if maxwait > 1:
-                            maxwait = 1
-                        self.putwaketime = curtime + maxwait
-                        self.putcond.wait(maxwait)
-                except Exiting:
-                    main_logger.debug("Exiting...")
-                    break
-
-                curtime = now()
-                while True:
-                    # Don't dequeue now, we are not sure we will use it.
-                    try:
-                        when, item = self.queue[0]
-                    except IndexError:
-                        break
-                    if when > curtime + self._RESOLUTION:
-                        break
-                    
-                    self.triggered.append(heapq.heappop(self.queue))
-                if len(self.triggered) > 0:
-                    with Locker(self.getcond):
-                        self.getcond.notify(len(self.triggered))
+        nextpage = 0
+        while True:
+            try:
+                exithelper.checkexit()
+            except Exiting:
+                main_logger.debug("Exiting...")
+                break
+            curtime = now()
+            if curtime >= nextpage:
+                self._pagein(curtime + self.window)
+                nextpage = curtime + self.window / 2.
+            due = []
+            with Locker(self.cond):
+                while len(self.heap) > 0 and self.heap[0][0] <= curtime:
+                    due.append(heapq.heappop(self.heap)[2])
+                if len(due) == 0 and not exithelper.stopping():
+                    timeout = nextpage - curtime
+                    if len(self.heap) > 0:
+                        timeout = min(timeout, self.heap[0][0] - curtime)
+                    self.cond.wait(max(timeout, 0))
+            for appname, item in due:
+                self.route(appname, item)
 
 
 class DeviceTokenFormater:
@@ -324,6 +2296,102 @@ class DeviceTokenFormater:
             return ''.join("%02x" % ord(c) for c in devtok)
 
 
+class CircuitBreaker:
+    """
+    Pauses all the agents sending to a gateway while it is failing,
+    instead of each of them retrying on its own.  After `threshold'
+    consecutive failures, the breaker opens: agents wait in acquire()
+    for a cooldown period, or the Retry-After given by the gateway if
+    longer.  Then one of them is let through to probe the gateway while
+    the others keep waiting: the breaker closes if the probe succeeds,
+    otherwise it opens again for twice as long, up to `maxcooldown'
+    seconds.
+    """
+
+    CLOSED = 0
+    OPEN = 1
+    HALFOPEN = 2
+
+    _MINCOOLDOWN = 1
+
+    def __init__(self, logger, name, labels, threshold, maxcooldown):
+        self.l = logger
+        self.name = name
+        self.labels = labels
+        self.threshold = threshold
+        self.maxcooldown = maxcooldown
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.cooldown = 0
+        self.until = 0
+        self.prober = None
+        self.cond = threading.Condition()
+        ExitHelper().onexit(self.cond)
+
+    def acquire(self):
+        """
+        Returns when a request may be sent to the gateway, whose outcome
+        must then be given to success() or failure().  Raises Exiting on
+        exit or if the calling thread is retired.
+        """
+        exithelper = ExitHelper()
+        with Locker(self.cond):
+            while self.state != CircuitBreaker.CLOSED:
+                exithelper.checkexit()
+                if self.state == CircuitBreaker.HALFOPEN:
+                    # Until the probe is done.
+                    self.cond.wait()
+                    continue
+                remaining = self.until - now()
+                if remaining <= 0:
+                    self.state = CircuitBreaker.HALFOPEN
+                    self.prober = threading.current_thread()
+                    self.l.info("Probing %s" % self.name)
+                    return
+                self.cond.wait(remaining)
+
+    def abandon(self):
+        """
+        Tells that the request allowed by acquire() was not sent after
+        all, so that another thread probes the gateway if needed.
+        """
+        with Locker(self.cond):
+            if self.state == CircuitBreaker.HALFOPEN and \
+              self.prober is threading.current_thread():
+                self.state = CircuitBreaker.OPEN
+                self.until = 0
+                self.cond.notify_all()
+
+    def success(self):
+        with Locker(self.cond):
+            self.failures = 0
+            if self.state == CircuitBreaker.CLOSED:
+                return
+            self.l.warning("%s is back, resuming" % self.name)
+            self.state = CircuitBreaker.CLOSED
+            self.cooldown = 0
+            self.cond.notify_all()
+
+    def failure(self, retryafter=0):
+        with Locker(self.cond):
+            self.failures += 1
+            if self.state == CircuitBreaker.CLOSED and \
+              self.failures < self.threshold:
+                return
+            if self.state == CircuitBreaker.OPEN:
+                # A request sent before the breaker opened.
+                self.until = max(self.until, now() + retryafter)
+                return
+            self.cooldown = min(max(self.cooldown * 2,
+                CircuitBreaker._MINCOOLDOWN), self.maxcooldown)
+            delay = max(self.cooldown, retryafter)
+            self.until = now() + delay
+            self.state = CircuitBreaker.OPEN
+            Metrics().incr('push2mob_breaker_opens_total', self.labels)
+            self.l.warning("%s is failing, pausing for %.3fs" %
+                (self.name, delay))
+
+
 class TLSConnectionMaker:
     """
     This is a socket.SSLSocket factory with pre-configured CA, cert
@@ -421,8 +2489,8 @@ class HTTPResponseReceiver:
             if self.lastheader is None:
                 return False
             line = line.strip(" \t")
-            self.headers[self.lastheaders] = \
-              self.headers[self.lastheaders] + " " + line
+            self.headers[self.lastheader] = \
+              self.headers[self.lastheader] + " " + line
             return True
 
         (name, value) = line.split(":", 1)
@@ -455,7 +2523,7 @@ class HTTPResponseReceiver:
                 return
             # XXX Raise an exception or return an error.
             print "ERROR: Unexpected HTTP header format"
-            sys.exist(1)
+            sys.exit(1)
         self.body.append(line)
 
     def getStatus(self):
@@ -478,6 +2546,138 @@ class HTTPResponseReceiver:
         return self.body
 
 
+class Tenant:
+    """
+    A client service sharing the daemon with others, selected with the
+    "tenant" option of the send command.  `weight' is its share of the
+    push queues, `maxrate' the max number of devices it may send to per
+    second and `maxqueued' the max number of devices it may have
+    notifications queued for in each push queue (0 for no limit).
+    """
+
+    def __init__(self, name, weight=1, maxrate=0., maxqueued=0):
+        self.name = name
+        self.weight = weight
+        self.maxrate = maxrate
+        self.maxqueued = maxqueued
+
+
+class TokenBucket:
+    """
+    Allows `rate' units per second, with bursts of up to one second
+    worth of them.  More units than that are allowed at once when the
+    bucket is full, the next ones then wait until they are paid back.
+    This is not thread-safe.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last = now()
+
+    def consume(self, n):
+        """
+        Returns whether `n' units are allowed now.
+        """
+        curtime = now()
+        self.tokens = min(self.rate,
+            self.tokens + (curtime - self.last) * self.rate)
+        self.last = curtime
+        if self.tokens < n and self.tokens < self.rate:
+            return False
+        self.tokens -= n
+        return True
+
+
+class Admission:
+    """
+    Tells the listener when a push queue is too busy to accept more
+    notifications, so that clients slow down before the lag grows out of
+    bounds.  The queue becomes busy when its depth or the estimated time
+    to drain it reaches its high watermark, and stays so until both are
+    below their low watermark; watermarks of 0 are not checked.  The
+    drain time is the depth divided by the rate at which items have
+    been dequeued while the queue was not empty, unknown until then.
+    Notifications of the high lane are accepted anyway.
+    This is not thread-safe, only the listener uses it.
+    """
+
+    # Min interval between two samples of the rate (seconds).
+    _SAMPLEINTERVAL = 1.
+    # Max retry-after returned (seconds).
+    _MAXRETRYAFTER = 60
+
+    def __init__(self, desc, pushq, high=0, low=0, highdrain=0, lowdrain=0):
+        self.desc = desc
+        self.pushq = pushq
+        self.high = high
+        self.low = low
+        self.highdrain = highdrain
+        self.lowdrain = lowdrain
+        self.busy = False
+        # Items dequeued per second, None until known.
+        self.rate = None
+        self.depth = 0
+        self.drain = 0.
+        self.sampletime = now()
+        self.sampledepth = 0
+        self.sampledequeued = pushq.dequeued
+
+    def _sample(self, curtime, depth):
+        elapsed = curtime - self.sampletime
+        if elapsed < self._SAMPLEINTERVAL:
+            return
+        dequeued = self.pushq.dequeued
+        if self.sampledepth > 0 and depth > 0:
+            rate = (dequeued - self.sampledequeued) / elapsed
+            if self.rate is None:
+                self.rate = rate
+            else:
+                self.rate = (self.rate + rate) / 2
+        self.sampletime = curtime
+        self.sampledepth = depth
+        self.sampledequeued = dequeued
+
+    def _draintime(self, depth):
+        if depth == 0:
+            return 0.
+        if self.rate is None:
+            return None
+        if self.rate <= 0:
+            return float('inf')
+        return depth / self.rate
+
+    def _over(self, mark, drainmark):
+        return (mark > 0 and self.depth >= mark) or \
+            (drainmark > 0 and self.drain is not None and
+             self.drain >= drainmark)
+
+    def check(self, lane):
+        """
+        Returns None if notifications of `lane' may be accepted,
+        otherwise the number of seconds after which to retry.
+        """
+        self.depth = self.pushq.qsize()
+        self._sample(now(), self.depth)
+        self.drain = self._draintime(self.depth)
+        if self.busy:
+            self.busy = self._over(self.low, self.lowdrain)
+        else:
+            self.busy = self._over(self.high, self.highdrain)
+        if not self.busy or lane == LANE_HIGH:
+            return None
+        if not self.rate:
+            return self._MAXRETRYAFTER
+        # Until the queue is back below its low watermarks.
+        target = self.depth
+        if self.low > 0:
+            target = min(target, self.low)
+        if self.lowdrain > 0:
+            target = min(target, self.lowdrain * self.rate)
+        retryafter = math.ceil((self.depth - target) / self.rate)
+        return int(min(max(retryafter, 1), self._MAXRETRYAFTER))
+
+
 class Listener(threading.Thread):
     """
     This is the base class for the ZMQ listening socket and
@@ -485,19 +2685,41 @@ class Listener(threading.Thread):
     from the client and either enqueues notifications or sends
     feedback upon demand.
     There ought to be only one instance of this class for each
-    application certificate, though you can make multiple
-    listener connected to a single push/feedback queue pair.
+    service, it serves all the applications configured for it.
+    Commands may be preceded by "name=value" options; the "app"
+    option selects the application the command applies to, the
+    "priority" one the lane of the notifications sent, the "tenant"
+    one who sends them, whose limits are enforced here, and the "at" one
+    when they are to be sent, in which case they are handed to the
+    Scheduler of the service instead of being queued.
     """
 
     _WHTSP = re.compile("\s+")
     _PLUS = re.compile(r"^\+")
+    _OPTION = re.compile(r"^(\w+)=(\S*)\s+")
+
+    # Options which may precede a command and their default value.
+    _OPTIONS = {
+        'app': DEFAULT_APP,
+        'priority': LANE_NORMAL,
+        'tenant': DEFAULT_TENANT,
+        'at': None
+    }
 
-    def __init__(self, idx, logger, zmqsock):
+    def __init__(self, idx, logger, zmqsock, apps, tenants=None,
+      scheduler=None):
         threading.Thread.__init__(self)
         self.name = "GenericListener%d" % idx
         self.daemon = True
         self.l = logger
         self.zmqsock = zmqsock
+        self.apps = apps
+        self.tenants = tenants
+        if self.tenants is None:
+            self.tenants = {DEFAULT_TENANT: Tenant(DEFAULT_TENANT)}
+        self.buckets = dict((name, TokenBucket(t.maxrate))
+            for name, t in self.tenants.iteritems() if t.maxrate > 0)
+        self.scheduler = scheduler
 
     def _send_error(self, msg, detail = None):
         """
@@ -512,6 +2734,9 @@ class Listener(threading.Thread):
             self.l.warning(fmt, msg)
         self.zmqsock.send("ERROR " + msg)
 
+    def _send_busy(self, retryafter):
+        self.zmqsock.send("BUSY %d" % retryafter)
+
     def _send_ok(self, res):
         if len(res) == 0:
             self.zmqsock.send("OK")
@@ -519,17 +2744,65 @@ class Listener(threading.Thread):
             self.zmqsock.send("OK %s" % res)
 
     @staticmethod
-    def _parse_expiry(expiry):
+    def _parse_expiry(expiry, base=None):
         """
         Parse expiry handling absolute format (seconds Epoch) or
-        relative format (starting with "+").
+        relative format (starting with "+"), relative to `base' if
+        given, otherwise to the current time.
         """
         expiry, nsub = re.subn(Listener._PLUS, "", expiry, 1)
         expiry = int(expiry)
         if nsub == 1:
-            expiry = now() + expiry
+            if base is None:
+                base = now()
+            expiry = base + expiry
         return expiry
 
+    def _parse_options(self, msg):
+        """
+        Strip the options preceding the command.
+        Returns a tuple (opts, msg), `opts' being an AttributeHolder
+        whose "app" and "tenant" attributes are the application and
+        Tenant objects, and whose "at" attribute is the time when the
+        notifications are to be sent, or None to send them right away.
+        """
+        opts = dict(self._OPTIONS)
+        while True:
+            m = Listener._OPTION.match(msg)
+            if m is None:
+                break
+            name, value = m.group(1, 2)
+            if name not in opts:
+                raise ValueError("unknown option %s" % name)
+            opts[name] = value
+            msg = msg[m.end():]
+
+        app = self.apps.get(opts['app'])
+        if app is None:
+            raise ValueError("unknown application %s" % opts['app'])
+        opts['app'] = app
+        if opts['priority'] not in LANES:
+            raise ValueError("unknown priority %s" % opts['priority'])
+        tenant = self._tenant(opts['tenant'])
+        if tenant is None:
+            raise ValueError("unknown tenant %s" % opts['tenant'])
+        opts['tenant'] = tenant
+        if opts['at'] is not None:
+            try:
+                at = Listener._parse_expiry(opts['at'])
+            except ValueError:
+                raise ValueError("invalid time %s" % opts['at'])
+            # Already due.
+            opts['at'] = at if at > now() else None
+        return (AttributeHolder(**opts), msg)
+
+    def _tenant(self, name):
+        """
+        Returns the Tenant object named `name', or None if it is
+        unknown.
+        """
+        return self.tenants.get(name)
+
     def _parse_send_args(self, nargs, msg):
         """
         Parse the send command with a variable number of mandatory
@@ -557,71 +2830,429 @@ class Listener(threading.Thread):
             raise IndexError("wrong number of arguments")
         return (arglist, devlist, payload)
 
-    def _parse_send(self, msg):
+    def _parse_send(self, opts, msg):
         """
         Parse the send command.  You must overload this method.
         """
 
-    def _perform_send(self):
+    def _pushq(self, opts):
+        """
+        Returns the push queue of a send command.  You must overload
+        this method.
+        """
+
+    def _admit(self, opts, ndevices):
+        """
+        Enforces the limits of the tenant of a send command to `ndevices'
+        devices.  Returns an error message if it is over one of them,
+        None otherwise.
+        """
+        tenant = opts.tenant
+        if tenant.maxqueued > 0 and tenant.maxqueued < ndevices + \
+          self._pushq(opts).queued(tenant.name):
+            reason = "quota"
+            msg = "Tenant %s has too many notifications queued " \
+                "(max %d devices)" % (tenant.name, tenant.maxqueued)
+        elif tenant.name in self.buckets and \
+          not self.buckets[tenant.name].consume(ndevices):
+            reason = "rate"
+            msg = "Tenant %s sends too fast (max %g devices/s)" % \
+                (tenant.name, tenant.maxrate)
+        else:
+            return None
+        Metrics().incr('push2mob_tenant_rejected_total',
+            (('service', self._SERVICE), ('tenant', tenant.name),
+            ('reason', reason)))
+        return msg
+
+    def _busy(self, opts):
+        """
+        Returns None if the push queue of a send command accepts its
+        notifications, otherwise the number of seconds after which the
+        client should retry (see Admission).
+        """
+        admission = self._pushq(opts).admission
+        if admission is None:
+            return None
+        wasbusy = admission.busy
+        retryafter = admission.check(opts.priority)
+        if admission.busy != wasbusy:
+            if admission.drain is None:
+                drain = "unknown drain time"
+            elif admission.drain == float('inf'):
+                drain = "not draining"
+            else:
+                drain = "drained in %.0fs" % admission.drain
+            self.l.warning("%s is %s (%d notifications, %s)" %
+                (admission.desc, "busy, only accepting high priority " \
+                "notifications" if admission.busy else "not busy anymore",
+                admission.depth, drain))
+        if retryafter is not None:
+            Metrics().incr('push2mob_busy_total',
+                (('service', self._SERVICE), ('app', opts.app.name)))
+        return retryafter
+
+    def _perform_send(self, opts, arglist, devtoks, payload):
+        """
+        Self-explanatory.  You must overload this method.
+        Returns the reply or None if an error message has already been
+        issued.
+        """
+        pass
+
+    def _perform_feedback(self, opts):
         """
         Self-explanatory.  You must overload this method.
+        Returns the reply or None if an error message has already been
+        issued.
         """
         pass
 
-    def _perform_feedback(self):
+    def _perform_other(self, opts, msg):
+        """
+        Handles commands other than "send" and "feedback".  Returns the
+        reply, None if an error message has already been issued or
+        False if the command is unknown.
+        """
+        if msg.lower() == "stats":
+            return Metrics().stats()
+        if msg.lower() == "trace":
+            return Tracer().dump(self._SERVICE)
+        return False
+
+    def run(self):
+        exithelper = ExitHelper()
+        exithelper.register()
+        poller = zmq.Poller()
+        poller.register(self.zmqsock, zmq.POLLIN)
+        poller.register(exithelper.fileno(), zmq.POLLIN)
+        while True:
+            # There is a small window where we can lose a request, but
+            # we wouldn't have answered anything to the client so we
+            # it is responsible to retry later.
+            try:
+                while True:
+                    exithelper.checkexit()
+                    if self.zmqsock in dict(poller.poll()):
+                        break
+            except Exiting:
+                self.l.debug("Exiting...")
+                break
+
+            msg = self.zmqsock.recv()
+            # Start of the trace of notifications.
+            self.received = now()
+            #
+            # Parse line.
+            msg = msg.strip()
+            self.l.debug("Got command: %s", msg)
+            try:
+                opts, msg = self._parse_options(msg)
+            except Exception as e:
+                self._send_error("Invalid option (%s)" % e, msg)
+                continue
+
+            if msg[0:5].lower().find("send ") == 0:
+                try:
+                    res = self._parse_send(opts, msg)
+                except Exception as e:
+                    self._send_error("Invalid input (%s)" % e , msg)
+                    continue
+                # An error message has already been issued.
+                if res is None:
+                    continue
+                if opts.at is None:
+                    retryafter = self._busy(opts)
+                    if retryafter is not None:
+                        self._send_busy(retryafter)
+                        continue
+                err = self._admit(opts, len(res[1]))
+                if err is not None:
+                    self._send_error(err)
+                    continue
+
+                res = self._perform_send(opts, *res)
+                if res is not None:
+                    self._send_ok(res)
+                continue
+
+            elif msg.lower().find("feedback") == 0:
+                res = self._perform_feedback(opts)
+                if res is not None:
+                    self._send_ok(res)
+                continue
+
+            res = self._perform_other(opts, msg)
+            if res is False:
+                self._send_error("Invalid input", msg)
+            elif res is not None:
+                self._send_ok(res)
+
+
+#############################################################################
+# APNS stuff.
+#############################################################################
+
+APNS_DEVTOKLEN = 32
+
+def apns_deadline(apnsmsg):
+    """
+    Returns the deadline of an item of the APNS push queue, for use
+    with CheckpointableDeadlineQueue.  Notifications whose expiry was
+    already in the past when they were received are meant to be tried
+    once by APNS, so they never become stale.
+    """
+    uid, creation, expiry, devtok, payload, lane, tenant = apnsmsg
+    if expiry <= creation:
+        return None
+    return expiry
+
+def apns_discard(completions, appname):
+    """
+    Returns the function to which CheckpointableDeadlineQueue passes
+    the stale items of the APNS push queue of application `appname',
+    which counts them and reports them to `completions' as discarded.
+    """
+    def discard(apnsmsg, when):
+        uid, creation, expiry, devtok, payload, lane, tenant = apnsmsg
+        Metrics().incr('push2mob_stale_dropped_total', (('service', 'apns'),
+            ('app', appname), ('when', when)))
+        completions('apns', appname, uid, creation, OUTCOME_DISCARDED,
+            (devtok, ), tenant)
+    return discard
+
+def apns_upgrade(apnsmsg):
+    """
+    Converts an item of the APNS push queue restored from the database:
+    those checkpointed by an older version have no lane nor tenant.
+    """
+    if len(apnsmsg) < 7:
+        return apnsmsg + (LANE_NORMAL, DEFAULT_TENANT)[len(apnsmsg) - 5:]
+    return apnsmsg
+
+def apns_sizeof(apnsmsg):
+    """
+    Returns an estimate of the memory used by an item of the APNS push
+    queue in bytes, for use with MemoryBudget: the tuple, its numbers
+    and its device token and payload strings.
+    """
+    return 300 + len(apnsmsg[4])
+
+class APNSDuplicateFilter:
+    """
+    Remembers the notifications received during the last `window'
+    seconds by device token and payload, so that the same notification
+    sent again to the same device can be dropped.  Entries are kept in
+    two dictionaries rotated every `window' seconds, so memory is
+    bounded by the notifications of the last two windows.
+    We do not need any locking as each object is accessed by only
+    one thread (APNSListener).
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.tstamp = now()
+        self.entries = [{}, {}]
+        self.i = 0
+
+    @staticmethod
+    def payloadhash(payload):
+        return hashlib.md5(payload).digest()[:8]
+
+    def _rotate(self, curtime):
+        if curtime - self.tstamp >= self.window:
+            self.i = (self.i + 1) % 2
+            self.entries[self.i] = {}
+            self.tstamp = curtime
+
+    def check(self, devtok, payloadhash, curtime):
+        """
+        Returns the id of the same notification if it was received
+        within the window, otherwise None.
+        """
+        self._rotate(curtime)
+        key = devtok + payloadhash
+        for entries in self.entries:
+            e = entries.get(key)
+            if e is not None and curtime - e[1] <= self.window:
+                return e[0]
+        return None
+
+    def record(self, devtok, payloadhash, uid, curtime):
+        """
+        Records the notification as `uid', once it has been accepted.
+        """
+        self.entries[self.i][devtok + payloadhash] = (uid, curtime)
+
+
+class APNSDeviceThrottle:
+    """
+    Limits the notifications sent to each device token to `rate' per
+    minute, allowing bursts of `burst' notifications, with the generic
+    cell rate algorithm: each device token has a theoretical arrival
+    time, pushed back by 60/rate seconds for each notification, and a
+    notification arriving more than the burst tolerance before it has
+    to wait.
+    Theoretical arrival times are kept in deciseconds in a fixed array
+    of `slots' 32-bit integers, so that memory is bounded whatever the
+    number of device tokens: each device token hashes to two slots,
+    both raised to its new arrival time, and the smallest of them is
+    its arrival time.  Collisions can only make it later, i.e. a device
+    throttled a little early, and slots in the past are as good as
+    free, so only the device tokens notified recently compete for them.
+    We do not need any locking as each object is accessed by only
+    one thread (APNSListener).
+    """
+
+    def __init__(self, rate, burst, slots):
+        self.interval = int(math.ceil(600 / rate))
+        self.tolerance = self.interval * (burst - 1)
+        self.slots = array.array('I', [0]) * slots
+        self.epoch = now()
+
+    def check(self, devtok, curtime, maxdelay):
+        """
+        Returns how long the notification to `devtok' must be delayed
+        in seconds, 0 if it can be sent now, and records it.  Returns
+        None without recording it if this is more than `maxdelay'.
+        """
+        slots = self.slots
+        h = hash(devtok)
+        i = h % len(slots)
+        j = (h >> 32) % len(slots)
+        t = int((curtime - self.epoch) * 10)
+        tat = max(min(slots[i], slots[j]), t)
+        delay = max(tat - t - self.tolerance, 0)
+        if delay > maxdelay * 10:
+            return None
+        tat += self.interval
+        if slots[i] < tat:
+            slots[i] = tat
+        if slots[j] < tat:
+            slots[j] = tat
+        return delay / 10.
+
+
+class APNSInvalidTokens:
+    """
+    Device tokens of an application reported as invalid by the feedback
+    service or by an error response, so that the listener drops the
+    notifications sent to them instead of spending a frame, and the
+    connection for error responses.  They are kept in memory as raw
+    32-byte strings and in the `dbinfo.table' table with the time they
+    were reported, and forgotten after `retention' seconds in case the
+    device registered again with the same token.
+    Lookups don't need locking, adding and forgetting device tokens is
+    done by the feedback queue and APNSFeedbackAgent.
+    """
+
+    def __init__(self, dbinfo, retention):
+        self.mutex = threading.Lock()
+        self.table = dbinfo.table
+        self.retention = retention
+        self.conn = sqlite3.connect(dbinfo.db, check_same_thread=False)
+        self.conn.isolation_level = None
+        # The feedback service may report many device tokens at once,
+        # and losing the last ones on a crash is harmless.
+        self.conn.execute("PRAGMA synchronous = OFF")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS %s (
+            devtok BLOB PRIMARY KEY NOT NULL,
+            reported REAL NOT NULL)""" % self.table)
+        self.conn.execute(
+            """CREATE INDEX IF NOT EXISTS %s_reported ON %s (
+            reported)""" % (self.table, self.table))
+        self.devtoks = set()
+        self.purge()
+        self.devtoks = set(str(row[0]) for row in
+            self.conn.execute("SELECT devtok FROM %s" % self.table))
+
+    @staticmethod
+    def raw(devtok):
+        """
+        Returns the raw device token of `devtok', given in hexadecimal
+        or in base64, or None if it is not valid.
+        """
+        try:
+            if len(devtok) == APNS_DEVTOKLEN * 2:
+                rawtok = devtok.decode('hex')
+            else:
+                rawtok = base64.standard_b64decode(devtok)
+        except TypeError:
+            return None
+        if len(rawtok) != APNS_DEVTOKLEN:
+            return None
+        return rawtok
+
+    def __contains__(self, rawtok):
+        return rawtok in self.devtoks
+
+    def __len__(self):
+        return len(self.devtoks)
+
+    def add(self, rawtok):
+        with Locker(self.mutex):
+            self.conn.execute("INSERT OR REPLACE INTO %s (devtok, reported) " \
+                "VALUES (?, ?)" % self.table, (buffer(rawtok), time.time()))
+            self.devtoks.add(rawtok)
+
+    def purge(self):
         """
-        Self-explanatory.  You must overload this method.
+        Forgets the device tokens reported more than `retention' seconds
+        ago.
         """
-        pass
+        cutoff = time.time() - self.retention
+        with Locker(self.mutex):
+            rows = self.conn.execute("SELECT devtok FROM %s " \
+                "WHERE reported < ?" % self.table, (cutoff, )).fetchall()
+            if len(rows) == 0:
+                return
+            self.conn.execute("DELETE FROM %s WHERE reported < ?" %
+                self.table, (cutoff, ))
+            for row in rows:
+                self.devtoks.discard(str(row[0]))
 
-    def run(self):
-        exithelper = ExitHelper()
-        exithelper.register()
-        while True:
-            # There is a small window where we can lose a request, but
-            # we wouldn't have answered anything to the client so we
-            # it is responsible to retry later.
-            try:
-                while True:
-                    exithelper.checkexit()
-                    if self.zmqsock.poll(1000):
-                        break
-            except Exiting:
-                self.l.debug("Exiting...")
-                break
 
-            msg = self.zmqsock.recv()
-            #
-            # Parse line.
-            msg = msg.strip()
-            self.l.debug("Got command: %s" % msg)
-            if msg[0:5].lower().find("send ") == 0:
-                try:
-                    res = self._parse_send(msg)
-                except Exception as e:
-                    self._send_error("Invalid input (%s)" % e , msg)
-                    continue
-                # An error message has already been issued.
-                if res is None:
-                    continue
+class APNSFeedbackQueue(CheckpointableQueue):
+    """
+    Feedback queue of an APNS application, holding (timestamp, device
+    token) tuples until the "feedback" command retrieves them.  A device
+    token which is still in the queue is not queued again, as it may be
+    reported by each notification sent to it.  Device tokens put in the
+    queue are recorded in `invalid' (APNSInvalidTokens), if any.
+    """
 
-                res = self._perform_send(*res)
-                self._send_ok(res)
-                continue
+    def __init__(self, dbinfo, restoredfirst=True, invalid=None):
+        self.invalid = invalid
+        self.devtoks = set()
+        CheckpointableQueue.__init__(self, dbinfo, restoredfirst)
 
-            elif msg.lower().find("feedback") == 0:
-                res = self._perform_feedback()
-                self._send_ok(res)
-                continue
+    def put(self, item, block=True, timeout=None):
+        if self.invalid is not None:
+            rawtok = APNSInvalidTokens.raw(item[1])
+            if rawtok is not None:
+                self.invalid.add(rawtok)
+        CheckpointableQueue.put(self, item, block, timeout)
 
-            self._send_error("Invalid input", msg)
+    def _put(self, item):
+        if item[1] in self.devtoks:
+            return
+        self.devtoks.add(item[1])
+        CheckpointableQueue._put(self, item)
 
+    def _get(self):
+        item = CheckpointableQueue._get(self)
+        self.devtoks.discard(item[1])
+        return item
 
-#############################################################################
-# APNS stuff.
-#############################################################################
+    def _restore_items(self, items):
+        kept = []
+        for item in items:
+            if item[1] not in self.devtoks:
+                self.devtoks.add(item[1])
+                kept.append(item)
+        CheckpointableQueue._restore_items(self, kept)
 
-APNS_DEVTOKLEN = 32
 
 class APNSRecentNotifications:
     """
@@ -635,15 +3266,18 @@ class APNSRecentNotifications:
     """
 
     def __init__(self, maxerrorwait):
+        self.setmaxerrorwait(maxerrorwait)
+        self.tstamp = now()
+        self.n = [{}, {}]
+        self.i = 0
+
+    def setmaxerrorwait(self, maxerrorwait):
         if maxerrorwait != 0:
             # For an error wait of 0.1 seconds, this
             # will rotate the dicts every minute.
             self.rotatetime = 600 * maxerrorwait
         else:
             self.rotatetime = 10
-        self.tstamp = now()
-        self.n = [{}, {}]
-        self.i = 0
 
     def _rotate(self):
         # This part should be protected by a mutex if the object was
@@ -662,7 +3296,7 @@ class APNSRecentNotifications:
     def lookup(self, ident):
         self._rotate()
         i0 = self.i
-        i1 = (i + 1) % 2
+        i1 = (i0 + 1) % 2
         n = self.n[i0].get(ident)
         if n is None:
             n = self.n[i1].get(ident)
@@ -696,26 +3330,49 @@ class APNSAgent(threading.Thread):
         255: "None (unknown)"
     }
 
-    def __init__(self, idx, logger, devtokfmt, pushq, gateway,
-        maxerrorwait, feedbackq, tlsconnect):
+    def __init__(self, idx, logger, devtokfmt, app, maxerrorwait,
+        completions):
 
         threading.Thread.__init__(self)
-        self.name = "Agent%d" % idx
+        self.name = appthreadname(app, "Agent%d" % idx)
         self.daemon = True
         self.l = logger
         self.devtokfmt = devtokfmt
-        self.pushq = pushq
-        self.gateway = gateway
+        self.appname = app.name
+        self.completions = completions
+        self.pushq = app.pushq
+        self.gateway = app.push_gateway
         self.maxerrorwait = maxerrorwait
-        self.feedbackq = feedbackq
-        self.tlsconnect = tlsconnect
+        self.feedbackq = app.feedbackq
+        self.tlsconnect = app.tlsconnect
+        self.breaker = app.breaker
         # Tuple: (id, bintok)
         self.recentnotifications = APNSRecentNotifications(maxerrorwait)
         self.sock = None
+        self.metrics = Metrics()
+        self.tracer = Tracer()
+        self.labels = (('app', app.name),)
 
     def _connect(self):
-        self.sock = self.tlsconnect(self.gateway, APNSAgent._RETRYTIME,
-            "Couldn't connect to APNS (%s:%d): %s")
+        """
+        Connects to the push gateway, retrying until it succeeds.  With a
+        circuit breaker, raises Exiting on exit while it is open.
+        """
+        if self.breaker is None:
+            self.metrics.incr('push2mob_apns_connects_total', self.labels)
+            self.sock = self.tlsconnect(self.gateway, APNSAgent._RETRYTIME,
+                "Couldn't connect to APNS (%s:%d): %s")
+        else:
+            while True:
+                self.breaker.acquire()
+                self.metrics.incr('push2mob_apns_connects_total',
+                    self.labels)
+                self.sock = self.tlsconnect(self.gateway, 0,
+                    "Couldn't connect to APNS (%s:%d): %s")
+                if self.sock is not None:
+                    self.breaker.success()
+                    break
+                self.breaker.failure()
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
 
     def _close(self):
@@ -744,6 +3401,8 @@ class APNSAgent(threading.Thread):
             return True
         # Bad...
         cmd, st, errident = struct.unpack(fmt, buf)
+        self.metrics.incr('push2mob_apns_errors_total',
+            self.labels + (('status', str(st)),))
         errdevtok = self.recentnotifications.lookup(errident)
         if errdevtok is None:
             errdevtok = "unknown"
@@ -751,8 +3410,8 @@ class APNSAgent(threading.Thread):
             errdevtok = self.devtokfmt(errdevtok)
         if st == APNSAgent._INVALIDTOKENSTATUS:
             self.feedbackq.put((0, errdevtok))
-            self.l.info("Notification #%d to %s response: %s" %
-                (errident, errdevtok, APNSAgent._error_responses[st]))
+            self.l.info("Notification #%d to %s response: %s",
+                errident, errdevtok, APNSAgent._error_responses[st])
         else:
             estr = APNSAgent._error_responses.get(st)
             if estr is None:
@@ -774,6 +3433,20 @@ class APNSAgent(threading.Thread):
         self._close()
         return r
 
+    @staticmethod
+    def _frame(uid, expiry, bintok, payload):
+        """
+        Builds the binary message of a notification.
+        """
+        fmt = '> B II' + 'H' + str(len(bintok)) + 's' + \
+            'H' + str(len(payload)) + 's'
+        # We provide an absolute expiry to APNS which may be in the
+        # past, in which case APNS tries only once.  Notifications
+        # which became stale while waiting in the queue are discarded
+        # beforehand if deadline scheduling is enabled.
+        return struct.pack(fmt, APNSAgent._EXTENDEDNOTIFICATION, uid,
+            expiry, len(bintok), bintok, len(payload), payload)
+
     def run(self):
         exithelper = ExitHelper()
         exithelper.register()
@@ -789,16 +3462,13 @@ class APNSAgent(threading.Thread):
                     if self.sock is None:
                         timeout = None
 
-                    countdown = timeout if timeout is not None else 0xFFFFFFFF
-                    while countdown > 0 and apnsmsg is None:
-                        exithelper.checkexit()
-                        try:
-                            apnsmsg = self.pushq.get(True, 1)
-                        except Queue.Empty:
-                            countdown -= 1
-
-                    if apnsmsg is not None:
+                    exithelper.checkexit()
+                    try:
+                        apnsmsg = self.pushq.get(True, timeout)
                         break
+                    except Queue.Empty:
+                        # Woken up on exit.
+                        exithelper.checkexit()
 
                     triple = select.select([self.sock], [], [], 0)
                     if len(triple[0]) != 0:
@@ -815,135 +3485,164 @@ class APNSAgent(threading.Thread):
                 self.l.debug("Exiting...")
                 break
 
-            uid, creation, expiry, devtok, payload = apnsmsg
+            uid, creation, expiry, devtok, payload, lane, tenant = apnsmsg
+            traced = self.tracer.sampled(uid)
+            if traced:
+                self.tracer.mark('apns', uid, 'dequeued')
             bintok = base64.standard_b64decode(devtok)
-
-            # Build the binary message.
-            fmt = '> B II' + 'H' + str(len(bintok)) + 's' + \
-                'H' + str(len(payload)) + 's'
-            # XXX Should we check the expiry?  We provide an absolute value
-            # to APNS which may be in the past.  This is harmless though.
-            binmsg = struct.pack(fmt, APNSAgent._EXTENDEDNOTIFICATION, uid,
-                expiry, len(bintok), bintok, len(payload), payload)
+            binmsg = APNSAgent._frame(uid, expiry, bintok, payload)
             if DUMP_QUERIES:
-                self.l.debug("Notification #%d: %s", (uid, hexdump(binmsg)))
+                self.l.debug("Notification #%d: %s", uid, hexdump(binmsg))
+            if traced:
+                self.tracer.mark('apns', uid, 'built')
 
             # Now send it.
-            if self.sock is None:
-                self._connect()
-
-            trial = 0
-            while trial < APNSAgent._MAXTRIAL:
-                try:
-                    self.sock.sendall(binmsg)
-                    break
-                except socket.error as e:
-                    self._processerror()
-                    trial = trial + 1
-                    self.l.debug("Retry (%d) to send notification "
-                        "#%d to %s (previous attempt failed with: %s)" %
-                        (trial, uid, self.devtokfmt(bintok), e))
+            try:
+                if self.sock is None:
                     self._connect()
-                    continue
+
+                trial = 0
+                while trial < APNSAgent._MAXTRIAL:
+                    try:
+                        sendtime = now()
+                        self.sock.sendall(binmsg)
+                        self.metrics.record('push2mob_gateway_seconds',
+                            (('service', 'apns'),), now() - sendtime)
+                        break
+                    except socket.error as e:
+                        self._processerror()
+                        trial = trial + 1
+                        self.metrics.incr('push2mob_retries_total',
+                            (('service', 'apns'),))
+                        self.l.debug("Retry (%d) to send notification "
+                            "#%d to %s (previous attempt failed with: %s)",
+                            trial, uid, self.devtokfmt(bintok), e)
+                        self._connect()
+                        continue
+            except Exiting:
+                # The gateway is down, the notification is kept.
+                self.pushq.put(apnsmsg)
+                self.l.debug("Exiting...")
+                break
             if trial == APNSAgent._MAXTRIAL:
                 self.l.warning("Cannot send notification #%d to %s, "
                     "abording" % (uid, self.devtokfmt(bintok)))
+                self.completions('apns', self.appname, uid, creation,
+                    OUTCOME_FAILED, (devtok,), tenant)
                 continue
             self.recentnotifications.record(uid, bintok)
+            if traced:
+                self.tracer.mark('apns', uid, 'written')
 
             lag = now() - creation
-            self.l.info("Notification #%d sent delayed by %.3fs" % (uid, lag))
+            self.l.log(NOTIFICATION_LOGLEVEL,
+                "Notification #%d sent delayed by %.3fs", uid, lag)
+            self.completions('apns', self.appname, uid, creation,
+                OUTCOME_SENT, (devtok,), tenant)
 
             if self.maxerrorwait != 0:
                 # Receive a possible error in the preceeding message.
                 triple = select.select([self.sock], [], [], self.maxerrorwait)
                 if len(triple[0]) != 0:
                     self._processerror()
+                if traced:
+                    self.tracer.mark('apns', uid, 'errorwindow')
 
 
 class APNSFeedbackAgent(threading.Thread):
     """
-    There ought to be only one instance of this class, at least
-    for each application certificate.
+    There ought to be only one instance of this class, it serves
+    all applications one after the other.
     It periodically check the APNS feedback service and 
     creates feedback entries for it.
     """
 
-    def __init__(self, idx, logger, devtokfmt, feedbackq, sock, gateway,
-        frequency, tlsconnect):
+    def __init__(self, idx, logger, devtokfmt, apps, frequency):
         threading.Thread.__init__(self)
         self.name = "Feedback%d" % idx
         self.daemon = True
-        self.sock = sock
         self.l = logger
         self.devtokfmt = devtokfmt
-        self.feedbackq = feedbackq
-        self.gateway = gateway
+        self.apps = apps
         self.frequency = frequency
-        self.tlsconnect = tlsconnect
         self.fmt = '> IH ' + str(APNS_DEVTOKLEN) + 's'
         self.tuplesize = struct.calcsize(self.fmt)
 
-    def _close(self):
-        self.sock.shutdown(socket.SHUT_RD)
-        self.sock.close()
-        self.sock = None
+    def _close(self, app):
+        try:
+            app.feedbacksock.shutdown(socket.SHUT_RD)
+        except socket.error:
+            # Already shut down by the other side.
+            pass
+        app.feedbacksock.close()
+        app.feedbacksock = None
+
+    def _retrieve(self, app, exithelper):
+        # app.feedbacksock is not None on the first run because we
+        # inherits the socket from the main thread (which has been
+        # used for testing purpose).
+        if app.feedbacksock is None:
+            # Don't retry, a failing application must not prevent the
+            # other ones from getting their feedback.
+            app.feedbacksock = app.tlsconnect(app.feedback_gateway, 0,
+                "Couldn't connect to feedback service (%s:%d): %s")
+            if app.feedbacksock is None:
+                return
+
+        buf = ""
+        while True:
+            # 10 seconds should be enough for APNS to send something!
+            b = None
+            deadline = now() + 10
+            while now() < deadline:
+                exithelper.checkexit()
+                if len(exithelper.select([app.feedbacksock],
+                  deadline - now())) == 0:
+                    continue
+                try:
+                    b = app.feedbacksock.recv()
+                except socket.error as e:
+                    self.l.debug("Feedback connection has been shut down " \
+                        "abruptly: %s" % e)
+                    b = ""
+                if len(b) == 0 and len(buf) != 0:
+                    self.l.warning("Unexpected trailing garbage " \
+                        "from feedback service (%d bytes remaining)" %
+                        len(buf))
+                    hexdump(buf)
+                break
+            if b is None or len(b) == 0:
+                break
+
+            buf = buf + b
+            while True:
+                try:
+                    bintuple = buf[0:self.tuplesize]
+                except IndexError as e:
+                    break
+                if len(bintuple) < self.tuplesize:
+                    break
+                buf = buf[self.tuplesize:]
+                ts, toklen, bintok = struct.unpack(self.fmt, bintuple)
+                devtok = self.devtokfmt(bintok)
+                ts = str(ts)
+                self.l.info("New feedback tuple for application %s " \
+                    "(%s, %s)" % (app.name, ts, devtok))
+                app.feedbackq.put((ts, devtok))
+
+        self._close(app)
 
     def run(self):
         exithelper = ExitHelper()
         exithelper.register()
         while True:
             try:
-                # self.sock is not None on the first run because we
-                # inherits the socket from the main thread (which has
-                # been used for testing purpose).
-                if self.sock is None:
-                    countdown = self.frequency
-                    while countdown > 0:
-                        exithelper.checkexit() 
-                        time.sleep(1)
-                        countdown -= 1
-
-                    self.sock = self.tlsconnect(self.gateway, self.frequency,
-                        "Couldn't connect to feedback service (%s:%d): %s")
-
-                buf = ""
-                while True:
-                    # 10 seconds should be enough for APNS to send something!
-                    b = None
-                    for i in range(10):
-                        exithelper.checkexit() 
-                        triple = select.select([self.sock], [], [], 1)
-                        if len(triple[0]) == 0:
-                            continue
-                        b = self.sock.recv()
-                        if len(b) == 0:
-                            if len(buf) != 0:
-                                self.l.warning("Unexpected trailing garbage " \
-                                    "from feedback service (%d bytes remaining)" %
-                                    len(buf))
-                                hexdump(buf)
-                            break
-                    if b is None or len(b) == 0:
-                        break
+                for app in self.apps:
+                    self._retrieve(app, exithelper)
+                    if app.invalid is not None:
+                        app.invalid.purge()
 
-                    buf = buf + b
-                    while True:
-                        try:
-                            bintuple = buf[0:self.tuplesize]
-                        except IndexError as e:
-                            break
-                        if len(bintuple) < self.tuplesize:
-                            break
-                        buf = buf[self.tuplesize:]
-                        ts, toklen, bintok = struct.unpack(self.fmt, bintuple)
-                        devtok = self.devtokfmt(bintok)
-                        ts = str(ts)
-                        self.l.info("New feedback tuple (%s, %s)" %
-                            (ts, devtok))
-                        self.feedbackq.put((ts, devtok))
-
-                self._close()
+                exithelper.sleep(self.frequency)
             except Exiting:
                 self.l.debug("Exiting...")
                 break
@@ -957,28 +3656,68 @@ class APNSListener(Listener):
     enhanced notification format.
     """
 
+    _SERVICE = 'apns'
     _PAYLOADMAXLEN = 256
 
-    def __init__(self, idx, logger, zmqsock, pushq, feedbackq):
-        Listener.__init__(self, idx, logger, zmqsock)
+    def __init__(self, idx, logger, zmqsock, apps, dedupwindow=0,
+      tenants=None, scheduler=None, throttle=None):
+        Listener.__init__(self, idx, logger, zmqsock, apps, tenants,
+            scheduler)
         self.name = "Listener%d" % idx
         self.l = logger
-        self.pushq = pushq
-        self.feedbackq = feedbackq
         self.uid = random.randint(0, 2**32)
-
-    def _parse_send(self, msg):
+        # Duplicate filters by application.
+        self.dedups = {}
+        if dedupwindow > 0:
+            for name in apps:
+                self.dedups[name] = APNSDuplicateFilter(dedupwindow)
+        # Device throttles by application, `throttle' holding their
+        # rate, burst, slots and the max delay of notifications over
+        # the rate, which are dropped beyond it.
+        self.throttles = {}
+        self.maxdelay = 0
+        if throttle is not None:
+            for name in apps:
+                self.throttles[name] = APNSDeviceThrottle(throttle.rate,
+                    throttle.burst, throttle.slots)
+            if scheduler is not None:
+                self.maxdelay = throttle.maxdelay
+
+    def _parse_send(self, opts, msg):
         arglist, devtoks, payload = Listener._parse_send_args(self, 1, msg)
 
         # Check expiry.
         try:
-            expiry = Listener._parse_expiry(arglist[0])
+            expiry = Listener._parse_expiry(arglist[0], opts.at)
         except Exception as e:
             self._send_error("Invalid expiry value: %s" % arglist[0])
             return None
         arglist = [expiry]
 
-        # Check device token format.
+        devtoks = self._parse_devtoks(devtoks)
+        if devtoks is None:
+            return None
+
+        # Check payload length.
+        if len(payload) > APNSListener._PAYLOADMAXLEN:
+            self._send_error("Payload too long (%d > %d)" %
+                (len(payload), APNSListener._PAYLOADMAXLEN), payload)
+            return None
+
+        obj = jsonload(payload)
+        if obj is None:
+            self._send_error("Invalid JSON payload: %s" % payload)
+            return None
+
+        # Mimic _parse_send_args() return value.
+        return (arglist, devtoks, payload)
+
+    def _parse_devtoks(self, devtoks):
+        """
+        Checks the format of device tokens given either in hexadecimal
+        or in base64.  Returns them in base64, or None if an error
+        message has already been issued.
+        """
         goodtoks = []
         for dt in devtoks:
             devtok = ''
@@ -1002,43 +3741,106 @@ class APNSListener(Listener):
             # Store the token in base64 in the queue, text is better
             # to debug.
             goodtoks.append(base64.standard_b64encode(devtok))
-        devtoks = goodtoks
+        return goodtoks
 
-        # Check payload length.
-        if len(payload) > APNSListener._PAYLOADMAXLEN:
-            self._send_error("Payload too long (%d > %d)" % len(payload),
-                APNSListener._PAYLOADMAXLEN, payload)
-            return None
+    def _pushq(self, opts):
+        return opts.app.pushq
 
-        obj = jsonload(payload)
-        if obj is None:
-            self._send_error("Invalid JSON payload: %s" % payload)
+    def _perform_send(self, opts, arglist, devtoks, payload):
+        if opts.at is not None and self.scheduler is None:
+            self._send_error("Scheduled delivery not available")
             return None
-
-        # Mimic _parse_send_args() return value.
-        return (arglist, devtoks, payload)
-
-    def _perform_send(self, arglist, devtoks, payload):
         expiry = arglist[0]
+        pushq = opts.app.pushq
+        tracer = Tracer()
+        invalid = opts.app.invalid
+        dedup = self.dedups.get(opts.app.name)
+        if dedup is not None:
+            payloadhash = APNSDuplicateFilter.payloadhash(payload)
+        curtime = now()
+        # Scheduled notifications are not throttled, the arrival times
+        # are those of notifications sent now.
+        throttle = None
+        if opts.at is None:
+            throttle = self.throttles.get(opts.app.name)
+            maxdelay = min(self.maxdelay, max(expiry - curtime, 0))
+        creation = opts.at
+        scheduled = []
 
         idlist = []
         for devtok in devtoks:
+            if invalid is not None and \
+              base64.standard_b64decode(devtok) in invalid:
+                Metrics().incr('push2mob_invalid_tokens_dropped_total',
+                    (('service', 'apns'), ('app', opts.app.name)))
+                idlist.append("!")
+                self.l.debug("Dropped notification for invalid device " \
+                    "token %s of application %s", devtok, opts.app.name)
+                continue
+            if dedup is not None:
+                dupuid = dedup.check(devtok, payloadhash, curtime)
+                if dupuid is not None:
+                    Metrics().incr('push2mob_duplicates_total',
+                        (('service', 'apns'), ('app', opts.app.name)))
+                    idlist.append("=%d" % dupuid)
+                    self.l.debug("Dropped duplicate of notification #%d " \
+                        "for device token %s of application %s",
+                        dupuid, devtok, opts.app.name)
+                    continue
+            delay = 0
+            if throttle is not None:
+                delay = throttle.check(devtok, curtime, maxdelay)
+                if delay is None:
+                    Metrics().incr('push2mob_throttled_total',
+                        (('service', 'apns'), ('app', opts.app.name),
+                         ('action', 'dropped')))
+                    idlist.append("-")
+                    self.l.debug("Dropped notification for device token " \
+                        "%s of application %s over its rate",
+                        devtok, opts.app.name)
+                    continue
             uid = self.uid
             self.uid += 1
-            self.pushq.put((uid, now(), expiry, devtok, payload))
+            # Only notifications given an id are recorded, a dropped one
+            # sent again is not a duplicate.
+            if dedup is not None:
+                dedup.record(devtok, payloadhash, uid, curtime)
+            apnsmsg = (uid, creation or now(), expiry, devtok, payload,
+                opts.priority, opts.tenant.name)
+            if delay > 0:
+                Metrics().incr('push2mob_throttled_total',
+                    (('service', 'apns'), ('app', opts.app.name),
+                     ('action', 'delayed')))
+                self.scheduler.schedule(curtime + delay, opts.app.name,
+                    [apnsmsg])
+                self.l.debug("Notification #%d for device token %s of " \
+                    "application %s over its rate, delayed by %.1fs",
+                    uid, devtok, opts.app.name, delay)
+            elif opts.at is None:
+                pushq.put(apnsmsg)
+            else:
+                scheduled.append(apnsmsg)
+            if tracer.sampled(uid):
+                tracer.mark('apns', uid, 'received', self.received)
+                tracer.mark('apns', uid, 'enqueued')
             idlist.append(str(uid))
-            self.l.debug("Got notification #%d for device token %s, " \
-                "expiring at %d" % (uid, base64.standard_b64encode(devtok), expiry))
+            self.l.debug("Got notification #%d for device token %s " \
+                "of application %s, expiring at %d",
+                uid, devtok, opts.app.name, expiry)
+        if len(scheduled) > 0:
+            self.scheduler.schedule(opts.at, opts.app.name, scheduled)
+            self.l.debug("%d notifications of application %s scheduled " \
+                "at %d", len(scheduled), opts.app.name, opts.at)
         return ' '.join(idlist)
 
-    def _perform_feedback(self):
+    def _perform_feedback(self, opts):
         feedbacks = []
         while True:
             try:
-                qobj = self.feedbackq.get_nowait()
+                qobj = opts.app.feedbackq.get_nowait()
             except Queue.Empty:
                 break
-            timestamp, devtok = qobj.data
+            timestamp, devtok = qobj
             feedbacks.append("%s:%s" % (timestamp, devtok))
         return ' '.join(feedbacks)
 
@@ -1047,6 +3849,178 @@ class APNSListener(Listener):
 # GCM stuff.
 #############################################################################
 
+class GCMNotification(collections.namedtuple('GCMNotification',
+    'uid creation collapsekey expiry delayidle devtoks payload app lane '
+    'tenant payloadsize')):
+    """
+    Item of the GCM push queue.  Its representation can be evaluated
+    back, which is what Checkpointable relies on.
+    Fields added over time have a default value so items checkpointed
+    by an older version can be restored.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def upgrade(cls, item):
+        """
+        Converts an item restored from the database.
+        """
+        if isinstance(item, cls):
+            return item
+        return cls(*item)
+
+    def sizeof(self):
+        """
+        Returns an estimate of the memory used by the notification in
+        bytes, for use with MemoryBudget.  The payload is shared by the
+        notifications of a send command but counted for each of them.
+        Its length is recorded by the listener; it is only serialized
+        again for items checkpointed by an older version.
+        """
+        payloadsize = self.payloadsize
+        if payloadsize == 0:
+            payloadsize = len(json.dumps(self.payload))
+        return 400 + len(self.collapsekey) + \
+            sum(45 + len(d) for d in self.devtoks) + 2 * payloadsize
+
+GCMNotification.__new__.__defaults__ = (DEFAULT_APP, LANE_NORMAL,
+    DEFAULT_TENANT, 0)
+
+
+class GCMCollapseIndex:
+    """
+    Index of the pending GCM notifications of a push queue, shared by
+    its lanes (see GCMCollapsingQueue) so that a notification
+    supersedes the older ones whatever their lane.  Its mutex is taken
+    after the one of any lane.
+    """
+
+    def __init__(self):
+        self.mutex = threading.Lock()
+        # (app, collapse key, registration ID) -> latest pending
+        # notification, without its registration IDs and payload so that
+        # spilled notifications do not stay in memory.
+        self.pending = {}
+        # uid -> registration IDs superseded in a pending notification.
+        self.superseded = {}
+
+
+class GCMCollapsingQueue(CheckpointableTimelySQueue):
+    """
+    GCM push queue where a notification supersedes the pending ones of
+    the same application and collapse key, for the registration IDs
+    they have in common: GCM would only deliver the last one to the
+    device anyway.  Superseded registration IDs are removed from the
+    older notifications when they are dequeued or checkpointed,
+    notifications left without any being dropped, and are reported to
+    `completions' as discarded.
+    The lanes of a push queue share the same `index', a
+    GCMCollapseIndex.
+    """
+
+    def __init__(self, dbinfo, completions, getcond=None, fairness=None,
+      memory=None, index=None):
+        self.index = index
+        if self.index is None:
+            self.index = GCMCollapseIndex()
+        self.completions = completions
+        CheckpointableTimelySQueue.__init__(self, dbinfo, getcond, fairness,
+            memory)
+
+    def _index(self, item):
+        """
+        Records the registration IDs of `item' as pending, superseding
+        those of older notifications.  Returns `item' without the IDs
+        superseded by a newer pending notification (None if none is
+        left) and the list of (notification, superseded IDs).
+        """
+        superseded = {}
+        keep = []
+        ref = item._replace(devtoks=(), payload=None)
+        with Locker(self.index.mutex):
+            for regid in item.devtoks:
+                k = (item.app, item.collapsekey, regid)
+                p = self.index.pending.get(k)
+                if p is not None and p.uid != item.uid:
+                    if (p.creation, p.uid) > (item.creation, item.uid):
+                        # A retried notification older than a pending
+                        # one.
+                        superseded.setdefault(item.uid, (item, []))[1].append(
+                            regid)
+                        continue
+                    self.index.superseded.setdefault(p.uid, set()).add(regid)
+                    superseded.setdefault(p.uid, (p, []))[1].append(regid)
+                self.index.pending[k] = ref
+                keep.append(regid)
+        if len(keep) == 0:
+            item = None
+        elif len(keep) != len(item.devtoks):
+            item = item._replace(devtoks=keep)
+        return item, superseded.values()
+
+    def _filter(self, item, forget=False):
+        with Locker(self.index.mutex):
+            if forget:
+                removed = self.index.superseded.pop(item.uid, None)
+            else:
+                removed = self.index.superseded.get(item.uid)
+        if removed is None:
+            return item
+        devtoks = [d for d in item.devtoks if d not in removed]
+        if len(devtoks) == 0:
+            return None
+        return item._replace(devtoks=devtoks)
+
+    def _release(self, item):
+        """
+        Forgets a dequeued notification and returns it without its
+        superseded registration IDs, or None if none is left.
+        """
+        with Locker(self.index.mutex):
+            for regid in item.devtoks:
+                k = (item.app, item.collapsekey, regid)
+                p = self.index.pending.get(k)
+                if p is not None and p.uid == item.uid:
+                    del self.index.pending[k]
+        return self._filter(item, forget=True)
+
+    def _report(self, superseded):
+        metrics = Metrics()
+        for item, regids in superseded:
+            metrics.incr('push2mob_gcm_collapsed_total', (('app', item.app),),
+                len(regids))
+            self.completions('gcm', item.app, item.uid, item.creation,
+                OUTCOME_DISCARDED, regids, item.tenant)
+
+    def _restore(self, e):
+        when, item = e
+        item, superseded = self._index(self.upgrade(item))
+        self._report(superseded)
+        if item is None:
+            return
+        if self._spills():
+            self.spill.push(item, when)
+        else:
+            self._schedule(when, item)
+
+    def _checkpoint_items(self):
+        for when, item in CheckpointableTimelySQueue._checkpoint_items(self):
+            item = self._filter(item)
+            if item is not None:
+                yield (when, item)
+
+    def put(self, when, item):
+        item, superseded = self._index(item)
+        self._report(superseded)
+        if item is not None:
+            CheckpointableTimelySQueue.put(self, when, item)
+
+    def _released(self, item):
+        item = CheckpointableTimelySQueue._released(self, item)
+        return self._release(item)
+
+
 class GCMFeedbackDatabase:
     """
     This object records all recent changes to registration IDs as reported
@@ -1190,6 +4164,12 @@ class GCMExponentialBackoffDatabase:
         return max(expbackoff, retryafter)
 
     def __init__(self, maxretries):
+        self.setmaxretries(maxretries)
+        self.tstamp = now()
+        self.uids = [{}, {}]
+        self.i = 0
+
+    def setmaxretries(self, maxretries):
         # Compute minimum rotate time with an arbitrary Retry-After
         # header set to 600 seconds.  And just to be sure multiply the
         # result by 2.
@@ -1202,11 +4182,7 @@ class GCMExponentialBackoffDatabase:
             expbackoff = (2 ** i) + 1
             rotatetime = max(600, expbackoff)
         self.rotatetime = rotatetime * 2
-
         self.maxretries = maxretries
-        self.tstamp = now()
-        self.uids = [{}, {}]
-        self.i = 0
 
     def _rotate(self):
         # This part should be protected by a mutex if the object was
@@ -1239,12 +4215,10 @@ class GCMExponentialBackoffDatabase:
 
 class GCMHTTPRequest:
 
-    def __init__(self, server_url, api_key, cacert):
+    def __init__(self, server_url, cacert):
         self.curl = pycurl.Curl()
         self.curl.setopt(pycurl.URL, server_url)
-        self.curl.setopt(pycurl.HTTPHEADER,
-            [ "Content-Type: application/json",
-              "Authorization: key=%s" % api_key ])
+        self.api_key = None
 
         self.curl.setopt(pycurl.HEADER, 1)
         self.curl.setopt(pycurl.FOLLOWLOCATION, 1)
@@ -1262,7 +4236,14 @@ class GCMHTTPRequest:
             self.curl.setopt(pycurl.SSL_VERIFYPEER, 1)
             self.curl.setopt(pycurl.SSL_VERIFYHOST, verifyhost)
 
-    def send(self, jsonmsg):
+    def send(self, jsonmsg, api_key):
+        # The connection is shared by all applications, only the key
+        # identifying them changes.
+        if api_key != self.api_key:
+            self.curl.setopt(pycurl.HTTPHEADER,
+                [ "Content-Type: application/json",
+                  "Authorization: key=%s" % api_key ])
+            self.api_key = api_key
         resp = HTTPResponseReceiver()
         self.curl.setopt(pycurl.WRITEFUNCTION, resp.write)
         self.curl.setopt(pycurl.POSTFIELDS, jsonmsg)
@@ -1288,202 +4269,355 @@ class GCMAgent(threading.Thread):
         'MissingCollapseKey'    : 'Missing Collapse Key'
     }
 
-    def __init__(self, idx, logger, pushq, server_url, api_key, ca_cert,
-        min_interval, dry_run, expbackoffdb, feedback_dbinfo):
+    # Notifications whose expiry is in the same bucket may be sent in
+    # the same request, with the earliest expiry.
+    _EXPIRYBUCKET = 60
+
+    def __init__(self, idx, logger, pushq, server_url, ca_cert,
+        min_interval, batch_window, dry_run, expbackoffdb, breaker, apps,
+        completions):
 
         threading.Thread.__init__(self)
         self.name = "Agent%d" % idx
         self.daemon = True
         self.l = logger
         self.pushq = pushq
-        self.gcmreq = GCMHTTPRequest(server_url, api_key, ca_cert)
+        self.gcmreq = GCMHTTPRequest(server_url, ca_cert)
         self.mininterval = min_interval
+        self.batchwindow = batch_window
         self.dryrun = dry_run
         self.expbackoffdb = expbackoffdb
-        self.feedback_dbinfo = feedback_dbinfo
+        self.breaker = breaker
+        self.apps = apps
+        self.completions = completions
+        self.metrics = Metrics()
+        self.tracer = Tracer()
 
-    def run(self):
-        self.feedbackdb = GCMFeedbackDatabase(self.feedback_dbinfo)
+    def _request(self, devtoks, collapsekey, payload, delayidle, ttl):
+        """
+        Builds the JSON request of a notification, as a dictionary.
+        """
+        req = {}
+        req['registration_ids'] = devtoks
+        req['collapse_key'] = collapsekey
+        req['data'] = payload
+        req['delay_while_idle'] = delayidle
+        req['time_to_live'] = ttl
+        if self.dryrun:
+            req['dry_run'] = True
+        return req
+
+    def _handleresults(self, uid, devtoks, results, jsonresp, feedbackdb,
+        labels):
+        """
+        Records the feedback of each registration ID of a notification.
+        Returns those which are to be retried.
+        """
+        devtoks2retry = []
+        for i in range(min(len(devtoks), len(results))):
+            devtok = devtoks[i]
+            result = results[i]
 
-        needsleep = 0
-        gcmmsg = None
-        exithelper = ExitHelper()
-        exithelper.register()
-        while True:
-            if needsleep:
-                time.sleep(self.mininterval)
-            needsleep = 1
+            if 'message_id' in result:
+                if 'registration_id' not in result:
+                    continue
+                self.l.info("In notification #%d, registration ID %s " \
+                    "has been replaced by %s",
+                    uid, devtok, result['registration_id'])
+                feedbackdb.replace(devtok, result['registration_id'])
+                self.metrics.incr('push2mob_gcm_canonical_ids_total',
+                    labels)
+                continue
 
-            gcmmsg = None
             try:
-                while gcmmsg is None:
-                    exithelper.checkexit()
-                    gcmmsg = self.pushq.get(1)
-            except Exiting:
-                self.l.debug("Exiting...")
-                break
+                error = result['error']
+            except KeyError as e:
+                self.l.warning("Expected 'error' in results[%d] in" \
+                    "notification #%d: %s" % (i, uid, jsonresp))
+                continue
 
-            uid, creation, collapsekey, expiry, delayidle, devtoks, payload = \
-                gcmmsg
-
-            # We store an absolute value but GCM wants a relative TTL.
-            # Semantically this makes sense to adjust the TTL just
-            # before handing the notification to the GCM service.
-            ttl = int(round(expiry - now()))
-            if ttl < 1:
-                self.l.warning("Discarding notification #%d: " \
-                    "time-to-live exceeded by %us (ttl: %us)" %
-                    (uid, -ttl, round(expiry - creation)))
+            self.metrics.incr('push2mob_gcm_errors_total',
+                labels + (('error', str(error)),))
+            emsg = ""
+            try:
+                emsg = GCMAgent._error_strings[error]
+            except KeyError as e:
+                self.l.error("Unexpected error for registration " \
+                    "ID %s in notification #%d: %s" %
+                    (devtok, uid, error))
                 continue
+            self.l.info("%s for registration ID %s in notification #%d",
+                emsg, devtok, uid)
+
+            # Special actions for some errors.
+            if error == 'InvalidRegistration' or \
+                error == 'MismatchSenderId':
+                feedbackdb.invalidate(devtok)
+            elif error == 'NotRegistered':
+                feedbackdb.unregister(devtok)
+            elif error == 'Unavailable' or \
+                 error == 'InternalServerError' or \
+                 error == 'QuotaExceeded' or \
+                 error == 'DeviceQuotaExceeded':
+                devtoks2retry.append(devtok)
+        return devtoks2retry
+
+    def _gather(self, gcmmsg):
+        """
+        Takes from the queue the notifications already due which can
+        be sent in the same request as `gcmmsg': same application,
+        collapse key, delay_while_idle and payload, an expiry in the
+        same bucket and other registration IDs, up to GCM's limit.
+        """
+        bucket = int(gcmmsg.expiry // GCMAgent._EXPIRYBUCKET)
+        devtoks = set(gcmmsg.devtoks)
+        def match(m):
+            if m.app != gcmmsg.app or m.collapsekey != gcmmsg.collapsekey or \
+              m.delayidle != gcmmsg.delayidle or \
+              int(m.expiry // GCMAgent._EXPIRYBUCKET) != bucket or \
+              len(devtoks) + len(m.devtoks) > GCMListener._MAXNUMIDS or \
+              m.payload != gcmmsg.payload or \
+              not devtoks.isdisjoint(m.devtoks):
+                return False
+            devtoks.update(m.devtoks)
+            return True
+        return self.pushq.take(match)
 
-            # Build the JSON request.
-            req = {}
-            req['registration_ids'] = devtoks
-            req['collapse_key'] = collapsekey
-            req['data'] = payload
-            req['delay_while_idle'] = delayidle
-            req['time_to_live'] = ttl
-            if self.dryrun:
-                req['dry_run'] = True
-            jsonmsg = json.dumps(req, indent=4, separators=(', ',': '))
+    def _sendable(self, gcmmsg):
+        """
+        Returns whether a notification can be sent, otherwise it is
+        discarded.
+        """
+        if gcmmsg.app not in self.apps:
+            self.l.error("Discarding notification #%d: unknown " \
+                "application %s" % (gcmmsg.uid, gcmmsg.app))
+            self.completions('gcm', gcmmsg.app, gcmmsg.uid, gcmmsg.creation,
+                OUTCOME_DISCARDED, gcmmsg.devtoks, gcmmsg.tenant)
+            return False
+        ttl = int(round(gcmmsg.expiry - now()))
+        if ttl < 1:
+            self.l.warning("Discarding notification #%d: " \
+                "time-to-live exceeded by %us (ttl: %us)" %
+                (gcmmsg.uid, -ttl, round(gcmmsg.expiry - gcmmsg.creation)))
+            self.completions('gcm', gcmmsg.app, gcmmsg.uid, gcmmsg.creation,
+                OUTCOME_DISCARDED, gcmmsg.devtoks, gcmmsg.tenant)
+            return False
+        return True
 
-            if DUMP_QUERIES:
-                self.l.debug("Notification #%d: %s", (uid, jsonmsg))
-            jsonmsg = json.dumps(req, separators=(',',':'))
+    def _complete(self, batch, outcome):
+        for m in batch:
+            self.completions('gcm', m.app, m.uid, m.creation, outcome,
+                m.devtoks, m.tenant)
 
+    def _retry(self, gcmmsg, delay, traced):
+        self.metrics.incr('push2mob_retries_total', (('service', 'gcm'),))
+        if gcmmsg.uid in traced:
+            self.tracer.mark('gcm', gcmmsg.uid, 'retry')
+        self.pushq.put(now() + delay, gcmmsg)
+
+    def _send(self, batch, feedbackdb):
+        """
+        Sends notifications sharing everything but their registration
+        IDs in one request, and handles the response for each of them.
+        """
+        first = batch[0]
+        app = self.apps[first.app]
+        if len(batch) == 1:
+            what = "notification #%d" % first.uid
+        else:
+            what = "notifications %s" % \
+                ', '.join("#%d" % m.uid for m in batch)
+        traced = set(m.uid for m in batch if self.tracer.sampled(m.uid))
+        for uid in traced:
+            self.tracer.mark('gcm', uid, 'dequeued')
+        devtoks = [devtok for m in batch for devtok in m.devtoks]
+
+        # We store an absolute value but GCM wants a relative TTL.
+        # Semantically this makes sense to adjust the TTL just
+        # before handing the notification to the GCM service.
+        ttl = int(round(min(m.expiry for m in batch) - now()))
+        req = self._request(devtoks, first.collapsekey, first.payload,
+            first.delayidle, ttl)
+        if DUMP_QUERIES:
+            self.l.debug("%s: %s", what.capitalize(),
+                json.dumps(req, indent=4, separators=(', ',': ')))
+        jsonmsg = json.dumps(req, separators=(',',':'))
+        for uid in traced:
+            self.tracer.mark('gcm', uid, 'built')
+
+        labels = (('app', first.app),)
+        try:
+            sendtime = now()
+            httpresp = self.gcmreq.send(jsonmsg, app.api_key)
+        except Exception as (e, estr):
+            self.l.error("Could not send request to GCM: %s" % estr)
+            self.metrics.incr('push2mob_gcm_connection_errors_total',
+                labels)
+            if self.breaker is not None:
+                self.breaker.failure()
+            self._complete(batch, OUTCOME_FAILED)
+            return
+        self.metrics.record('push2mob_gateway_seconds',
+            (('service', 'gcm'),), now() - sendtime)
+        for uid in traced:
+            self.tracer.mark('gcm', uid, 'response')
+        status = httpresp.getStatus()
+        self.metrics.incr('push2mob_gcm_responses_total',
+            labels + (('status', str(status)),))
+        jsonresp = ''.join(httpresp.getBody())
+        resphdrs = httpresp.getHeaders()
+        retryafter = 0
+        if 'Retry-After' in resphdrs:
             try:
-                httpresp = self.gcmreq.send(jsonmsg)
-            except Exception as (e, estr):
-                self.l.error("Could not send request to GCM: %s" % estr)
-                continue
-            status = httpresp.getStatus()
-            jsonresp = ''.join(httpresp.getBody())
-            resphdrs = httpresp.getHeaders()
-            retryafter = 0
-            try:
-                retryafter = int(resphdrs['Retry-After'])
-            except KeyError as e:
-                retryafter = 0
+                retryafter = parse_retryafter(resphdrs['Retry-After'])
             except ValueError as e:
-                # TODO We can handle Retry-After: being a date here.
-                retryafter = 0
+                self.l.warning("In response to %s: %s" % (what, e))
+        if self.breaker is not None:
+            if status >= 500:
+                self.breaker.failure(retryafter)
+            else:
+                self.breaker.success()
 
-            # First check status code.
-            if status == 200:
-                pass
-            elif status == 400:
-                self.l.error("Invalid JSON in notification #%d " \
-                    "(details: %s): %s" % (uid, jsonresp, jsonmsg))
-                continue
-            elif status == 401:
-                # GCM provides a response but nothing relevant for the
-                # possible causes of this error.
-                self.l.error("Authentication error for " \
-                    "notification #%d (details: %s): %s" %
-                    (uid, jsonresp, jsonmsg))
-                continue
-            elif status == 500 or status == 503:
-                delay = self.expbackoffdb.schedule(uid, retryafter)
-                if delay is not None:
-                    self.pushq.put(now() + delay, gcmmsg)
+        # First check status code.
+        if status == 200:
+            pass
+        elif status == 400:
+            self.l.error("Invalid JSON in %s (details: %s): %s" %
+                (what, jsonresp, jsonmsg))
+            self._complete(batch, OUTCOME_FAILED)
+            return
+        elif status == 401:
+            # GCM provides a response but nothing relevant for the
+            # possible causes of this error.
+            self.l.error("Authentication error for %s (details: %s): %s" %
+                (what, jsonresp, jsonmsg))
+            self._complete(batch, OUTCOME_FAILED)
+            return
+        elif status == 500 or status == 503:
+            for m in batch:
+                delay = self.expbackoffdb.schedule(m.uid, retryafter)
+                if delay is None:
+                    self.l.error("Giving up notification #%d after %d " \
+                        "retries, last HTTP status code %d (details: %s)" %
+                        (m.uid, self.expbackoffdb.maxretries, status,
+                        jsonresp))
+                    self._complete([m], OUTCOME_FAILED)
+                    continue
+                self._retry(m, delay, traced)
                 # These errors happen from time to time, they are not
                 # strictly errors, so just issue warnings.
                 if status == 500:
                     self.l.warning("Internal server error for " \
                         "notification #%d, retrying in %.3fs, but this should" \
                         "probably be reported to GCM Error body (details: %s)" %
-                        (uid, delay, jsonresp))
+                        (m.uid, delay, jsonresp))
                 else: # status == 503
                     self.l.warning("Service unavailable for " \
                         "notification #%d, retrying in %.3fs (details: %s)" %
-                        (uid, delay, jsonresp))
-                # Don't ack the gcmmsg.  It has been handled above.
-                gcmmsg = None
-                continue
-            else:
-                self.l.error("Unexpected HTTP status code %d in " \
-                    "notification #%d (details: %s): %s" %
-                    (status, uid, jsonresp, jsonmsg))
-                continue
+                        (m.uid, delay, jsonresp))
+            return
+        else:
+            self.l.error("Unexpected HTTP status code %d in %s " \
+                "(details: %s): %s" % (status, what, jsonresp, jsonmsg))
+            self._complete(batch, OUTCOME_FAILED)
+            return
 
-            # Now check the body.
-            try:
-                resp = json.loads(jsonresp)
-            except Exception as e:
-                self.l.error("Couldn't decode JSON returned in" \
-                    "notification #%d: %s" %
-                    (uid, jsonresp))
-                continue
+        # Now check the body.
+        try:
+            resp = json.loads(jsonresp)
+        except Exception as e:
+            self.l.error("Couldn't decode JSON returned in %s: %s" %
+                (what, jsonresp))
+            self._complete(batch, OUTCOME_FAILED)
+            return
 
-            lag = now() - creation
-            self.l.info("Notification #%d sent delayed by %.3fs as id %s: " \
-                "success %d, failure %d, canonical_ids %d" %
-                (uid, lag, resp['multicast_id'],
-                 resp['success'], resp['failure'], resp['canonical_ids']))
+        results = resp.get('results', [])
+        if (resp['failure'] != 0 or resp['canonical_ids'] != 0) and \
+          len(devtoks) != len(results):
+            self.l.warning("Weird number of results in %s (%d devices, " \
+                "%d results): %s" %
+                (what, len(devtoks), len(results), jsonresp))
+        curtime = now()
+        offset = 0
+        for m in batch:
+            # Results are in the order of the registration IDs.
+            mresults = results[offset:offset + len(m.devtoks)]
+            offset += len(m.devtoks)
+            if len(batch) == 1:
+                success = resp['success']
+                failure = resp['failure']
+                canonical = resp['canonical_ids']
+            else:
+                success = sum(1 for r in mresults if 'message_id' in r)
+                failure = sum(1 for r in mresults if 'error' in r)
+                canonical = sum(1 for r in mresults
+                    if 'registration_id' in r)
+            self.l.log(NOTIFICATION_LOGLEVEL,
+                "Notification #%d sent delayed by %.3fs as id %s: " \
+                "success %d, failure %d, canonical_ids %d",
+                m.uid, curtime - m.creation, resp['multicast_id'],
+                success, failure, canonical)
+            self.completions('gcm', m.app, m.uid, m.creation, OUTCOME_SENT,
+                m.devtoks, m.tenant)
             if resp['failure'] == 0 and resp['canonical_ids'] == 0:
                 continue
 
-            if len(devtoks) != len(resp['results']):
-                self.l.warning("Weird number of results in " \
-                    "notification #%d (%d devices, %d results): %s" %
-                    (uid, len(devtoks), len(data['results'], jsonresp)))
-
-            devtoks2retry = []
-            for i in range(len(devtoks)):
-                devtok = devtoks[i]
-                result = resp['results'][i]
-
-                if 'message_id' in result:
-                    if 'registration_id' not in result:
-                        continue
-                    self.l.info("In notification #%d, registration ID %s " \
-                        "has been replaced by %s" %
-                        (uid, devtok, result['registration_id']))
-                    self.feedbackdb.replace(devtok, result['registration_id'])
-                    continue
-
-                try:
-                    error = result['error']
-                except KeyError as e:
-                    self.l.warning("Expected 'error' in results[%d] in" \
-                        "notification #%d: %s" % (i, uid, jsonresp))
-                    continue
-
-                emsg = ""
-                try:
-                    emsg = GCMAgent._error_strings[error]
-                except KeyError as e:
-                    self.l.error("Unexpected error for registration " \
-                        "ID %s in notification #%d: %s" %
-                        (devtok, uid, error))
-                    continue
-                self.l.info("%s for registration ID %s " \
-                    "in notification #%d" % (emsg, devtok, uid))
-
-                # Special actions for some errors.
-                if error == 'InvalidRegistration' or \
-                    error == 'MismatchSenderId':
-                    self.feedbackdb.invalidate(devtok)
-                elif error == 'NotRegistered':
-                    self.feedbackdb.unregister(devtok)
-                elif error == 'Unavailable' or \
-                     error == 'InternalServerError' or \
-                     error == 'QuotaExceeded' or \
-                     error == 'DeviceQuotaExceeded':
-                    devtoks2retry.append(devtok)
-
+            devtoks2retry = self._handleresults(m.uid, m.devtoks, mresults,
+                jsonresp, feedbackdb, labels)
             if len(devtoks2retry) == 0:
                 continue
-            delay = self.expbackoffdb.schedule(uid, retryafter)
+            delay = self.expbackoffdb.schedule(m.uid, retryafter)
             if delay is None:
                 continue
+            if len(devtoks2retry) == len(m.devtoks):
+                self._retry(m, delay, traced)
+            else:
+                self._retry(m._replace(devtoks=devtoks2retry), delay, traced)
 
-            if len(devtoks2retry) == len(devtoks):
-                self.pushq.put(now() + delay, gcmmsg)
-                continue
+    def run(self):
+        # SQLite connections cannot be shared between threads.
+        feedbackdbs = {}
+        for name, app in self.apps.iteritems():
+            feedbackdbs[name] = GCMFeedbackDatabase(app.feedback_dbinfo)
+
+        needsleep = 0
+        gcmmsg = None
+        exithelper = ExitHelper()
+        exithelper.register()
+        while True:
+            gcmmsg = None
+            try:
+                if needsleep:
+                    exithelper.sleep(self.mininterval)
+                needsleep = 1
+                while gcmmsg is None:
+                    exithelper.checkexit()
+                    gcmmsg = self.pushq.get()
+            except Exiting:
+                self.l.debug("Exiting...")
+                break
 
-            self.pushq.put(now() + delay, (uid, creation, collapsekey, expiry,
-                delayidle, devtoks2retry, payload))
+            batch = [gcmmsg]
+            if self.batchwindow > 0 and \
+              len(gcmmsg.devtoks) < GCMListener._MAXNUMIDS:
+                # Returns at once on exit, the batch is then sent before
+                # exiting.
+                exithelper.select([], self.batchwindow)
+                batch.extend(self._gather(gcmmsg))
+            if self.breaker is not None:
+                try:
+                    self.breaker.acquire()
+                except Exiting:
+                    # GCM is down, the notifications are kept.
+                    for m in batch:
+                        self.pushq.put(now(), m)
+                    self.l.debug("Exiting...")
+                    break
+            batch = [m for m in batch if self._sendable(m)]
+            if len(batch) > 0:
+                self._send(batch, feedbackdbs[batch[0].app])
+            elif self.breaker is not None:
+                self.breaker.abandon()
 
 
 class GCMListener(Listener):
@@ -1494,20 +4628,21 @@ class GCMListener(Listener):
     enhanced notification format.
     """
 
+    _SERVICE = 'gcm'
     _MAXNUMIDS = 1000
     _MAXTTL = 2419200       # 4 weeks
     _PAYLOADMAXLEN = 4096
 
-    def __init__(self, idx, logger, zmqsock, pushq,
-      feedback_dbinfo):
-        Listener.__init__(self, idx, logger, zmqsock)
+    def __init__(self, idx, logger, zmqsock, pushq, apps, tenants=None,
+      scheduler=None):
+        Listener.__init__(self, idx, logger, zmqsock, apps, tenants,
+            scheduler)
         self.name = "Listener%d" % idx
         self.l = logger
         self.pushq = pushq
-        self.feedback_dbinfo = feedback_dbinfo
         self.uid = random.randint(0, 2**32)
 
-    def _parse_send(self, msg):
+    def _parse_send(self, opts, msg):
         arglist, ids, payload = Listener._parse_send_args(self, 3, msg)
 
         # Collape key (arg #1).
@@ -1516,11 +4651,15 @@ class GCMListener(Listener):
         # Check expiry (arg #2).
         expiry = arglist[1]
         try:
-            expiry = Listener._parse_expiry(expiry)
+            expiry = Listener._parse_expiry(expiry, opts.at)
         except Exception as e:
             self._send_error("Invalid expiry value: %s" % expiry)
             return None
-        if round(expiry - now()) > GCMListener._MAXTTL:
+        # The TTL counts from the time the notification is sent.
+        sendtime = opts.at
+        if sendtime is None:
+            sendtime = now()
+        if round(expiry - sendtime) > GCMListener._MAXTTL:
             self._send_error("Expiry value too high " \
                 "(max %ds in the future): %s" %
                 (GCMListener._MAXTTL, expiry))
@@ -1537,32 +4676,16 @@ class GCMListener(Listener):
 
         arglist = [collapsekey, expiry, delayidle]
 
-        goodids = []
-        for i in ids:
-            r = self.idschanges.query(i)
-            if r is None:
-                goodids.append(i)
-                continue
-            state, newi = r
-            if state == GCMFeedbackDatabase.REPLACED:
-                goodids.append(newi)
-                continue
-            elif state == GCMFeedbackDatabase.NOTREGISTERED or \
-                state == GCMFeedbackDatabase.INVALID:
-                # Our client didn't get feedback yet, just discard the
-                # message, it is not an error.
-                continue
-
-        if len(goodids) == 0:
+        ids = self._filter_ids(opts, ids)
+        if len(ids) == 0:
             self._send_error("All registrations IDs have been filtered out, " \
                 "please get feedback")
             return None
-        ids = goodids
 
         # Check payload.
         if len(payload) > GCMListener._PAYLOADMAXLEN:
-            self._send_error("Payload too long (%d > %d)" % len(payload),
-                GCMListener._PAYLOADMAXLEN, payload)
+            self._send_error("Payload too long (%d > %d)" %
+                (len(payload), GCMListener._PAYLOADMAXLEN), payload)
             return None
 
         obj = jsonload(payload)
@@ -1574,27 +4697,76 @@ class GCMListener(Listener):
         # Mimic _parse_send_args() return value.
         return (arglist, ids, payload)
 
-    def _perform_send(self, arglist, devtoks, payload):
+    def _filter_ids(self, opts, ids):
+        """
+        Replaces registration IDs which have a canonical ID and drops
+        those which are not valid anymore, according to the feedback
+        received from GCM.
+        """
+        idschanges = self.idschanges[opts.app.name]
+        goodids = []
+        for i in ids:
+            r = idschanges.query(i)
+            if r is None:
+                goodids.append(i)
+                continue
+            state, newi = r
+            if state == GCMFeedbackDatabase.REPLACED:
+                goodids.append(newi)
+                continue
+            elif state == GCMFeedbackDatabase.NOTREGISTERED or \
+                state == GCMFeedbackDatabase.INVALID:
+                # Our client didn't get feedback yet, just discard the
+                # message, it is not an error.
+                continue
+        return goodids
+
+    def _pushq(self, opts):
+        return self.pushq
+
+    def _perform_send(self, opts, arglist, devtoks, payload):
+        if opts.at is not None and self.scheduler is None:
+            self._send_error("Scheduled delivery not available")
+            return None
         collapsekey = arglist[0]
         expiry = arglist[1]
         delayidle = arglist[2]
 
-        createtime = now()
+        createtime = opts.at
+        if createtime is None:
+            createtime = now()
+        tracer = Tracer()
+        scheduled = []
         uids = []
+        # Shared by the notifications of the command, see sizeof().
+        payloadsize = len(json.dumps(payload))
         while len(devtoks) > 0:
             toks = devtoks[:GCMListener._MAXNUMIDS]
             devtoks = devtoks[GCMListener._MAXNUMIDS:]
             uid = self.uid
             self.uid += 1
-            self.pushq.put(createtime, (uid, createtime, collapsekey,
-                expiry, delayidle, toks, payload))
-            self.l.debug("Got notification #%d for %d devices, " \
-                "expiring at %d" % (uid, len(toks), expiry))
+            gcmmsg = GCMNotification(uid, createtime, collapsekey, expiry,
+                delayidle, toks, payload, opts.app.name, opts.priority,
+                opts.tenant.name, payloadsize)
+            if opts.at is None:
+                self.pushq.put(createtime, gcmmsg)
+            else:
+                scheduled.append(gcmmsg)
+            if tracer.sampled(uid):
+                tracer.mark('gcm', uid, 'received', self.received)
+                tracer.mark('gcm', uid, 'enqueued')
+            self.l.debug("Got notification #%d for %d devices " \
+                "of application %s, expiring at %d",
+                uid, len(toks), opts.app.name, expiry)
             uids.append(str(uid))
+        if len(scheduled) > 0:
+            self.scheduler.schedule(opts.at, opts.app.name, scheduled)
+            self.l.debug("%d notifications of application %s scheduled " \
+                "at %d", len(scheduled), opts.app.name, opts.at)
         return ' '.join(uids)
 
-    def _perform_feedback(self):
-        feedbacks = self.idschanges.queryAll()
+    def _perform_feedback(self, opts):
+        feedbacks = self.idschanges[opts.app.name].queryAll()
         for i in range(len(feedbacks)):
             t = feedbacks[i]
             if t[1] == GCMFeedbackDatabase.REPLACED:
@@ -1609,10 +4781,493 @@ class GCMListener(Listener):
         return ' '.join(feedbacks)
 
     def run(self):
-        self.idschanges = GCMFeedbackDatabase(self.feedback_dbinfo)
+        # SQLite connections cannot be shared between threads.
+        self.idschanges = {}
+        for name, app in self.apps.iteritems():
+            self.idschanges[name] = GCMFeedbackDatabase(app.feedback_dbinfo)
         Listener.run(self)
 
 
+#############################################################################
+# Worker processes.
+#############################################################################
+
+class EventSender:
+    """
+    Wrapper around the ZMQ socket used by a worker process to send
+    events to the main process, so it can be shared by all threads.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.mutex = threading.Lock()
+
+    def send(self, event):
+        with Locker(self.mutex):
+            self.sock.send_pyobj(event)
+
+
+class WorkerPushQueue(ExitAwareQueue):
+    """
+    Push queue of a worker process, fed by the main process which owns
+    the persistent queue.  Items the agents put back (e.g. GCM
+    notifications to retry) are sent to the main process.
+    Items fed are kept by priority lane, and served in strict priority
+    order so that they don't wait behind lower ones already dispatched,
+    then shared among tenants as described by `fairness' (see
+    TenantDeque).
+    """
+
+    def __init__(self, events, service, appname, fairness=None):
+        self.fairness = fairness
+        ExitAwareQueue.__init__(self)
+        self.events = events
+        self.service = service
+        self.appname = appname
+        if service == 'gcm':
+            self.lane = lambda gcmmsg: gcmmsg.lane
+        else:
+            self.lane = lambda apnsmsg: apnsmsg[5]
+
+    # Queue.Queue internals, self.queue is a TenantDeque per lane.
+    def _init(self, maxsize):
+        self.queue = [TenantDeque(self.fairness) for lane in LANES]
+        self.index = dict((name, i) for i, name in enumerate(LANES))
+
+    def _qsize(self, len=len):
+        return sum(len(q) for q in self.queue)
+
+    def _put(self, item):
+        self.queue[self.index.get(self.lane(item),
+            self.index[LANE_NORMAL])].append(item)
+
+    def _get(self):
+        for q in self.queue:
+            if len(q) > 0:
+                return q.popleft()
+
+    def feed(self, item):
+        Queue.Queue.put(self, item)
+
+    def drain(self):
+        """
+        Removes and returns all items.
+        """
+        with Locker(self.mutex):
+            items = []
+            for q in self.queue:
+                items.extend(q.take(lambda item: True))
+        return items
+
+    def put(self, *args):
+        # Mimic the queues of the main process, whose signature is
+        # either put(item) or put(when, item).
+        item = args[0] if len(args) == 1 else args
+        self.events.send(('requeue', self.service, self.appname, item))
+
+
+class WorkerTimelyPushQueue(WorkerPushQueue):
+    """
+    Same as WorkerPushQueue but mimics CheckpointableTimelySQueue.
+    Items are fed only once they are due.
+    """
+
+    def get(self, timeout=None):
+        try:
+            return ExitAwareQueue.get(self, True, timeout)
+        except Queue.Empty:
+            return None
+
+    def take(self, match):
+        taken = []
+        with Locker(self.mutex):
+            for q in self.queue:
+                taken.extend(q.take(match))
+        return taken
+
+
+class WorkerFeedbackQueue:
+    """
+    Feedback queue of a worker process, entries are sent to the main
+    process.
+    """
+
+    def __init__(self, events, service, appname):
+        self.events = events
+        self.service = service
+        self.appname = appname
+
+    def put(self, item):
+        self.events.send(('feedback', self.service, self.appname, item))
+
+
+class WorkerDispatcher(threading.Thread):
+    """
+    Forwards the notifications of one push queue of the main process
+    to the worker processes.
+    """
+
+    def __init__(self, pool, logger, service, appname, pushq):
+        threading.Thread.__init__(self)
+        self.name = "%sDispatcher" % service.upper()
+        if appname is not None and appname != DEFAULT_APP:
+            self.name = "%s:%s" % (appname, self.name)
+        self.daemon = True
+        self.pool = pool
+        self.l = logger
+        self.service = service
+        self.appname = appname
+        self.pushq = pushq
+
+    def _get(self):
+        # Both return None on exit.
+        if self.service == 'gcm':
+            return self.pushq.get()
+        try:
+            return self.pushq.get()
+        except Queue.Empty:
+            return None
+
+    def _putback(self, item):
+        if self.service == 'gcm':
+            self.pushq.put(now(), item)
+        else:
+            self.pushq.put(item)
+
+    def run(self):
+        exithelper = ExitHelper()
+        exithelper.register()
+        tracer = Tracer()
+        while True:
+            item = None
+            try:
+                while item is None:
+                    exithelper.checkexit()
+                    item = self._get()
+                # All workers are busy, the notification is better
+                # kept in the persistent queue.
+                while not self.pool.dispatch(self.service, self.appname,
+                  item):
+                    exithelper.checkexit()
+                    time.sleep(0.01)
+                uid = item.uid if self.service == 'gcm' else item[0]
+                if tracer.sampled(uid):
+                    tracer.mark(self.service, uid, 'dispatched')
+            except Exiting:
+                if item is not None:
+                    self._putback(item)
+                self.l.debug("Exiting...")
+                break
+
+
+class WorkerPool:
+    """
+    Runs the agents in worker processes, so they don't compete with
+    each other for the interpreter lock.  The main process keeps the
+    listeners and the persistent queues: WorkerDispatcher threads
+    forward the notifications to the workers and an event thread gets
+    back requeued notifications, feedback and completions.
+    """
+
+    # Maximum number of notifications pending in each worker, in the
+    # ZMQ socket buffers and in its local queues.
+    _HWM = 64
+
+    def __init__(self, logger, nworkers, ipcdir):
+        self.l = logger
+        self.nworkers = nworkers
+        self.prefix = "%s/push2mob.%d" % (ipcdir, os.getpid())
+        self.names = ["control", "events"] + \
+            ["work%d" % i for i in range(nworkers)]
+        self.pids = []
+        self.rr = 0
+
+    def endpoint(self, name):
+        return "ipc://%s.%s" % (self.prefix, name)
+
+    def fork(self):
+        """
+        Forks the worker processes.  This must be done before any thread
+        or ZMQ context is created.  Returns the worker index in the
+        worker processes and None in the main process.
+        """
+        for i in range(self.nworkers):
+            pid = os.fork()
+            if pid == 0:
+                self.pids = []
+                return i
+            self.pids.append(pid)
+        return None
+
+    def start(self, apns_apps, gcm_pushq, completions):
+        """
+        Creates the sockets and starts the threads of the main process.
+        Returns the list of threads registered to ExitHelper.
+        """
+        self.apns_apps = apns_apps
+        self.gcm_pushq = gcm_pushq
+        self.completions = completions
+        self.zmqctx = zmq.Context()
+        self.worksocks = []
+        for i in range(self.nworkers):
+            sock = self.zmqctx.socket(zmq.PUSH)
+            sock.setsockopt(zmq.SNDHWM, WorkerPool._HWM)
+            sock.bind(self.endpoint("work%d" % i))
+            self.worksocks.append((sock, threading.Lock()))
+        self.controlsock = self.zmqctx.socket(zmq.PUB)
+        self.controlsock.bind(self.endpoint("control"))
+        self.controlmutex = threading.Lock()
+        self.eventsock = self.zmqctx.socket(zmq.PULL)
+        self.eventsock.bind(self.endpoint("events"))
+        self.alive = set(self.pids)
+        self.exited = threading.Event()
+
+        t = threading.Thread(target=self._receive, name="WorkerEvents")
+        t.daemon = True
+        t.start()
+
+        threads = []
+        for app in apns_apps.itervalues():
+            threads.append(WorkerDispatcher(self, self.l, 'apns', app.name,
+                app.pushq))
+        threads.append(WorkerDispatcher(self, self.l, 'gcm', None, gcm_pushq))
+        for t in threads:
+            t.start()
+        return threads
+
+    def dispatch(self, service, appname, item):
+        """
+        Sends a notification to a worker.  Returns False if the
+        workers are all busy.
+        """
+        if service == 'gcm':
+            # Always hand a notification to the same worker, so its
+            # exponential back-off database sees all retries.
+            candidates = [item.uid % self.nworkers]
+        else:
+            self.rr = (self.rr + 1) % self.nworkers
+            candidates = range(self.rr, self.nworkers) + range(0, self.rr)
+
+        for i in candidates:
+            sock, lock = self.worksocks[i]
+            with Locker(lock):
+                try:
+                    sock.send_pyobj((service, appname, item), zmq.NOBLOCK)
+                    return True
+                except zmq.ZMQError as e:
+                    if e.errno != zmq.EAGAIN:
+                        raise
+        return False
+
+    def _reap(self):
+        for pid in list(self.alive):
+            try:
+                rpid, status = os.waitpid(pid, os.WNOHANG)
+            except OSError:
+                rpid = pid
+            if rpid == 0:
+                continue
+            self.alive.discard(pid)
+            if not self.exited.is_set():
+                self.l.error("Worker process %d died unexpectedly, the " \
+                    "notifications it was handling are lost" % pid)
+        if len(self.alive) == 0:
+            self.exited.set()
+
+    def _receive(self):
+        while True:
+            if not self.eventsock.poll(1000):
+                self._reap()
+                continue
+            kind, service, appname, payload = self.eventsock.recv_pyobj()
+            if kind == 'done':
+                uid, creation, outcome, devtoks, tenant = payload
+                self.completions(service, appname, uid, creation, outcome,
+                    devtoks, tenant)
+            elif kind == 'requeue' and service == 'gcm':
+                when, item = payload
+                self.gcm_pushq.put(when, item)
+            elif kind == 'requeue':
+                self.apns_apps[appname].pushq.put(payload)
+            elif kind == 'feedback':
+                self.apns_apps[appname].feedbackq.put(payload)
+            elif kind == 'metrics':
+                idx, snapshot = payload
+                Metrics().merge(idx, snapshot)
+            elif kind == 'traces':
+                Tracer().extend(payload)
+            elif kind == 'bye':
+                self.l.debug("Worker process %d exited" % payload)
+                self.alive.discard(payload)
+                try:
+                    os.waitpid(payload, 0)
+                except OSError:
+                    pass
+                if len(self.alive) == 0:
+                    self.exited.set()
+
+    def reload(self, conf):
+        """
+        Sends the options read by reloadconf() to the workers.
+        """
+        with Locker(self.controlmutex):
+            self.controlsock.send_pyobj(("reload", conf))
+
+    def stop(self, timeout):
+        """
+        Asks the workers to exit and waits for them to send back the
+        notifications they have not handled yet.  This must be called
+        once the dispatchers have exited.
+        """
+        self.l.info("Waiting for %d worker processes..." % len(self.alive))
+        deadline = now() + timeout
+        while not self.exited.is_set() and now() < deadline:
+            # PUB sockets drop messages for peers that are not connected
+            # yet, so repeat the order.
+            with Locker(self.controlmutex):
+                self.controlsock.send_pyobj(("exit", None))
+            self.exited.wait(1)
+        for pid in list(self.alive):
+            self.l.error("Killing worker process %d which did not exit, " \
+                "the notifications it was handling are lost" % pid)
+            os.kill(pid, signal.SIGKILL)
+        for name in self.names:
+            try:
+                os.unlink("%s.%s" % (self.prefix, name))
+            except OSError:
+                pass
+
+
+class Worker:
+    """
+    Main loop of a worker process: feeds the local queues of its agents
+    with the notifications dispatched by the main process, until it is
+    asked to exit.  Notifications which have not been handled by then
+    are sent back to the main process.
+    """
+
+    def __init__(self, idx, pool, logger):
+        self.idx = idx
+        self.pool = pool
+        self.l = logger
+
+    # How often metrics are sent to the main process.  (seconds)
+    _METRICSINTERVAL = 1
+
+    def _completed(self, service, appname, uid, creation, outcome, devtoks,
+      tenant):
+        self.events.send(('done', service, appname,
+            (uid, creation, outcome, devtoks, tenant)))
+
+    def _sendmetrics(self):
+        self.events.send(('metrics', None, None,
+            (self.idx, Metrics().snapshot())))
+        traces = Tracer().drain()
+        if len(traces) > 0:
+            self.events.send(('traces', None, None, traces))
+
+    def _backlog(self):
+        return sum(q.qsize() for q in self.queues.itervalues())
+
+    def _rename(self, threads):
+        for t in threads:
+            t.name = "Worker%d:%s" % (self.idx, t.name)
+
+    def _feed(self, msg):
+        service, appname, item = msg
+        self.queues[(service, appname)].feed(item)
+
+    def run(self, agentconf, apns_apps, gcm_apps):
+        # The main process tells us when to exit or reload.
+        for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGQUIT,
+          signal.SIGHUP):
+            signal.signal(sig, signal.SIG_IGN)
+
+        zmqctx = zmq.Context()
+        eventsock = zmqctx.socket(zmq.PUSH)
+        eventsock.connect(self.pool.endpoint("events"))
+        self.events = EventSender(eventsock)
+        worksock = zmqctx.socket(zmq.PULL)
+        worksock.setsockopt(zmq.RCVHWM, WorkerPool._HWM)
+        worksock.connect(self.pool.endpoint("work%d" % self.idx))
+        controlsock = zmqctx.socket(zmq.SUB)
+        controlsock.setsockopt(zmq.SUBSCRIBE, "")
+        controlsock.connect(self.pool.endpoint("control"))
+
+        # Agents only see the local queues.
+        self.queues = {}
+        wapps = {}
+        for name, app in apns_apps.iteritems():
+            pushq = WorkerPushQueue(self.events, 'apns', name,
+                agentconf.apns_fairness)
+            self.queues[('apns', name)] = pushq
+            wapps[name] = AttributeHolder(name=name, pushq=pushq,
+                feedbackq=WorkerFeedbackQueue(self.events, 'apns', name),
+                push_gateway=app.push_gateway, tlsconnect=app.tlsconnect,
+                breaker=app.breaker)
+        gcm_pushq = WorkerTimelyPushQueue(self.events, 'gcm', None,
+            agentconf.gcm_fairness)
+        self.queues[('gcm', None)] = gcm_pushq
+        completions = Completions()
+        completions.register(self._completed)
+        completions.register(Tracer().completed)
+        agents = Agents(agentconf, wapps, gcm_apps, gcm_pushq, completions)
+        self._rename(agents.start())
+
+        poller = zmq.Poller()
+        poller.register(controlsock, zmq.POLLIN)
+        poller.register(worksock, zmq.POLLIN)
+        lastmetrics = now()
+        ppid = os.getppid()
+        while True:
+            # The main process may die without telling us.
+            if os.getppid() != ppid:
+                self.l.error("Main process died, worker %d exiting" %
+                    self.idx)
+                logging.shutdown()
+                os._exit(1)
+            if now() - lastmetrics >= Worker._METRICSINTERVAL:
+                self._sendmetrics()
+                lastmetrics = now()
+            # Stop reading notifications when the agents are late, the
+            # main process will give them to other workers.
+            if self._backlog() < WorkerPool._HWM:
+                socks = dict(poller.poll(1000))
+            else:
+                socks = dict([(controlsock, controlsock.poll(100))])
+            if socks.get(controlsock):
+                cmd, arg = controlsock.recv_pyobj()
+                if cmd == "exit":
+                    break
+                elif cmd == "reload":
+                    self._rename(reconfigure(arg, agents))
+            if socks.get(worksock):
+                self._feed(worksock.recv_pyobj())
+
+        # Get what has already been dispatched to us.
+        while worksock.poll(100):
+            self._feed(worksock.recv_pyobj())
+        exithelper = ExitHelper()
+        exithelper.signalexit()
+        exithelper.waitexit()
+
+        n = 0
+        for (service, appname), q in self.queues.iteritems():
+            for item in q.drain():
+                if service == 'gcm':
+                    q.put(now(), item)
+                else:
+                    q.put(item)
+                n += 1
+        self.l.debug("Worker %d sent back %d notifications" % (self.idx, n))
+        self._sendmetrics()
+        self.events.send(('bye', None, None, os.getpid()))
+        worksock.close()
+        controlsock.close()
+        eventsock.close()
+        zmqctx.term()
+
+
 #############################################################################
 # Main.
 #############################################################################
@@ -1629,19 +5284,190 @@ def parse_loglevel(l):
         raise Exception("Unknown log level: %s" % l)
     return ret
 
-def createLogger(name, logfile, level, propagate, formatter):
+def confget(cp, getter, section, option, default):
+    """
+    Calls the ConfigParser `getter' method (e.g. "getint") unless the
+    option is missing, in which case `default' is returned.  This is
+    used for options which have been added over time.
+    """
+    if not cp.has_option(section, option):
+        return default
+    return getattr(cp, getter)(section, option)
+
+def appsections(cp, service):
+    """
+    Returns a list of (appname, section) tuples for `service'.  The
+    "[service]" section configures the default application, additional
+    ones are declared with "[service:appname]" sections.
+    """
+    apps = [(DEFAULT_APP, service)]
+    for section in cp.sections():
+        if not section.startswith(service + ':'):
+            continue
+        name = section[len(service) + 1:]
+        if name == DEFAULT_APP or re.match(r"^\w+$", name) is None:
+            raise Exception("Invalid application name in section [%s]" %
+                section)
+        apps.append((name, section))
+    return apps
+
+def readtenants(cp):
+    """
+    Returns the Tenant objects by name.  Tenants are declared with
+    "[tenant:name]" sections, the default one always exists and may be
+    configured with a "[tenant:default]" section.
+    """
+    tenants = {DEFAULT_TENANT: Tenant(DEFAULT_TENANT)}
+    for section in cp.sections():
+        if not section.startswith('tenant:'):
+            continue
+        name = section[len('tenant:'):]
+        if re.match(r"^\w+$", name) is None:
+            raise Exception("Invalid tenant name in section [%s]" % section)
+        weight = confget(cp, 'getint', section, 'weight', 1)
+        if weight < 1:
+            raise Exception("%s.weight: must be at least 1" % section)
+        tenants[name] = Tenant(name, weight,
+            confget(cp, 'getfloat', section, 'max_rate', 0.),
+            confget(cp, 'getint', section, 'max_queued', 0))
+    return tenants
+
+def reloadconf(configfile, apns_apps):
+    """
+    Reads the options which can be changed without restarting, see
+    reconfigure().  Raises an exception if one of them is invalid.
+    """
+    cp = ConfigParser.SafeConfigParser()
+    if len(cp.read([configfile])) == 0:
+        raise Exception("Cannot open '%s'" % configfile)
+    loglevels = {}
+    for section, name in (('main', 'push2mob'), ('apns', 'push2mob.APNS'),
+      ('gcm', 'push2mob.GCM')):
+        try:
+            loglevels[name] = parse_loglevel(cp.get(section, 'log_level'))
+        except Exception as e:
+            raise Exception("%s.log_level: %s" % (section, e))
+    apns_push_concurrency = {}
+    default = cp.getint('apns', 'push_concurrency')
+    for name, section in appsections(cp, 'apns'):
+        if name in apns_apps:
+            apns_push_concurrency[name] = confget(cp, 'getint', section,
+                'push_concurrency', default)
+    return AttributeHolder(loglevels=loglevels,
+        apns_push_concurrency=apns_push_concurrency,
+        apns_push_max_error_wait=cp.getfloat('apns', 'push_max_error_wait'),
+        gcm_concurrency=cp.getint('gcm', 'concurrency'),
+        gcm_min_interval=cp.getfloat('gcm', 'min_interval'),
+        gcm_batch_window=confget(cp, 'getfloat', 'gcm', 'batch_window', 0.),
+        gcm_max_retries=cp.getint('gcm', 'max_retries'))
+
+def reconfigure(conf, agents):
+    """
+    Applies the options read by reloadconf() in the current process:
+    log levels and `agents' (None if they run in worker processes).
+    Log files are also reopened, e.g. after they have been rotated.
+    """
+    for name, level in conf.loglevels.iteritems():
+        logger = logging.getLogger(name)
+        logger.setLevel(level)
+        for h in logger.handlers:
+            h = getattr(h, 'target', h)
+            if not isinstance(h, logging.FileHandler):
+                continue
+            with Locker(h):
+                if h.stream is not None:
+                    h.stream.close()
+                h.stream = h._open()
+    if agents is not None:
+        return agents.reconfigure(conf)
+    return []
+
+
+class Agents:
+    """
+    APNS and GCM agent threads of a process.  Their number and settings
+    can be changed while running: agents in excess are retired (see
+    ExitHelper) and exit once done with their current notification.
+    """
+
+    def __init__(self, conf, apns_apps, gcm_apps, gcm_pushq, completions):
+        self.conf = conf
+        self.apns_apps = apns_apps
+        self.gcm_apps = gcm_apps
+        self.gcm_pushq = gcm_pushq
+        self.completions = completions
+        self.apns = dict((name, []) for name in apns_apps)
+        self.gcm = []
+
+    def start(self):
+        """
+        Starts the APNS and GCM agent threads.  Returns the list of threads.
+        """
+        return self.reconfigure(self.conf)
+
+    def reconfigure(self, conf):
+        """
+        Applies the concurrency and settings of `conf', as returned by
+        reloadconf().  Returns the list of threads started.
+        """
+        exithelper = ExitHelper()
+        threads = []
+        for name, app in self.apns_apps.iteritems():
+            agents = self.apns[name]
+            n = conf.apns_push_concurrency.get(name, len(agents))
+            for t in agents[n:]:
+                exithelper.retire(t)
+            del agents[n:]
+            for t in agents:
+                t.maxerrorwait = conf.apns_push_max_error_wait
+                t.recentnotifications.setmaxerrorwait(t.maxerrorwait)
+            for i in range(len(agents), n):
+                t = APNSAgent(i, self.conf.apns_logger,
+                    self.conf.apns_devtokfmt, app,
+                    conf.apns_push_max_error_wait, self.completions)
+                agents.append(t)
+                threads.append(t)
+                t.start()
+
+        self.conf.gcm_expbackoffdb.setmaxretries(conf.gcm_max_retries)
+        for t in self.gcm[conf.gcm_concurrency:]:
+            exithelper.retire(t)
+        del self.gcm[conf.gcm_concurrency:]
+        for t in self.gcm:
+            t.mininterval = conf.gcm_min_interval
+            t.batchwindow = conf.gcm_batch_window
+        for i in range(len(self.gcm), conf.gcm_concurrency):
+            t = GCMAgent(i, self.conf.gcm_logger, self.gcm_pushq,
+                self.conf.gcm_server_url, self.conf.gcm_cacerts,
+                conf.gcm_min_interval, conf.gcm_batch_window,
+                self.conf.gcm_dry_run, self.conf.gcm_expbackoffdb,
+                self.conf.gcm_breaker, self.gcm_apps, self.completions)
+            self.gcm.append(t)
+            threads.append(t)
+            t.start()
+        return threads
+
+def createHandler(handler, formatter, asyncqueue):
+    """
+    Returns `handler' with `formatter', behind an AsyncLogHandler if
+    `asyncqueue' (its max size) is not 0.
+    """
+    handler.setFormatter(formatter)
+    if asyncqueue == 0:
+        return handler
+    return AsyncLogHandler(handler, asyncqueue)
+
+def createLogger(name, logfile, level, propagate, formatter, asyncqueue):
     logger = logging.getLogger(name)
     logger.setLevel(level)
     if len(logfile) == 0:
-        handler = logging.FileHandler("/dev/null")
-        logger.addHandler(handler)
+        logger.addHandler(logging.NullHandler())
         logger.propagate = True
         return logger
 
     logger.propagate = propagate
-    handler = logging.FileHandler(logfile)
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    logger.addHandler(createHandler(logging.FileHandler(logfile), formatter,
+        asyncqueue))
     return logger
 
 if __name__ == "__main__":
@@ -1689,6 +5515,60 @@ if __name__ == "__main__":
             loglevel = parse_loglevel(cp.get('main', 'log_level'))
         except Exception as e:
             raise Exception("main.log_level: %s" % e)
+        workers = confget(cp, 'getint', 'main', 'workers', 0)
+        ipc_dir = confget(cp, 'get', 'main', 'ipc_dir', '/tmp')
+        metrics_http_bind = confget(cp, 'get', 'main', 'metrics_http_bind',
+            '')
+        trace_sample_rate = confget(cp, 'getfloat', 'main',
+            'trace_sample_rate', 0.)
+        trace_buffer_size = confget(cp, 'getint', 'main',
+            'trace_buffer_size', 10000)
+        log_async = confget(cp, 'getboolean', 'main', 'log_async', False)
+        log_queue_size = confget(cp, 'getint', 'main', 'log_queue_size',
+            100000)
+        log_summary_interval = confget(cp, 'getint', 'main',
+            'log_summary_interval', 0)
+        journal_dir = confget(cp, 'get', 'main', 'journal_dir', '')
+        restore_chunk_size = confget(cp, 'getint', 'main',
+            'restore_chunk_size', 1000)
+        restore_order = confget(cp, 'get', 'main', 'restore_order',
+            'restored')
+        queue_memory_budget = confget(cp, 'getint', 'main',
+            'queue_memory_budget', 0)
+        if restore_order not in ('restored', 'new'):
+            raise Exception("main.restore_order: must be \"restored\" or " \
+                "\"new\"")
+        schedule_window = confget(cp, 'getint', 'main', 'schedule_window',
+            300)
+        if schedule_window < 1:
+            raise Exception("main.schedule_window: must be at least 1")
+        busy_high_watermark = confget(cp, 'getint', 'main',
+            'busy_high_watermark', 0)
+        busy_low_watermark = confget(cp, 'getint', 'main',
+            'busy_low_watermark', busy_high_watermark * 3 / 4)
+        busy_high_drain_time = confget(cp, 'getfloat', 'main',
+            'busy_high_drain_time', 0)
+        busy_low_drain_time = confget(cp, 'getfloat', 'main',
+            'busy_low_drain_time', busy_high_drain_time * 3 / 4)
+        if busy_low_watermark > busy_high_watermark or \
+          busy_low_drain_time > busy_high_drain_time:
+            raise Exception("main.busy_low_watermark, " \
+                "main.busy_low_drain_time: must not be above their high " \
+                "counterpart")
+        lane_dispatch = confget(cp, 'get', 'main', 'lane_dispatch', 'strict')
+        lane_weights = None
+        if lane_dispatch != 'strict':
+            try:
+                lane_weights = [int(w) for w in lane_dispatch.split(':')]
+            except ValueError:
+                lane_weights = []
+            if len(lane_weights) != len(LANES) or min(lane_weights) < 1:
+                raise Exception("main.lane_dispatch: must be \"strict\" " \
+                    "or %d positive weights separated by colons" % len(LANES))
+        journal_segsize = confget(cp, 'getint', 'main',
+            'journal_segment_size', 67108864)
+        journal_maxsegs = confget(cp, 'getint', 'main',
+            'journal_max_segments', 16)
         apns_zmq_bind = cp.get('apns', 'zmq_bind')
         apns_sqlitedb = cp.get('apns', 'sqlite_db')
         apns_tableprefix = cp.get('apns', 'table_prefix')
@@ -1705,6 +5585,27 @@ if __name__ == "__main__":
         apns_push_gateway = cp.get('apns', 'push_gateway')
         apns_push_concurrency = cp.getint('apns', 'push_concurrency')
         apns_push_max_error_wait = cp.getfloat('apns', 'push_max_error_wait')
+        apns_push_deadline_sched = confget(cp, 'getboolean', 'apns',
+            'push_deadline_scheduling', False)
+        apns_dedup_window = confget(cp, 'getfloat', 'apns', 'dedup_window',
+            0.)
+        apns_invalid_token_retention = confget(cp, 'getfloat', 'apns',
+            'invalid_token_retention', 0.)
+        apns_device_max_rate = confget(cp, 'getfloat', 'apns',
+            'device_max_rate', 0.)
+        apns_device_burst = confget(cp, 'getint', 'apns', 'device_burst', 1)
+        apns_device_max_delay = confget(cp, 'getfloat', 'apns',
+            'device_max_delay', 0.)
+        apns_device_throttle_slots = confget(cp, 'getint', 'apns',
+            'device_throttle_slots', 4194304)
+        if apns_device_burst < 1:
+            raise Exception("apns.device_burst: must be at least 1")
+        if apns_device_throttle_slots < 1:
+            raise Exception("apns.device_throttle_slots: must be at least 1")
+        apns_breaker_threshold = confget(cp, 'getint', 'apns',
+            'breaker_threshold', 0)
+        apns_breaker_max_cooldown = confget(cp, 'getfloat', 'apns',
+            'breaker_max_cooldown', 60.)
         apns_feedback_gateway = cp.get('apns', 'feedback_gateway')
         apns_feedback_freq = cp.getfloat('apns', 'feedback_frequency')
         gcm_zmq_bind = cp.get('gcm', 'zmq_bind')
@@ -1722,11 +5623,56 @@ if __name__ == "__main__":
         gcm_concurrency = cp.getint('gcm', 'concurrency')
         gcm_max_retries = cp.getint('gcm', 'max_retries')
         gcm_min_interval = cp.getfloat('gcm', 'min_interval')
+        gcm_batch_window = confget(cp, 'getfloat', 'gcm', 'batch_window', 0.)
+        gcm_breaker_threshold = confget(cp, 'getint', 'gcm',
+            'breaker_threshold', 0)
+        gcm_breaker_max_cooldown = confget(cp, 'getfloat', 'gcm',
+            'breaker_max_cooldown', 60.)
         gcm_dry_run = cp.getboolean('gcm', 'dry_run')
+        gcm_collapse_pending = confget(cp, 'getboolean', 'gcm',
+            'collapse_pending', False)
+
+        # Applications other than the default one may override some
+        # options.
+        apns_apps = {}
+        for name, section in appsections(cp, 'apns'):
+            tableprefix = apns_tableprefix
+            if name != DEFAULT_APP:
+                tableprefix = '%s_%s' % (apns_tableprefix, name)
+            apns_apps[name] = AttributeHolder(name=name,
+                tableprefix=confget(cp, 'get', section, 'table_prefix',
+                    tableprefix),
+                cacerts=confget(cp, 'get', section, 'cacerts_file',
+                    apns_cacerts),
+                cert=confget(cp, 'get', section, 'cert_file', apns_cert),
+                key=confget(cp, 'get', section, 'key_file', apns_key),
+                push_gateway=confget(cp, 'get', section, 'push_gateway',
+                    apns_push_gateway),
+                push_concurrency=confget(cp, 'getint', section,
+                    'push_concurrency', apns_push_concurrency),
+                feedback_gateway=confget(cp, 'get', section,
+                    'feedback_gateway', apns_feedback_gateway))
+        gcm_apps = {}
+        for name, section in appsections(cp, 'gcm'):
+            tableprefix = gcm_tableprefix
+            if name != DEFAULT_APP:
+                tableprefix = '%s_%s' % (gcm_tableprefix, name)
+            tableprefix = confget(cp, 'get', section, 'table_prefix',
+                tableprefix)
+            gcm_apps[name] = AttributeHolder(name=name,
+                tableprefix=tableprefix,
+                api_key=confget(cp, 'get', section, 'api_key', gcm_api_key),
+                feedback_dbinfo=AttributeHolder(db=gcm_sqlitedb,
+                    table='%s_feedback' % tableprefix,
+                    lock=threading.Lock()))
+        tenants = readtenants(cp)
     except BaseException as e:
         logging.error("%s: %s" % (CONFIGFILE, e))
         sys.exit(1)
 
+    # Before worker processes are forked, so they inherit it.
+    Tracer().configure(trace_sample_rate, trace_buffer_size)
+
     if daemon and len(logfile) == 0:
         logging.error("Option main.log_file cannot be empty in daemon mode")
         sys.exit(1)
@@ -1745,16 +5691,19 @@ if __name__ == "__main__":
     #
     formatter = logging.Formatter('%(asctime)s %(name)s/%(threadName)s: ' \
         '%(message)s', '%Y/%m/%d %H:%M:%S')
-    main_logger = createLogger('push2mob', logfile, loglevel, False, formatter)
+    asyncqueue = log_queue_size if log_async else 0
+    main_logger = createLogger('push2mob', logfile, loglevel, False, formatter,
+        asyncqueue)
     main_logger.propagate = False
     if logstdout:
-        handler = logging.StreamHandler()
-        handler.setFormatter(formatter)
-        main_logger.addHandler(handler)
+        main_logger.addHandler(createHandler(logging.StreamHandler(),
+            formatter, asyncqueue))
     apns_logger = createLogger('push2mob.APNS', apns_logfile, apns_loglevel,
-        apns_logpropagate, formatter)
+        apns_logpropagate, formatter, asyncqueue)
     gcm_logger = createLogger('push2mob.GCM', gcm_logfile, gcm_loglevel,
-        gcm_logpropagate, formatter)
+        gcm_logpropagate, formatter, asyncqueue)
+    if log_summary_interval > 0:
+        NOTIFICATION_LOGLEVEL = logging.DEBUG
 
     #
     # Daemonize.
@@ -1773,28 +5722,90 @@ if __name__ == "__main__":
         main_logger.warning("Starting with pid %u..." % os.getpid())
 
         #
-        # Check APNS push/feedback TLS connections.
+        # Check APNS push/feedback TLS connections of each application.
         #
-        apns_tlsconnect = TLSConnectionMaker(apns_cacerts, apns_cert, apns_key)
-        main_logger.info("Testing APNS push gateway...")
-        l = apns_push_gateway.split(':', 2)
-        apns_push_gateway = (l[0], int(l[1]))
-        s = apns_tlsconnect(apns_push_gateway, 0,
-            "%s: Cannot connect to APNS (%%s:%%d): %%s" % CONFIGFILE)
-        if s is None:
-            sys.exit(3)
-        s.close()
-
-        main_logger.info("Testing APNS feedback gateway...")
-        l = apns_feedback_gateway.split(':', 2)
-        apns_feedback_gateway = (l[0], int(l[1]))
-        apns_feedback_sock = apns_tlsconnect(apns_feedback_gateway, 0,
-            "%s: Cannot connect to APNS feedback service (%%s:%%d): %%s" % \
-            CONFIGFILE)
-        if apns_feedback_sock is None:
-            sys.exit(3)
-        # Do not close it because the APNS feedback service immediately sends
-        # something that we don't want to loose.
+        for app in apns_apps.itervalues():
+            app.tlsconnect = TLSConnectionMaker(app.cacerts, app.cert,
+                app.key)
+            main_logger.info("Testing APNS push gateway for application " \
+                "%s..." % app.name)
+            l = app.push_gateway.split(':', 2)
+            app.push_gateway = (l[0], int(l[1]))
+            app.breaker = None
+            if apns_breaker_threshold > 0:
+                app.breaker = CircuitBreaker(apns_logger,
+                    "APNS push gateway %s:%d of application %s" %
+                    (app.push_gateway + (app.name,)),
+                    (('service', 'apns'), ('app', app.name)),
+                    apns_breaker_threshold, apns_breaker_max_cooldown)
+            s = app.tlsconnect(app.push_gateway, 0,
+                "%s: Cannot connect to APNS (%%s:%%d): %%s" % CONFIGFILE)
+            if s is None:
+                sys.exit(3)
+            s.close()
+
+            main_logger.info("Testing APNS feedback gateway for " \
+                "application %s..." % app.name)
+            l = app.feedback_gateway.split(':', 2)
+            app.feedback_gateway = (l[0], int(l[1]))
+            app.feedbacksock = app.tlsconnect(app.feedback_gateway, 0,
+                "%s: Cannot connect to APNS feedback service " \
+                "(%%s:%%d): %%s" % CONFIGFILE)
+            if app.feedbacksock is None:
+                sys.exit(3)
+            # Do not close it because the APNS feedback service immediately
+            # sends something that we don't want to loose.
+
+        #
+        # Fork worker processes before any thread or ZMQ context is
+        # created.  They only run the agents.
+        #
+        gcm_breaker = None
+        if gcm_breaker_threshold > 0:
+            gcm_breaker = CircuitBreaker(gcm_logger,
+                "GCM server %s" % gcm_server_url, (('service', 'gcm'),),
+                gcm_breaker_threshold, gcm_breaker_max_cooldown)
+        # Tenants take turns in each lane of the push queues, by deficit
+        # round-robin: each one may send to as many devices as its weight
+        # per turn, a GCM notification costing its number of
+        # registration IDs.
+        quantum = lambda tenant: \
+            tenants[tenant].weight if tenant in tenants else 1
+        apns_fairness = AttributeHolder(tenant=lambda apnsmsg: apnsmsg[6],
+            cost=lambda apnsmsg: 1, quantum=quantum)
+        gcm_fairness = AttributeHolder(tenant=lambda gcmmsg: gcmmsg.tenant,
+            cost=lambda gcmmsg: len(gcmmsg.devtoks), quantum=quantum)
+        agentconf = AttributeHolder(apns_logger=apns_logger,
+            apns_devtokfmt=apns_devtokfmt,
+            apns_push_max_error_wait=apns_push_max_error_wait,
+            gcm_logger=gcm_logger, gcm_concurrency=gcm_concurrency,
+            gcm_server_url=gcm_server_url, gcm_cacerts=gcm_cacerts,
+            gcm_min_interval=gcm_min_interval,
+            gcm_batch_window=gcm_batch_window, gcm_dry_run=gcm_dry_run,
+            gcm_max_retries=gcm_max_retries,
+            gcm_expbackoffdb=GCMExponentialBackoffDatabase(gcm_max_retries),
+            gcm_breaker=gcm_breaker,
+            apns_fairness=apns_fairness, gcm_fairness=gcm_fairness,
+            apns_push_concurrency=dict((name, app.push_concurrency)
+                for name, app in apns_apps.iteritems()))
+        workerpool = None
+        if workers > 0:
+            main_logger.info("Starting %d worker processes..." % workers)
+            workerpool = WorkerPool(main_logger, workers, ipc_dir)
+            idx = workerpool.fork()
+            if idx is not None:
+                try:
+                    for app in apns_apps.itervalues():
+                        app.feedbacksock.close()
+                    Worker(idx, workerpool, main_logger).run(agentconf,
+                        apns_apps, gcm_apps)
+                except BaseException as e:
+                    main_logger.exception("Uncaugth exception in worker " \
+                        "%d: %s" % (idx, e))
+                    logging.shutdown()
+                    os._exit(99)
+                logging.shutdown()
+                os._exit(0)
 
         #
         # Creation ZMQ sockets early so we don't waste other resource
@@ -1806,7 +5817,7 @@ if __name__ == "__main__":
             zmqctx_r = zmq.Context()
             apns_zmqsock = zmqctx_r.socket(zmq.REP)
             apns_zmqsock.bind("tcp://%s" % apns_zmq_bind)
-        except zmq.core.error.ZMQError as e:
+        except zmq.ZMQError as e:
             main_logger.error("Cannot create ZMQ REP socket for APNS on " \
                 "tcp://%s: %s" % (apns_zmq_bind, e))
             sys.exit(3)
@@ -1817,7 +5828,7 @@ if __name__ == "__main__":
             zmqctx_r = zmq.Context()
             gcm_zmqsock = zmqctx_r.socket(zmq.REP)
             gcm_zmqsock.bind("tcp://%s" % gcm_zmq_bind)
-        except zmq.core.error.ZMQError as e:
+        except zmq.ZMQError as e:
             main_logger.error("Cannot create ZMQ REP socket for GCM on " \
                 "tcp://%s: %s" % (gcm_zmq_bind, e))
             sys.exit(3)
@@ -1825,32 +5836,122 @@ if __name__ == "__main__":
         #
         # Create persistent queues for notifications and feedback.
         #
-        apns_push_dbinfo = AttributeHolder(db=apns_sqlitedb,
-            table=('%s_notifications' % apns_tableprefix))
-        apns_feedback_dbinfo = AttributeHolder(db=apns_sqlitedb,
-            table=('%s_feedback' % apns_tableprefix))
-        gcm_push_dbinfo = AttributeHolder(db=gcm_sqlitedb,
-            table=('%s_notifications' % gcm_tableprefix))
-        gcm_feedback_dbinfo = AttributeHolder(db=gcm_sqlitedb,
-            table='%s_feedback' % gcm_tableprefix,
-            lock=threading.Lock())
-
-        apns_pushq = CheckpointableQueue(apns_push_dbinfo)
-        main_logger.info("%d APNS notifications retrieved from persistent " \
-            "storage" % apns_pushq.qsize())
-        apns_feedbackq = CheckpointableQueue(apns_feedback_dbinfo)
-        main_logger.info("%d APNS feedbacks retrieved from persistent " \
-            "storage" % apns_feedbackq.qsize())
-        gcm_pushq = CheckpointableTimelySQueue(gcm_push_dbinfo)
+        # Each APNS application has its own queues, GCM applications
+        # share the same one.  Their content is restored afterwards.
+        # Push queues have a queue per priority lane, the normal one
+        # using the table of the queue of older versions.  They share the
+        # memory budget, if any.
+        restoredfirst = restore_order == 'restored'
+        budget = MemoryBudget(queue_memory_budget)
+        apns_memory = None
+        gcm_memory = None
+        if queue_memory_budget > 0:
+            apns_memory = AttributeHolder(budget=budget, sizeof=apns_sizeof)
+            gcm_memory = AttributeHolder(budget=budget,
+                sizeof=GCMNotification.sizeof)
+        lanetable = lambda prefix, lane: '%s_notifications%s' % (prefix,
+            '' if lane == LANE_NORMAL else '_' + lane)
+        completions = Completions()
+        torestore = []
+        for app in apns_apps.itervalues():
+            feedback_dbinfo = AttributeHolder(db=apns_sqlitedb,
+                table=('%s_feedback' % app.tableprefix))
+
+            lanes = []
+            for lane in LANES:
+                push_dbinfo = AttributeHolder(db=apns_sqlitedb,
+                    table=lanetable(app.tableprefix, lane),
+                    upgrade=apns_upgrade)
+                if apns_push_deadline_sched:
+                    lanes.append(CheckpointableDeadlineQueue(push_dbinfo,
+                        apns_deadline, apns_fairness,
+                        apns_discard(completions, app.name), apns_memory))
+                else:
+                    lanes.append(CheckpointableQueue(push_dbinfo,
+                        restoredfirst, apns_fairness, apns_memory))
+            app.pushq = LanedQueue(lanes, lambda apnsmsg: apnsmsg[5],
+                LaneScheduler(lane_weights))
+            app.invalid = None
+            if apns_invalid_token_retention > 0:
+                app.invalid = APNSInvalidTokens(AttributeHolder(
+                    db=apns_sqlitedb, table='%s_invalid' % app.tableprefix),
+                    apns_invalid_token_retention)
+                main_logger.info("%d invalid APNS device tokens of " \
+                    "application %s retrieved from persistent storage" %
+                    (len(app.invalid), app.name))
+            app.feedbackq = APNSFeedbackQueue(feedback_dbinfo, restoredfirst,
+                app.invalid)
+            torestore.append(("APNS notifications of application %s" %
+                app.name, app.pushq))
+            torestore.append(("APNS feedbacks of application %s" % app.name,
+                app.feedbackq))
+
+        getcond = threading.Condition()
+        gcm_index = GCMCollapseIndex()
+        lanes = []
+        for lane in LANES:
+            gcm_push_dbinfo = AttributeHolder(db=gcm_sqlitedb,
+                table=lanetable(gcm_tableprefix, lane),
+                upgrade=GCMNotification.upgrade)
+            if gcm_collapse_pending:
+                lanes.append(GCMCollapsingQueue(gcm_push_dbinfo, completions,
+                    getcond, gcm_fairness, gcm_memory, gcm_index))
+            else:
+                lanes.append(CheckpointableTimelySQueue(gcm_push_dbinfo,
+                    getcond, gcm_fairness, gcm_memory))
+        gcm_pushq = LanedTimelyQueue(lanes, lambda gcmmsg: gcmmsg.lane,
+            LaneScheduler(lane_weights))
         gcm_pushq.start()
-        main_logger.info("%d GCM notifications retrieved from persistent " \
-            "storage" % gcm_pushq.qsize())
-        db = GCMFeedbackDatabase(gcm_feedback_dbinfo)
-        main_logger.info("%d GCM feedbacks retrieved from persistent " \
-            "storage" % db.count())
-        del db
+        torestore.append(("GCM notifications", gcm_pushq))
+        if busy_high_watermark > 0 or busy_high_drain_time > 0:
+            for app in apns_apps.itervalues():
+                app.pushq.admission = Admission("APNS push queue of " \
+                    "application %s" % app.name, app.pushq,
+                    busy_high_watermark, busy_low_watermark,
+                    busy_high_drain_time, busy_low_drain_time)
+            gcm_pushq.admission = Admission("GCM push queue", gcm_pushq,
+                busy_high_watermark, busy_low_watermark,
+                busy_high_drain_time, busy_low_drain_time)
+        if restore_chunk_size <= 0:
+            for desc, q in torestore:
+                main_logger.info("%d %s retrieved from persistent storage" %
+                    (q.restore(), desc))
+        else:
+            for desc, q in torestore:
+                main_logger.info("%d %s to retrieve from persistent " \
+                    "storage in the background" % (q.torestore, desc))
+        for app in gcm_apps.itervalues():
+            db = GCMFeedbackDatabase(app.feedback_dbinfo)
+            main_logger.info("%d GCM feedbacks of application %s " \
+                "retrieved from persistent storage" % (db.count(), app.name))
+            del db
 
-        gcm_expbackoffdb = GCMExponentialBackoffDatabase(gcm_max_retries)
+        #
+        # Create the schedulers of notifications sent with the "at"
+        # option, which put them in the push queues when due.
+        #
+        def apns_route(appname, apnsmsg):
+            app = apns_apps.get(appname)
+            if app is None:
+                uid, creation, expiry, devtok = apnsmsg[:4]
+                main_logger.warning("Discarding scheduled APNS " \
+                    "notification #%d of unknown application %s" %
+                    (uid, appname))
+                completions('apns', appname, uid, creation,
+                    OUTCOME_DISCARDED, (devtok, ), apnsmsg[6])
+                return
+            app.pushq.put(apnsmsg)
+        apns_scheduler = Scheduler('apns', AttributeHolder(db=apns_sqlitedb,
+            table='%s_scheduled' % apns_tableprefix, upgrade=apns_upgrade),
+            schedule_window, apns_route)
+        gcm_scheduler = Scheduler('gcm', AttributeHolder(db=gcm_sqlitedb,
+            table='%s_scheduled' % gcm_tableprefix,
+            upgrade=GCMNotification.upgrade),
+            schedule_window, lambda appname, gcmmsg: gcm_pushq.put(now(),
+            gcmmsg))
+        main_logger.info("%d scheduled APNS notifications and %d " \
+            "scheduled GCM notifications in persistent storage" %
+            (apns_scheduler.qsize(), gcm_scheduler.qsize()))
 
         #
         # Prepare the exit door.
@@ -1865,48 +5966,178 @@ if __name__ == "__main__":
         signal.signal(signal.SIGQUIT, exit_handler)
 
         #
-        # Start APNS ang GCM agent threads and APNS feedback one.
+        # Start APNS ang GCM agent threads (or dispatchers to worker
+        # processes) and APNS feedback one.
         #
         threadlist = []
-        for i in range(apns_push_concurrency):
-            t = APNSAgent(i, apns_logger, apns_devtokfmt, apns_pushq,
-                apns_push_gateway, apns_push_max_error_wait,
-                apns_feedbackq, apns_tlsconnect)
+        metrics = Metrics()
+        completions.register(metrics.completed)
+        if workerpool is None:
+            completions.register(Tracer().completed)
+        if log_summary_interval > 0:
+            t = LogSummary({'apns': apns_logger, 'gcm': gcm_logger},
+                log_summary_interval)
+            completions.register(t.completed)
             threadlist.append(t)
             t.start()
+        journal = None
+        if len(journal_dir) > 0:
+            try:
+                journal = Journal(journal_dir, journal_segsize,
+                    journal_maxsegs)
+            except (IOError, OSError) as e:
+                main_logger.error("Cannot open the journal in %s: %s" %
+                    (journal_dir, e))
+                sys.exit(3)
+            main_logger.info("Journal in %s" % journal_dir)
+            completions.register(journal.completed)
+        for app in apns_apps.itervalues():
+            labels = (('service', 'apns'), ('app', app.name))
+            for lane, q in zip(LANES, app.pushq.lanes):
+                metrics.gauge('push2mob_queue_depth',
+                    labels + (('queue', 'push'), ('lane', lane)), q.qsize)
+                metrics.gauge('push2mob_queue_spilled',
+                    labels + (('lane', lane),), q.spilled)
+            metrics.gauge('push2mob_queue_depth',
+                labels + (('queue', 'feedback'),), app.feedbackq.qsize)
+            if app.invalid is not None:
+                metrics.gauge('push2mob_invalid_tokens', labels,
+                    app.invalid.__len__)
+        for lane, q in zip(LANES, gcm_pushq.lanes):
+            metrics.gauge('push2mob_queue_depth',
+                (('service', 'gcm'), ('queue', 'push'), ('lane', lane)),
+                q.qsize)
+            metrics.gauge('push2mob_queue_spilled',
+                (('service', 'gcm'), ('lane', lane)), q.spilled)
+        admissions = [((('service', 'apns'), ('app', app.name)),
+            app.pushq.admission) for app in apns_apps.itervalues()]
+        admissions.append(((('service', 'gcm'),), gcm_pushq.admission))
+        for labels, a in admissions:
+            if a is None:
+                continue
+            metrics.gauge('push2mob_queue_busy', labels,
+                lambda a=a: int(a.busy))
+            metrics.gauge('push2mob_queue_drain_rate', labels,
+                lambda a=a: a.rate or 0)
+        metrics.gauge('push2mob_queue_memory_bytes', (),
+            lambda: budget.used)
+        metrics.gauge('push2mob_queue_memory_limit_bytes', (),
+            lambda: budget.limit)
+        metrics.gauge('push2mob_queue_depth',
+            (('service', 'apns'), ('queue', 'scheduled')),
+            apns_scheduler.qsize)
+        metrics.gauge('push2mob_queue_depth',
+            (('service', 'gcm'), ('queue', 'scheduled')),
+            gcm_scheduler.qsize)
+        agents = None
+        if workerpool is None:
+            agents = Agents(agentconf, apns_apps, gcm_apps, gcm_pushq,
+                completions)
+            threadlist.extend(agents.start())
+        else:
+            threadlist.extend(workerpool.start(apns_apps, gcm_pushq,
+                completions))
 
         t = APNSFeedbackAgent(0, apns_logger, apns_devtokfmt,
-            apns_feedbackq, apns_feedback_sock, apns_feedback_gateway,
-            apns_feedback_freq, apns_tlsconnect)
+            apns_apps.values(), apns_feedback_freq)
         threadlist.append(t)
         t.start()
-
-        for i in range(gcm_concurrency):
-            t = GCMAgent(i, gcm_logger, gcm_pushq, gcm_server_url,
-                gcm_api_key, gcm_cacerts, gcm_min_interval, gcm_dry_run,
-                gcm_expbackoffdb, gcm_feedback_dbinfo)
+        for t in (apns_scheduler, gcm_scheduler):
             threadlist.append(t)
             t.start()
 
+        #
+        # Serve metrics to Prometheus.
+        #
+        if len(metrics_http_bind) > 0:
+            main_logger.info("Metrics served on http://%s/metrics" %
+                metrics_http_bind)
+            l = metrics_http_bind.split(':', 2)
+            try:
+                httpd = BaseHTTPServer.HTTPServer((l[0], int(l[1])),
+                    MetricsHTTPHandler)
+            except socket.error as e:
+                main_logger.error("Cannot serve metrics on %s: %s" %
+                    (metrics_http_bind, e))
+                sys.exit(3)
+            t = threading.Thread(target=httpd.serve_forever,
+                name="MetricsHTTP")
+            t.daemon = True
+            t.start()
+
         #
         # Start APNSListener and GCMListener threads.
         #
-        t = APNSListener(0, apns_logger, apns_zmqsock, apns_pushq,
-            apns_feedbackq)
+        apns_throttle = None
+        if apns_device_max_rate > 0:
+            apns_throttle = AttributeHolder(rate=apns_device_max_rate,
+                burst=apns_device_burst, slots=apns_device_throttle_slots,
+                maxdelay=apns_device_max_delay)
+        t = APNSListener(0, apns_logger, apns_zmqsock, apns_apps,
+            apns_dedup_window, tenants, apns_scheduler, apns_throttle)
         threadlist.append(t)
         t.start()
-        t = GCMListener(0, gcm_logger, gcm_zmqsock, gcm_pushq,
-            gcm_feedback_dbinfo)
+        t = GCMListener(0, gcm_logger, gcm_zmqsock, gcm_pushq, gcm_apps,
+            tenants, gcm_scheduler)
         threadlist.append(t)
         t.start()
 
+        #
+        # Restore persistent queues while serving.
+        #
+        if restore_chunk_size > 0:
+            t = QueueRestorer(torestore, restore_chunk_size)
+            t.start()
+
+        #
+        # Reload the configuration on SIGHUP, from another thread as
+        # for exit.
+        #
+        reloadmutex = threading.Lock()
+        def reload():
+            with Locker(reloadmutex):
+                main_logger.info("Reloading %s..." % CONFIGFILE)
+                try:
+                    conf = reloadconf(CONFIGFILE, apns_apps)
+                except Exception as e:
+                    main_logger.error("%s: %s, configuration not reloaded" %
+                        (CONFIGFILE, e))
+                    return
+                reconfigure(conf, agents)
+                if workerpool is not None:
+                    workerpool.reload(conf)
+                main_logger.info("Reloaded %s: APNS concurrency %s, " \
+                    "GCM concurrency %d" % (CONFIGFILE,
+                    ', '.join("%s=%d" % i for i in
+                        sorted(conf.apns_push_concurrency.iteritems())),
+                    conf.gcm_concurrency))
+        def reload_handler(signum, frame):
+            t = threading.Thread(target=reload, name="Reload")
+            t.daemon = True
+            t.start()
+        signal.signal(signal.SIGHUP, reload_handler)
+
         exithelper.waitexit()
-        apns_pushq_size = apns_pushq.checkpoint()
-        apns_feedbackq_size = apns_feedbackq.checkpoint()
+        if workerpool is not None:
+            workerpool.stop(30)
+        for app in apns_apps.itervalues():
+            apns_pushq_size = app.pushq.checkpoint()
+            apns_feedbackq_size = app.feedbackq.checkpoint()
+            main_logger.info("Checkpointed %u APNS notifications, " \
+              "%u APNS feedback tuples of application %s" %
+              (apns_pushq_size, apns_feedbackq_size, app.name))
+            if apns_push_deadline_sched:
+                main_logger.info("Discarded %u stale APNS notifications " \
+                  "of application %s when dequeuing, %u when checkpointing" %
+                  (app.pushq.dropped_at_dequeue, app.name,
+                   app.pushq.dropped_at_checkpoint))
         gcm_pushq_size = gcm_pushq.checkpoint()
-        main_logger.info("Checkpointed %u APNS notifications, " \
-          "%u APNS feedback tuples, %u GCM notifications" %
-          (apns_pushq_size, apns_feedbackq_size, gcm_pushq_size))
+        main_logger.info("Checkpointed %u GCM notifications" % gcm_pushq_size)
+        main_logger.info("Checkpointed %u scheduled APNS notifications and " \
+            "%u scheduled GCM notifications" % (apns_scheduler.checkpoint(),
+            gcm_scheduler.checkpoint()))
+        if journal is not None:
+            journal.close()
         # Never reached.
         sys.exit(0)
 
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+#
+# Checks the push queues of push2mob in process, without any network:
+# each check builds its queues on SQLite databases of a temporary
+# directory, runs a scenario and prints PASS or FAIL.  Exits with
+# status 1 if any check fails.
+#
+
+import getopt
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import push2mob
+from push2mob import AttributeHolder, CheckpointableDeadlineQueue, \
+    GCMCollapseIndex, GCMCollapsingQueue, GCMNotification, LaneScheduler, \
+    LanedTimelyQueue, MemoryBudget, Spill
+
+def usage():
+    print """Usage: queuetest.py [options]
+Options:
+  -k    Only run scenarios whose name matches this regular expression
+  -h    Show this help message"""
+
+# List of (name, scenario), scenario returning whether all its checks
+# passed.
+SCENARIOS = []
+
+def scenario(name):
+    def register(func):
+        SCENARIOS.append((name, func))
+        return func
+    return register
+
+def check(what, ok):
+    print "%s: %s" % ("PASS" if ok else "FAIL", what)
+    return ok
+
+WORKDIR = None
+
+def dbinfo(name, **kwargs):
+    return AttributeHolder(db=os.path.join(WORKDIR, "%s.db" % name),
+        table=name, **kwargs)
+
+class Outcomes:
+    """
+    Completions hook recording the outcome of every notification.
+    """
+
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.outcomes = []
+
+    def __call__(self, service, appname, uid, creation, outcome, devtoks,
+      tenant):
+        with self.mutex:
+            self.outcomes.append((uid, outcome, list(devtoks)))
+
+    def of(self, uid):
+        with self.mutex:
+            return [(o, d) for u, o, d in self.outcomes if u == uid]
+
+def apnsnotification(uid, creation, expiry):
+    return (uid, creation, expiry, "%064x" % uid, '{"uid": %d}' % uid,
+        push2mob.LANE_NORMAL, push2mob.DEFAULT_TENANT)
+
+def gcmnotification(uid, creation, devtoks, lane):
+    return GCMNotification(uid, creation, 'news', creation + 3600, False,
+        devtoks, {'uid': uid}, push2mob.DEFAULT_APP, lane,
+        push2mob.DEFAULT_TENANT, len(json.dumps({'uid': uid})))
+
+@scenario("gcm.collapse.lanes")
+def _():
+    outcomes = Outcomes()
+    getcond = threading.Condition()
+    index = GCMCollapseIndex()
+    lanes = [GCMCollapsingQueue(dbinfo("gcm_%s" % lane), outcomes,
+        getcond, None, None, index) for lane in push2mob.LANES]
+    q = LanedTimelyQueue(lanes, lambda gcmmsg: gcmmsg.lane, LaneScheduler())
+    q.start()
+    curtime = push2mob.now()
+    q.put(curtime, gcmnotification(1, curtime, ['a', 'b'],
+        push2mob.LANES[-1]))
+    q.put(curtime, gcmnotification(2, curtime + 1, ['a'], push2mob.LANE_HIGH))
+    first = q.get(1)
+    second = q.get(1)
+    ok = check("the newer notification of the high lane is handed out " \
+        "first", first is not None and first.uid == 2)
+    ok &= check("the older notification of the bulk lane is handed out " \
+        "without the registration IDs superseded from the high lane",
+        second is not None and second.uid == 1 and second.devtoks == ['b'])
+    ok &= check("registration IDs superseded across lanes are reported " \
+        "as discarded",
+        outcomes.of(1) == [(push2mob.OUTCOME_DISCARDED, ['a'])])
+    return ok
+
+@scenario("apns.deadline.stale")
+def _():
+    discarded = []
+    q = CheckpointableDeadlineQueue(dbinfo("apns"), push2mob.apns_deadline,
+        None, lambda apnsmsg, when: discarded.append((apnsmsg[0], when)))
+    curtime = push2mob.now()
+    q.put(apnsnotification(1, curtime - 10, curtime - 1))
+    q.put(apnsnotification(2, curtime, curtime + 3600))
+    q.put(apnsnotification(3, curtime, curtime + 0.2))
+    for i in range(3):
+        q.checkpoint()
+    ok = check("a stale notification is dropped once at checkpoint",
+        q.dropped_at_checkpoint == 1 and discarded == [(1, "checkpoint")])
+    ok &= check("a stale notification dropped at checkpoint leaves the " \
+        "queue", q.qsize() == 2)
+    time.sleep(0.3)
+    item = q.get(True, 1)
+    ok &= check("a notification gone stale is dropped once at dequeue",
+        item[0] == 2 and q.dropped_at_dequeue == 1 and
+        discarded[1:] == [(3, "dequeue")])
+    return ok
+
+@scenario("apns.deadline.spill")
+def _():
+    budget = MemoryBudget(20 * push2mob.apns_sizeof(apnsnotification(0, 0, 0)))
+    memory = AttributeHolder(budget=budget, sizeof=push2mob.apns_sizeof)
+    discarded = []
+    info = dbinfo("apns", upgrade=push2mob.apns_upgrade)
+    q = CheckpointableDeadlineQueue(info, push2mob.apns_deadline, None,
+        lambda apnsmsg, when: discarded.append(apnsmsg[0]), memory)
+    curtime = push2mob.now()
+    for i in range(100):
+        q.put(apnsnotification(i, curtime, curtime + 3600 - i))
+    ok = check("notifications over the memory budget are spilled",
+        q.spilled() == 80)
+    first = [q.get(False)[0] for i in range(3)]
+    ok &= check("notifications in memory are handed out by earliest " \
+        "deadline first", first == [19, 18, 17])
+    q.put(apnsnotification(100, curtime - 10, curtime - 1))
+    q.checkpoint()
+    # As after a restart.
+    budget = MemoryBudget(budget.limit)
+    memory = AttributeHolder(budget=budget, sizeof=push2mob.apns_sizeof)
+    q = CheckpointableDeadlineQueue(info, push2mob.apns_deadline, None,
+        lambda apnsmsg, when: discarded.append(apnsmsg[0]), memory)
+    q.restore()
+    rest = []
+    while q.qsize() > 0:
+        rest.append(q.get(False)[0])
+    ok &= check("spilled notifications are checkpointed and handed out " \
+        "after a restart", sorted(rest) == range(17) + range(20, 100) and
+        discarded == [100])
+    ok &= check("the memory budget is released", budget.used == 0)
+    return ok
+
+@scenario("spill.restart")
+def _():
+    info = dbinfo("spill")
+    # Restored items are numbered from 1, others from 11.
+    spill = Spill(info)
+    spill.push(1, restored=True)
+    spill.push(11)
+    spill.push(2, restored=True)
+    spill.flush()
+    # Restarted after a crash, with the rows of the first run left over.
+    spill = Spill(info)
+    ok = check("restored items left over are counted",
+        spill.restored == 2 and len(spill) == 3)
+    spill.push(3, restored=True)
+    spill.push(12)
+    items = spill.pop(10)
+    ok &= check("restored items left over go before the ones restored " \
+        "after the restart", items == [1, 2, 3, 11, 12])
+    ok &= check("restored items are all paged in",
+        spill.restored == 0 and len(spill) == 0)
+    return ok
+
+
+if __name__ == "__main__":
+    pattern = None
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "k:h")
+    except getopt.GetoptError as e:
+        print >>sys.stderr, e
+        sys.exit(1)
+    for o, a in opts:
+        if o == "-k":
+            pattern = re.compile(a)
+        elif o == "-h":
+            usage()
+            sys.exit(0)
+
+    # Queues use the main logger.
+    push2mob.main_logger = logging.getLogger("queuetest")
+    push2mob.main_logger.addHandler(logging.NullHandler())
+    ok = True
+    for name, func in SCENARIOS:
+        if pattern is not None and not pattern.search(name):
+            continue
+        WORKDIR = tempfile.mkdtemp(prefix="queuetest")
+        try:
+            print "%s:" % name
+            ok &= func()
+        finally:
+            shutil.rmtree(WORKDIR)
+    sys.exit(0 if ok else 1)